@@ -1,7 +1,7 @@
 # Scriptable KVM/QEMU guest agent in Python.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: December 9, 2019
+# Last Change: October 16, 2026
 # URL: https://negotiator.readthedocs.org
 
 """
@@ -19,17 +19,34 @@ while avoiding code duplication.
 """
 
 # Standard library modules.
-import json
+import collections
+import functools
+import itertools
 import logging
-import os
-
-# External dependencies.
-from executor import execute
-from humanfriendly import Timer, compact
+import sys
+import threading
+import types
 
 # Modules included in our project.
-from negotiator_common.utils import format_call
-from negotiator_common.config import BUILTIN_COMMANDS_DIRECTORY, USER_COMMANDS_DIRECTORY
+from negotiator_common.config import (
+    DEFAULT_CONCURRENCY,
+    MAX_BATCH_CONCURRENCY,
+    MAX_INPUT_CHUNKS_IN_FLIGHT,
+    PREFERRED_CODECS,
+    RESULT_CACHE_SIZE,
+    STREAM_CHUNK_SIZE,
+    STREAMING_CONCURRENCY,
+)
+from negotiator_common.execution import CachedResult, CommandExecutionMixin
+from negotiator_common.serialization import (
+    AVAILABLE_CODECS,
+    JSONCodec,
+    binary,
+    extract_attachments,
+    restore_attachments,
+)
+from negotiator_common.transfer import FileTransferMixin
+from negotiator_common.utils import ResultCache, Timer, WorkerPool, format_call
 
 # Semi-standard module versioning.
 __version__ = '0.12.2'
@@ -38,20 +55,30 @@ __version__ = '0.12.2'
 logger = logging.getLogger(__name__)
 
 
-class NegotiatorInterface(object):
+class NegotiatorInterface(CommandExecutionMixin, FileTransferMixin):
 
     """
     Common logic shared between the host/guest components.
 
     This class defines the protocol that's used to communicate between the
-    Python programs running on the hosts and guests.
+    Python programs running on the hosts and guests. Only the methods named
+    in :attr:`exported_methods` can be called by the remote side, sub classes
+    that define additional methods for the remote side extend this tuple.
     """
 
+    exported_methods = (('select_codec', 'call_batch')
+                        + CommandExecutionMixin.exported_methods
+                        + FileTransferMixin.exported_methods)
+    """The names of the methods that the remote side is allowed to call (a tuple of strings)."""
+
+    preferred_codecs = PREFERRED_CODECS
+    """The names of the codecs offered to the remote side, in order of preference (a tuple of strings)."""
+
     def __init__(self, handle, label):
         """
         Initialize a negotiator host or guest agent.
 
-        :param handle: A file like object connected to the other side.
+        :param handle: A binary file like object connected to the other side.
         :param label: A string describing the file like object (used in logging).
 
         This constructor is intended to be called by sub classes to provide the
@@ -60,21 +87,34 @@ class NegotiatorInterface(object):
         """
         self.conn_handle = handle
         self.conn_label = label
-        # Somewhere in the Python installation process the executable bits of
-        # the built-in scripts get lost. This is a pragmatic hack to compensate
-        # for that.
-        for entry in os.listdir(BUILTIN_COMMANDS_DIRECTORY):
-            pathname = os.path.join(BUILTIN_COMMANDS_DIRECTORY, entry)
-            if os.path.isfile(pathname) and not os.access(pathname, os.X_OK):
-                logger.debug("Making %s executable ..", pathname)
-                os.chmod(pathname, 0o755)
+        # State used to multiplex concurrent remote method calls on a single
+        # channel (see start_remote_call() and wait_for_response()).
+        self.request_ids = itertools.count(1)
+        self.pending_calls = collections.OrderedDict()
+        self.read_condition = threading.Condition()
+        self.read_in_progress = False
+        self.write_lock = threading.Lock()
+        # The codec used to encode the messages we send (see negotiate_codec()).
+        self.codec = None
+        self.codec_negotiated = False
+        self.negotiate_lock = threading.Lock()
+        # Whether the remote side supports batch calls (see call_remote_batch()).
+        self.batch_supported = True
+        # The standard input streams of commands started by execute_streaming().
+        self.input_streams = {}
+        # Limits the number of streaming responses sent at the same time (see process_request()).
+        self.streaming_slots = threading.Semaphore(STREAMING_CONCURRENCY)
+        # Unfinished uploads (see negotiator_common.transfer).
+        self.uploads = {}
+        # The output of cacheable commands (see find_cache_ttl()).
+        self.result_cache = ResultCache(RESULT_CACHE_SIZE)
 
     def raw_read(self, num_bytes):
         """
         Read the given number of bytes from the remote side.
 
         :param num_bytes: The number of bytes to read (an integer).
-        :returns: The data read from the remote side (a string).
+        :returns: The data read from the remote side (a byte string).
         """
         logger.debug("Preparing to read %i bytes from %s ..", num_bytes, self.conn_label)
         data = self.conn_handle.read(num_bytes)
@@ -85,7 +125,7 @@ class NegotiatorInterface(object):
         """
         Read a newline terminated string from the remote side.
 
-        :returns: The data read from the remote side (a string).
+        :returns: The data read from the remote side (a byte string).
         """
         logger.debug("Preparing to read line from %s ..", self.conn_label)
         data = self.conn_handle.readline()
@@ -96,7 +136,7 @@ class NegotiatorInterface(object):
         """
         Write a string of data to the remote side.
 
-        :param data: The data to write tot the remote side (a string).
+        :param data: The data to write to the remote side (a byte string).
         """
         logger.debug("Preparing to write %i bytes to %s ..", len(data), self.conn_label)
         self.conn_handle.write(data)
@@ -105,59 +145,80 @@ class NegotiatorInterface(object):
 
     def read(self):
         """
-        Wait for a JSON encoded message from the remote side.
+        Wait for a message from the remote side.
+
+        :returns: The message decoded to a Python value.
+        :raises: :exc:`ProtocolError` when the remote side violates the
+                 defined protocol.
+
+        Refer to :func:`read_frame()` for details about the protocol.
+        """
+        value, codec = self.read_frame()
+        return value
+
+    def read_frame(self):
+        """
+        Wait for a message from the remote side.
 
         The basic communication protocol is really simple:
 
         1. First an ASCII encoded integer number is received, terminated by a
-           newline.
-        2. Second the number of bytes given by step 1 is read and interpreted
-           as a JSON encoded value. This step is not terminated by a newline.
+           newline. The number may be followed by a space and the name of the
+           codec that was used to encode the message (see
+           :mod:`negotiator_common.serialization`) and the sizes of any
+           binary attachments (all separated by spaces).
+        2. Second the number of bytes given by step 1 is read and decoded using
+           the given codec (JSON when no codec was given). This step is not
+           terminated by a newline.
+        3. Finally the attachments are read (one after another, without any
+           separators) and put in place of their placeholders in the message.
 
         That's it :-).
 
-        :returns: The JSON value decoded to a Python value.
+        :returns: A tuple with two values:
+
+                  1. The message decoded to a Python value.
+                  2. The name of the codec used by the remote side (a string)
+                     or :data:`None` when the remote side didn't name a codec
+                     (because it doesn't support codec negotiation).
         :raises: :exc:`ProtocolError` when the remote side violates the
                  defined protocol.
         """
         logger.debug("Waiting for message from other side ..")
         # Wait for a line containing an integer byte count.
-        line = self.raw_readline().strip()
-        if not line.isdigit():
-            # Complain loudly about protocol errors :-).
-            raise ProtocolError(compact("""
-                Received invalid input from remote side! I was expecting a
-                byte count, but what I got instead was the line {input}!
-            """, input=repr(line)))
-        else:
-            # First we get a line containing a byte count, then we read
-            # that number of bytes from the remote side and decode it as a
-            # JSON encoded message.
-            num_bytes = int(line, 10)
-            logger.debug("Reading message of %i bytes ..", num_bytes)
-            encoded_value = self.raw_read(num_bytes)
-            try:
-                decoded_value = json.loads(encoded_value)
-                logger.debug("Parsed message: %s", decoded_value)
-                return decoded_value
-            except Exception as e:
-                logger.exception("Failed to parse JSON formatted message!")
-                raise ProtocolError(compact("""
-                    Failed to decode message from remote side as JSON!
-                    Tried to decode message {message}. Original error:
-                    {error}.
-                """, message=repr(encoded_value), error=str(e)))
-
-    def write(self, value):
+        num_bytes, codec_name, attachment_sizes = parse_header(self.raw_readline())
+        # First we get a line containing a byte count, then we read
+        # that number of bytes from the remote side and decode it.
+        encoded_value = self.raw_read(num_bytes)
+        attachments = [self.raw_read(n) for n in attachment_sizes]
+        return decode_message(encoded_value, codec_name, attachments), codec_name
+
+    def write(self, value, codec=None):
         """
         Send a Python value to the other side.
 
-        :param value: Any Python value that can be encoded as JSON.
+        :param value: Any Python value that can be encoded using the codec.
+        :param codec: The name of the codec used to encode the message (a
+                      string) or :data:`None` to send a plain JSON message
+                      that older versions of `negotiator` understand.
+
+        When a codec is given, binary strings embedded in the value are sent
+        as attachments (see :func:`read_frame()`) instead of being encoded.
         """
-        encoded_message = json.dumps(value)
+        attachments = []
+        if codec:
+            value = extract_attachments(value, attachments)
+        encoded_message = AVAILABLE_CODECS[codec or JSONCodec.name].encode(value)
         num_bytes = len(encoded_message)
-        logger.debug("Sending message of %i bytes: %s", num_bytes, encoded_message)
-        self.raw_write("%i\n%s" % (num_bytes, encoded_message))
+        header = ' '.join(["%i" % num_bytes] + ([codec] if codec else []) + ["%i" % len(a) for a in attachments])
+        logger.debug("Sending message of %i bytes (with %i attachments): %r",
+                     num_bytes, len(attachments), encoded_message)
+        # The lock makes sure that messages written by concurrent callers
+        # don't get interleaved on the channel.
+        with self.write_lock:
+            self.raw_write(header.encode('ascii') + b'\n' + encoded_message)
+            for data in attachments:
+                self.raw_write(data)
 
     def call_remote_method(self, method, *args, **kw):
         """
@@ -167,32 +228,240 @@ class NegotiatorInterface(object):
         :param args: The positional arguments for the method.
         :param kw: The keyword arguments for the method.
         :returns: The return value of the remote method.
+        :raises: :exc:`RemoteMethodFailed` when the remote method call fails.
+
+        This method is thread safe: Multiple threads can call remote methods
+        over the same channel at the same time, responses are matched to their
+        callers based on request IDs (see :func:`start_remote_call()`).
         """
-        timer = Timer()
-        logger.debug("Calling remote method %s ..", format_call(method, *args, **kw))
-        self.write(dict(method=method, args=args, kw=kw))
-        response = self.read()
-        if response['success']:
-            logger.debug("Remote method call succeeded in %s and returned %r!", timer, response['result'])
-            return response['result']
+        return self.start_remote_call(method, *args, **kw).wait()
+
+    def call_remote_batch(self, calls, parallel=False):
+        """
+        Call several methods on the remote object in a single round trip.
+
+        :param calls: An iterable of tuples with the name of a method (a
+                      string) and optionally a list of positional arguments
+                      and a dictionary of keyword arguments.
+        :param parallel: :data:`True` to have the remote side run the calls
+                         at the same time (see :func:`call_batch()`),
+                         :data:`False` to run them one after another.
+        :returns: A list of :class:`RemoteCall` objects whose responses have
+                  been received, in the order of `calls`.
+
+        A failing call doesn't affect the other calls in the batch, the error
+        is raised when :func:`RemoteCall.get_result()` is called:
+
+        .. code-block:: python
+
+           calls = channel.call_remote_batch([
+               ('execute', ['find-ip-addresses']),
+               ('execute', ['find-disk-usage']),
+               ('execute', ['find-distributor-id']),
+           ], parallel=True)
+           facts = [call.get_result() for call in calls]
+
+        When the remote side doesn't support batch calls the calls are sent
+        separately (pipelined, see :func:`start_remote_call()`).
+        """
+        members = [RemoteCall(self, None, c[0], tuple(c[1]) if len(c) > 1 else (), c[2] if len(c) > 2 else {})
+                   for c in calls]
+        if self.batch_supported:
+            try:
+                responses = self.call_remote_method('call_batch', [
+                    dict(method=m.method, args=m.args, kw=m.kw) for m in members
+                ], parallel=parallel)
+            except RemoteMethodUnsupported:
+                logger.debug("Remote side doesn't support batch calls, falling back to separate calls.")
+                self.batch_supported = False
+            else:
+                for member, response in zip(members, responses):
+                    member.response = response
+                    member.cached = response.get('cached', False)
+                return members
+        members = [self.start_remote_call(m.method, *m.args, **m.kw) for m in members]
+        for member in members:
+            self.wait_for_response(member)
+        return members
+
+    def start_remote_call(self, method, *args, **kw):
+        """
+        Send a remote method call without waiting for the response.
+
+        :param method: The name of the method to call (a string).
+        :param args: The positional arguments for the method.
+        :param kw: The keyword arguments for the method.
+        :returns: A :class:`RemoteCall` object.
+
+        Every request is tagged with a unique request ID which the remote side
+        includes in its response, this enables any number of calls to be in
+        flight on a single channel at the same time (pipelining):
+
+        .. code-block:: python
+
+           calls = [channel.start_remote_call('execute', name) for name in names]
+           results = [call.wait() for call in calls]
+
+        Remote sides that predate request IDs answer requests in the order
+        they were received, in this case responses without a request ID are
+        matched to the oldest pending call.
+        """
+        if not self.codec_negotiated:
+            self.negotiate_codec()
+        return self.send_remote_call(method, *args, **kw)
+
+    def send_remote_call(self, method, *args, **kw):
+        """
+        Send a remote method call using the current codec (see :func:`start_remote_call()`).
+
+        :param method: The name of the method to call (a string).
+        :param args: The positional arguments for the method.
+        :param kw: The keyword arguments for the method.
+        :returns: A :class:`RemoteCall` object.
+        """
+        call = RemoteCall(self, next(self.request_ids), method, args, kw)
+        logger.debug("Calling remote method %s (request #%i) ..", format_call(method, *args, **kw), call.request_id)
+        with self.read_condition:
+            self.pending_calls[call.request_id] = call
+        self.write(dict(id=call.request_id, method=method, args=args, kw=kw), codec=self.codec)
+        return call
+
+    def negotiate_codec(self):
+        """
+        Agree with the remote side on the codec used to encode messages.
+
+        The codecs in :attr:`preferred_codecs` that are available locally are
+        offered to the remote side (using a plain JSON message) which picks the
+        first codec that it supports (see :func:`select_codec()`). When the
+        remote side doesn't support codec negotiation we keep sending plain
+        JSON messages.
+        """
+        with self.negotiate_lock:
+            if not self.codec_negotiated:
+                offered_codecs = [name for name in self.preferred_codecs if name in AVAILABLE_CODECS]
+                call = self.send_remote_call('select_codec', offered_codecs)
+                # We don't use call.wait() here because it logs a warning when
+                # the call fails, which is expected for older remote sides.
+                self.wait_for_response(call)
+                selected_codec = call.response.get('result')
+                if not call.response['success']:
+                    logger.debug("Remote side doesn't support codec negotiation, using JSON.")
+                elif selected_codec in AVAILABLE_CODECS:
+                    logger.debug("Remote side selected %s codec.", selected_codec)
+                    self.codec = selected_codec
+                else:
+                    logger.warning("Remote side selected unsupported codec %r, using JSON.", selected_codec)
+                self.codec_negotiated = True
+
+    def select_codec(self, codecs):
+        """
+        Select the codec to use for the messages sent by the remote side.
+
+        :param codecs: A list of codec names (strings) in order of preference.
+        :returns: The name of the first codec that is also available locally
+                  (a string), defaults to ``json``.
+
+        The codec of each message is given in the message header and responses
+        are encoded using the codec of the request, so no state needs to be
+        kept on this side of the channel.
+        """
+        for name in codecs:
+            if name in AVAILABLE_CODECS:
+                return name
+        return JSONCodec.name
+
+    def wait_for_response(self, call, partial=False):
+        """
+        Wait for the response to a remote method call.
+
+        :param call: A :class:`RemoteCall` object.
+        :param partial: :data:`True` to return as soon as a partial result
+                        is available (see :func:`RemoteCall.stream()`).
+
+        Only one thread reads from the channel at any given time, the responses
+        it reads are handed to the calls they belong to (which may belong to
+        other threads) until the response to the given call has arrived.
+        """
+        with self.read_condition:
+            while call.response is None and not (partial and call.partial_results):
+                if self.read_in_progress:
+                    # Another thread is reading from the channel, wait for it
+                    # to hand us our response (or to hand over the channel).
+                    self.read_condition.wait()
+                else:
+                    self.read_in_progress = True
+                    try:
+                        self.read_condition.release()
+                        try:
+                            response = self.read()
+                        finally:
+                            self.read_condition.acquire()
+                        self.dispatch_response(response)
+                    finally:
+                        self.read_in_progress = False
+                        self.read_condition.notify_all()
+
+    def dispatch_response(self, response):
+        """
+        Hand a response from the remote side to the call it belongs to.
+
+        :param response: The decoded response (a dictionary).
+
+        This method is called by :func:`wait_for_response()` while it holds
+        the lock that protects the pending calls.
+        """
+        request_id = response.get('id')
+        if response.get('partial') and request_id in self.pending_calls:
+            # Partial results of streaming methods are queued until the
+            # caller gets around to them, the call stays pending.
+            call = self.pending_calls[request_id]
+            call.partial_results.append(response['result'])
+            call.cached = call.cached or response.get('cached', False)
+            return
+        elif request_id in self.pending_calls:
+            call = self.pending_calls.pop(request_id)
+        elif request_id is None and self.pending_calls:
+            # Old peers answer our requests in order without echoing the ID.
+            call = self.pending_calls.popitem(last=False)[1]
         else:
-            logger.warning("Remote method call failed after %s: %s", timer, response['error'])
-            raise RemoteMethodFailed(response['error'])
+            logger.warning("Ignoring response to unknown request #%s!", request_id)
+            return
+        call.response = response
+        call.cached = call.cached or response.get('cached', False)
 
-    def enter_main_loop(self):
+    def enter_main_loop(self, concurrency=DEFAULT_CONCURRENCY, queue_size=None):
         """
         Wait for requests from the other side.
 
+        :param concurrency: The number of requests to handle at the same time
+                            (an integer, defaults to :data:`.DEFAULT_CONCURRENCY`).
+        :param queue_size: The maximum number of requests waiting for a worker
+                           thread (an integer, defaults to twice the value of
+                           `concurrency`). When the queue is full no new
+                           requests are read until a worker becomes available.
+
+        When `concurrency` is greater than one, requests are handled by a pool
+        of worker threads so that one slow method call doesn't block other
+        requests. Responses are then sent in the order in which they complete,
+        which is why requests without a request ID (from remote sides that
+        expect responses in order) are always handled in the main loop. No
+        more than `concurrency` streaming responses (for commands without an
+        input stream) are sent at the same time (see :func:`process_request()`).
+
         The communication protocol for remote procedure calls is as follows:
 
-        - Every request is a dictionary containing at least a ``command`` key
+        - Every request is a dictionary containing at least a ``method`` key
           with a string value (the name of the method to invoke).
 
-        - The value of the optional ``arguments`` key gives a list of
-          positional arguments to pass to the method.
+        - The value of the optional ``args`` key gives a list of positional
+          arguments to pass to the method.
+
+        - The value of the optional ``kw`` key gives a dictionary of keyword
+          arguments to pass to the method.
 
-        - The value of the optional ``keyword-arguments`` key gives a
-          dictionary of keyword arguments to pass to the method.
+        - The value of the optional ``id`` key is a request ID that is included
+          in the response, this enables the remote side to have multiple
+          requests in flight at the same time.
 
         Responses are structured as follows:
 
@@ -208,65 +477,451 @@ class NegotiatorInterface(object):
         :raises: :exc:`ProtocolError` when the remote side violates the
                  defined protocol.
         """
-        while True:
-            request = self.read()
-            method_name = request.get('method')
-            method = getattr(self, method_name, None)
-            args = request.get('args', [])
-            kw = request.get('kw', {})
-            if method and not method_name.startswith('_'):
-                try:
-                    logger.info("Remote is calling local method %s ..", format_call(method_name, *args, **kw))
-                    result = method(*args, **kw)
-                    logger.info("Local method call was successful and returned result %r.", result)
-                    self.write(dict(success=True, result=result))
-                except Exception as e:
-                    logger.exception("Swallowing unexpected exception during local method call so we don't crash!")
-                    self.write(dict(success=False, error=str(e)))
+        pool = WorkerPool(concurrency, queue_size) if concurrency > 1 else None
+        self.streaming_slots = threading.Semaphore(concurrency)
+        try:
+            while True:
+                request, codec = self.read_frame()
+                if pool and 'id' in request:
+                    pool.submit(self.process_request, request, codec)
+                else:
+                    self.process_request(request, codec)
+        finally:
+            if pool:
+                pool.shutdown()
+
+    def process_request(self, request, codec=None):
+        """
+        Handle a request from the remote side and send the response.
+
+        :param request: The decoded request (a dictionary).
+        :param codec: The name of the codec used to encode the request (a
+                      string or :data:`None`), the response is encoded using
+                      the same codec.
+        """
+        timer = Timer()
+        response = self.handle_request(request)
+        if response['success'] and isinstance(response['result'], types.GeneratorType):
+            if 'id' in request:
+                # Streaming responses are sent from a separate thread so that
+                # we can keep handling requests, for example input for the
+                # command whose output is being streamed. Commands without
+                # input don't depend on the requests that follow, so the
+                # number of threads streaming their output is limited by
+                # waiting for a slot (this stops new requests from being
+                # handled until a streaming response finishes).
+                limited = not request.get('kw', {}).get('input_stream')
+                if limited:
+                    self.streaming_slots.acquire()
+                thread = threading.Thread(target=self.stream_response_in_thread,
+                                          args=(request, response, codec, limited))
+                thread.daemon = True
+                thread.start()
             else:
-                logger.warning("Remote tried to call unsupported method %s!", method_name)
-                self.write(dict(success=False, error="Method %s not supported" % method_name))
+                self.stream_response(request, response, codec)
+            return
+        try:
+            self.write(response, codec=codec)
+        except (TypeError, ValueError) as e:
+            # The message is encoded before anything is written, so we can
+            # still report the problem to the remote side.
+            logger.exception("Failed to encode response to remote side!")
+            self.write(dict(success=False, error="Failed to encode response: %s" % e, id=request.get('id')),
+                       codec=codec)
+        logger.debug("Responded to request for method %s in %s.", request.get('method'), timer)
+
+    def stream_response_in_thread(self, request, response, codec, limited):
+        """
+        Send a streaming response from a separate thread (see :func:`process_request()`).
+
+        :param request: The decoded request (a dictionary).
+        :param response: The response whose result is a generator (a dictionary).
+        :param codec: The name of the codec used to encode the request (a
+                      string or :data:`None`).
+        :param limited: :data:`True` when the thread holds one of the
+                        streaming slots, :data:`False` otherwise.
+        """
+        try:
+            self.stream_response(request, response, codec)
+        finally:
+            if limited:
+                self.streaming_slots.release()
 
-    def list_commands(self):
+    def stream_response(self, request, response, codec=None):
+        """
+        Send the values produced by a streaming method to the remote side.
+
+        :param request: The decoded request (a dictionary).
+        :param response: The response whose result is a generator (a dictionary).
+        :param codec: The name of the codec used to encode the request (a
+                      string or :data:`None`).
+
+        Every value produced by the generator is sent as a partial response
+        (with ``partial=True``) as soon as it is available, followed by a
+        final response with the result :data:`None`. Because remote sides
+        that don't send request IDs can't handle partial responses, they
+        receive a single response with all values in a list.
+        """
+        generator = response['result']
+        try:
+            if 'id' in request:
+                for value in generator:
+                    partial = dict(id=request['id'], success=True, partial=True, result=value)
+                    if response.get('cached'):
+                        partial['cached'] = True
+                    self.write(partial, codec=codec)
+                response['result'] = None
+            else:
+                response['result'] = list(generator)
+        except Exception as e:
+            logger.exception("Swallowing unexpected exception during streaming method call so we don't crash!")
+            response = dict(success=False, error=str(e), id=request.get('id'))
+        finally:
+            generator.close()
+        self.write(response, codec=codec)
+
+    def handle_request(self, request):
         """
-        Find the names of the user defined commands.
+        Invoke a local method on behalf of the remote side.
 
-        :returns: A list of executable names (strings).
+        :param request: The decoded request (a dictionary).
+        :returns: The response to send to the remote side (a dictionary).
         """
-        commands = set()
-        for directory in (BUILTIN_COMMANDS_DIRECTORY, USER_COMMANDS_DIRECTORY):
-            if os.path.isdir(directory):
-                for entry in os.listdir(directory):
-                    pathname = os.path.join(directory, entry)
-                    if os.path.isfile(pathname) and os.access(pathname, os.X_OK):
-                        commands.add(entry)
-        return list(commands)
+        method_name = request.get('method')
+        method = getattr(self, method_name, None) if method_name in self.exported_methods else None
+        args = request.get('args', [])
+        kw = request.get('kw', {})
+        if method:
+            try:
+                logger.info("Remote is calling local method %s ..", format_call(method_name, *args, **kw))
+                result = method(*args, **kw)
+                logger.info("Local method call was successful and returned result %r.", result)
+                if isinstance(result, CachedResult):
+                    # Tell the remote side that the result came from a cache.
+                    response = dict(success=True, result=result.value, cached=True)
+                else:
+                    response = dict(success=True, result=result)
+            except Exception as e:
+                logger.exception("Swallowing unexpected exception during local method call so we don't crash!")
+                response = dict(success=False, error=str(e))
+        else:
+            logger.warning("Remote tried to call unsupported method %s!", method_name)
+            response = dict(success=False, error="Method %s not supported" % method_name)
+        if 'id' in request:
+            response['id'] = request['id']
+        return response
 
-    def prepare_environment(self):
+    def call_batch(self, requests, parallel=False):
+        """
+        Invoke several local methods on behalf of the remote side (see :func:`call_remote_batch()`).
+
+        :param requests: A list of requests (dictionaries with the keys
+                         ``method``, ``args`` and ``kw``).
+        :param parallel: :data:`True` to handle the requests at the same time
+                         (using up to :data:`.MAX_BATCH_CONCURRENCY` worker
+                         threads), :data:`False` to handle them one after
+                         another.
+        :returns: A list of responses (dictionaries with the keys ``success``
+                  and ``result`` or ``error``) in the order of `requests`.
         """
-        Prepare environment variables for command execution.
+        responses = [None] * len(requests)
+        if parallel and len(requests) > 1:
+            pool = WorkerPool(min(len(requests), MAX_BATCH_CONCURRENCY))
+            try:
+                for index, request in enumerate(requests):
+                    pool.submit(self.handle_batch_request, request, responses, index)
+            finally:
+                pool.shutdown()
+        else:
+            for index, request in enumerate(requests):
+                self.handle_batch_request(request, responses, index)
+        return responses
 
-        This method can be overridden by sub classes to prepare environment
-        variables for external command execution.
+    def handle_batch_request(self, request, responses, index):
         """
+        Handle one of the requests in a batch (see :func:`call_batch()`).
 
-    def execute(self, *command, **options):
+        :param request: The request (a dictionary).
+        :param responses: The list of responses to the batch.
+        :param index: The index of the request in the batch (an integer).
         """
-        Execute a user defined or built-in command.
+        response = self.handle_request(dict(method=request.get('method'),
+                                            args=request.get('args', []),
+                                            kw=request.get('kw', {})))
+        if response['success'] and isinstance(response['result'], types.GeneratorType):
+            # The results of streaming methods are collected in a list,
+            # because a batch is answered by a single response.
+            try:
+                response['result'] = list(response['result'])
+            except Exception as e:
+                logger.exception("Swallowing unexpected exception during streaming method call so we don't crash!")
+                response = dict(success=False, error=str(e))
+        responses[index] = response
 
-        :param command: The command name and any arguments (one or more strings).
-        :param input: The input to feed to the command on its standard input
-                      stream (a string or ``None``).
-        :returns: The output of the command (a string) or ``None`` if the
-                  command exited with a nonzero exit code.
+    def execute_remote_command(self, command, input=None, stdout=None, stderr=None):
         """
-        self.prepare_environment()
-        command_name = os.path.basename(command[0])
-        user_command = os.path.join(USER_COMMANDS_DIRECTORY, command_name)
-        builtin_command = os.path.join(BUILTIN_COMMANDS_DIRECTORY, command_name)
-        command = list(command)
-        command[0] = user_command if os.path.isfile(user_command) else builtin_command
-        return execute(*command, input=options.get('input', None), capture=True, logger=logger)
+        Execute a command on the remote side and copy its output as it arrives.
+
+        :param command: The command name and any arguments (a list of strings).
+        :param input: A binary file like object whose contents are streamed to
+                      the standard input of the remote command (optional).
+        :param stdout: A binary file like object to which the standard output
+                       of the remote command is written (defaults to the
+                       standard output stream of the current process).
+        :param stderr: A binary file like object to which the standard error
+                       output of the remote command is written (defaults to
+                       the standard error stream of the current process).
+        :returns: The exit code of the remote command (an integer).
+        :raises: :exc:`RemoteMethodFailed` when the remote method call fails.
+
+        This uses :func:`~negotiator_common.execution.CommandExecutionMixin.execute_streaming()`
+        on the remote side. When the remote side doesn't support streaming,
+        :func:`~negotiator_common.execution.CommandExecutionMixin.execute()`
+        is used instead (so the output arrives all at once and the input
+        needs to be UTF-8 encoded text, otherwise :exc:`~exceptions.ValueError`
+        is raised).
+        """
+        stdout = stdout or getattr(sys.stdout, 'buffer', sys.stdout)
+        stderr = stderr or getattr(sys.stderr, 'buffer', sys.stderr)
+        streams = dict(stdout=stdout, stderr=stderr, returncode=None)
+        sender = None
+        try:
+            if input is None:
+                call = self.start_remote_call('execute_streaming', *command)
+            else:
+                import uuid
+                call = self.start_remote_call('execute_streaming', *command, input_stream=str(uuid.uuid4()))
+                sender = self.stream_input(call, input)
+            for chunk in call.stream():
+                copy_output(chunk, streams)
+            if sender:
+                sender.join()
+                if sender.error:
+                    raise sender.error
+            if call.cached:
+                logger.debug("Output of remote command %s was cached by the remote side.", command[0])
+        except RemoteMethodUnsupported:
+            data = input.read() if input is not None else None
+            if isinstance(data, bytes):
+                # Remote sides without streaming encode messages as JSON,
+                # which can't represent byte strings.
+                try:
+                    data = data.decode('utf-8')
+                except UnicodeDecodeError:
+                    raise ValueError("The remote side doesn't support binary input"
+                                     " (the input of %s isn't valid UTF-8)!" % command[0])
+            output = self.call_remote_method('execute', *command, capture=True, input=data)
+            stdout.write((output.rstrip() + '\n').encode('utf-8'))
+            stdout.flush()
+        return streams['returncode'] or 0
+
+    def stream_input(self, call, input):
+        """
+        Stream input to a remote command started by :func:`execute_remote_command()`.
+
+        :param call: The :class:`RemoteCall` of
+                     :func:`~negotiator_common.execution.CommandExecutionMixin.execute_streaming()`.
+        :param input: A binary file like object.
+        :returns: The :class:`threading.Thread` that sends the input, or
+                  :data:`None` when the remote side didn't confirm that the
+                  command has started. If sending the input fails for a
+                  reason other than the command exiting, the exception is
+                  available as the ``error`` attribute of the thread.
+
+        The input is sent in chunks of :data:`.STREAM_CHUNK_SIZE` bytes. To
+        keep memory usage constant on both sides no more than
+        :data:`.MAX_INPUT_CHUNKS_IN_FLIGHT` chunks are sent before the remote
+        side acknowledges that the command has consumed them. The input is
+        sent from a separate thread so that the caller can keep reading the
+        output of the command in the mean time, otherwise both sides could
+        end up waiting for each other to read what they've written.
+        """
+        # Wait for the remote side to confirm that the command has started, if
+        # it doesn't we leave it to the caller to report the error (without
+        # having consumed any input).
+        self.wait_for_response(call, partial=True)
+        if call.partial_results:
+            call.partial_results.popleft()
+        else:
+            return None
+        sender = threading.Thread(target=self.send_input, args=(call.kw['input_stream'], input))
+        sender.daemon = True
+        sender.error = None
+        sender.start()
+        return sender
+
+    def send_input(self, input_stream, input):
+        """
+        Send input to a remote command (used by :func:`stream_input()`).
+
+        :param input_stream: The identifier of the input stream (a string).
+        :param input: A binary file like object.
+        """
+        in_flight = collections.deque()
+        try:
+            offset = 0
+            for chunk in iter(functools.partial(input.read, STREAM_CHUNK_SIZE), b''):
+                in_flight.append(self.start_remote_call('write_input', input_stream, offset, binary(chunk)))
+                offset += len(chunk)
+                while in_flight and (len(in_flight) >= MAX_INPUT_CHUNKS_IN_FLIGHT or in_flight[0].done):
+                    in_flight.popleft().wait()
+            while in_flight:
+                in_flight.popleft().wait()
+            self.call_remote_method('close_input', input_stream)
+        except RemoteMethodFailed as e:
+            # The command may exit before consuming all of its input.
+            logger.warning("Stopped sending input to remote command: %s", e)
+        except Exception as e:
+            threading.current_thread().error = e
+
+
+def parse_header(line):
+    """
+    Parse the header line of a message (see :func:`NegotiatorInterface.read_frame()`).
+
+    :param line: The header line (a byte string).
+    :returns: A tuple with three values:
+
+              1. The size of the encoded message in bytes (an integer).
+              2. The name of the codec (a string) or :data:`None`.
+              3. A list with the sizes of the attachments (integers).
+    :raises: :exc:`ProtocolError` when the header line is invalid or names a
+             codec that isn't available.
+    """
+    tokens = line.split()
+    if not (tokens and tokens[0].isdigit() and all(t.isdigit() for t in tokens[2:])):
+        # Complain loudly about protocol errors :-).
+        from humanfriendly import compact
+        raise ProtocolError(compact("""
+            Received invalid input from remote side! I was expecting a
+            byte count, but what I got instead was the line {input}!
+        """, input=repr(line.strip())))
+    num_bytes = int(tokens[0], 10)
+    codec_name = tokens[1].decode('ascii') if len(tokens) > 1 else None
+    if (codec_name or JSONCodec.name) not in AVAILABLE_CODECS:
+        raise ProtocolError("Remote side used unsupported codec %r!" % codec_name)
+    logger.debug("Reading message of %i bytes (encoded using %s) ..", num_bytes, codec_name or JSONCodec.name)
+    return num_bytes, codec_name, [int(t, 10) for t in tokens[2:]]
+
+
+def decode_message(encoded_value, codec_name, attachments):
+    """
+    Decode a message received from the remote side.
+
+    :param encoded_value: The encoded message (a byte string).
+    :param codec_name: The name of the codec (a string) or :data:`None`.
+    :param attachments: A list of byte strings.
+    :returns: The message decoded to a Python value.
+    :raises: :exc:`ProtocolError` when the message can't be decoded.
+    """
+    codec = AVAILABLE_CODECS[codec_name or JSONCodec.name]
+    try:
+        decoded_value = codec.decode(encoded_value)
+        if codec_name:
+            decoded_value = restore_attachments(decoded_value, attachments)
+        logger.debug("Parsed message: %s", decoded_value)
+        return decoded_value
+    except Exception as e:
+        logger.exception("Failed to parse %s encoded message!", codec.name)
+        from humanfriendly import compact
+        raise ProtocolError(compact("""
+            Failed to decode message from remote side as {codec}!
+            Tried to decode message {message}. Original error:
+            {error}.
+        """, codec=codec.name, message=repr(encoded_value), error=str(e)))
+
+
+def copy_output(chunk, streams):
+    """
+    Copy a chunk of output produced by a remote command.
+
+    :param chunk: A dictionary produced by
+                  :func:`~negotiator_common.execution.CommandExecutionMixin.execute_streaming()`.
+    :param streams: A dictionary with the keys ``stdout`` and ``stderr`` whose
+                    values are binary file like objects. The ``returncode``
+                    key is set when the exit code of the command arrives.
+    """
+    for name in ('stdout', 'stderr'):
+        if name in chunk:
+            streams[name].write(chunk[name])
+            streams[name].flush()
+    if 'returncode' in chunk:
+        streams['returncode'] = chunk['returncode']
+
+
+class RemoteCall(object):
+
+    """A remote method call that may still be in flight (see :func:`NegotiatorInterface.start_remote_call()`)."""
+
+    def __init__(self, interface, request_id, method, args, kw):
+        """
+        Initialize a :class:`RemoteCall` object.
+
+        :param interface: The :class:`NegotiatorInterface` that sent the call.
+        :param request_id: The request ID of the call (an integer).
+        :param method: The name of the remote method (a string).
+        :param args: The positional arguments for the method.
+        :param kw: The keyword arguments for the method.
+        """
+        self.interface = interface
+        self.request_id = request_id
+        self.method = method
+        self.args = args
+        self.kw = kw
+        self.response = None
+        self.partial_results = collections.deque()
+        self.timer = Timer()
+        # Whether the remote side answered from its result cache.
+        self.cached = False
+
+    @property
+    def done(self):
+        """:data:`True` when the response has been received, :data:`False` otherwise."""
+        return self.response is not None
+
+    def wait(self):
+        """
+        Wait for the response to the remote method call.
+
+        :returns: The return value of the remote method.
+        :raises: :exc:`RemoteMethodFailed` when the remote method call fails.
+        """
+        self.interface.wait_for_response(self)
+        return self.get_result()
+
+    def stream(self):
+        """
+        Get the partial results of a streaming remote method as they arrive.
+
+        :returns: A generator of the values produced by the remote method.
+        :raises: :exc:`RemoteMethodFailed` when the remote method call fails.
+        """
+        while True:
+            while self.partial_results:
+                yield self.partial_results.popleft()
+            if self.done:
+                break
+            self.interface.wait_for_response(self, partial=True)
+        self.get_result()
+
+    def get_result(self):
+        """
+        Get the result of the remote method call after the response has been received.
+
+        :returns: The return value of the remote method.
+        :raises: :exc:`RemoteMethodUnsupported` when the remote side doesn't
+                 support the method, :exc:`RemoteMethodFailed` when the
+                 remote method call fails for other reasons.
+        """
+        if self.response['success']:
+            logger.debug("Remote method call succeeded in %s and returned %r!", self.timer, self.response['result'])
+            return self.response['result']
+        elif self.response['error'] == "Method %s not supported" % self.method:
+            logger.debug("Remote side doesn't support method %s.", self.method)
+            raise RemoteMethodUnsupported(self.response['error'])
+        else:
+            logger.warning("Remote method call failed after %s: %s", self.timer, self.response['error'])
+            raise RemoteMethodFailed(self.response['error'])
 
 
 class ProtocolError(Exception):
@@ -277,3 +932,8 @@ class ProtocolError(Exception):
 class RemoteMethodFailed(Exception):
 
     """Exception that is raised when a remote method call failed."""
+
+
+class RemoteMethodUnsupported(RemoteMethodFailed):
+
+    """Exception that is raised when the remote side doesn't support a method."""
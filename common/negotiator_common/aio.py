@@ -0,0 +1,549 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""
+:mod:`asyncio` implementation of the negotiator protocol.
+
+The :class:`AsyncNegotiatorInterface` class speaks the same protocol as
+:class:`~negotiator_common.NegotiatorInterface` (including codec negotiation,
+attachments, pipelining, streaming and batch calls) but it's built on
+:mod:`asyncio` streams instead of blocking file objects. This enables a single
+event loop to talk to hundreds of guests at the same time:
+
+.. code-block:: python
+
+   import asyncio
+   from negotiator_common.aio import AsyncNegotiatorInterface
+
+   async def list_commands(unix_socket):
+       channel = await AsyncNegotiatorInterface.connect(unix_socket)
+       try:
+           return await channel.call_remote_method('list_commands', timeout=5)
+       finally:
+           await channel.close()
+
+   async def main(sockets):
+       return await asyncio.gather(*map(list_commands, sockets), return_exceptions=True)
+
+Timeouts are enforced per call (using :func:`asyncio.wait_for()`) instead of
+using ``SIGALRM`` (see :class:`~negotiator_common.utils.TimeOut`), so they
+work outside of the main thread and don't affect other calls.
+
+This module requires Python 3.6 or newer.
+"""
+
+# Standard library modules.
+import asyncio
+import functools
+import inspect
+import itertools
+import logging
+
+# Modules included in our project.
+from negotiator_common import (
+    NegotiatorInterface,
+    ProtocolError,
+    RemoteCall,
+    RemoteMethodUnsupported,
+    decode_message,
+    parse_header,
+)
+from negotiator_common.config import DEFAULT_TIMEOUT, PREFERRED_CODECS, RESULT_CACHE_SIZE
+from negotiator_common.execution import CachedResult, CommandExecutionMixin
+from negotiator_common.serialization import AVAILABLE_CODECS, JSONCodec, extract_attachments
+from negotiator_common.utils import ResultCache, format_call
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+
+class AsyncNegotiatorInterface(CommandExecutionMixin):
+
+    """
+    Common logic shared between the host and guest, built on :mod:`asyncio`.
+
+    Local methods that can be called by the remote side are defined on sub
+    classes (and named in :attr:`exported_methods`), they can be regular
+    methods (which are run in the default executor of the event loop, so they
+    don't block the event loop) or coroutine functions (which are awaited in
+    the event loop). The commands of
+    :class:`~negotiator_common.execution.CommandExecutionMixin` (for example
+    :func:`execute()` and :func:`list_commands()`) are available as well.
+    """
+
+    exported_methods = ('select_codec', 'call_batch') + CommandExecutionMixin.exported_methods
+    """The names of the methods that the remote side is allowed to call (a tuple of strings)."""
+
+    preferred_codecs = PREFERRED_CODECS
+    """The codecs offered to the remote side in order of preference (see :func:`negotiate_codec()`)."""
+
+    # Built-in method shared with the blocking implementation.
+    select_codec = NegotiatorInterface.select_codec
+
+    def __init__(self, reader, writer, label, timeout=DEFAULT_TIMEOUT):
+        """
+        Initialize an :class:`AsyncNegotiatorInterface` object.
+
+        :param reader: An :class:`asyncio.StreamReader` object.
+        :param writer: An :class:`asyncio.StreamWriter` object.
+        :param label: A string that describes the channel (used in log messages).
+        :param timeout: The default number of seconds to wait for the response
+                        to a remote method call (a number, defaults to
+                        :data:`.DEFAULT_TIMEOUT`, zero disables the timeout).
+        """
+        self.reader = reader
+        self.writer = writer
+        self.conn_label = label
+        self.timeout = timeout
+        # State used to multiplex concurrent remote method calls.
+        self.request_ids = itertools.count(1)
+        self.pending_calls = {}
+        self.receiving = False
+        self.receiver = None
+        self.write_lock = asyncio.Lock()
+        # The codec used to encode the messages we send (see negotiate_codec()).
+        self.codec = None
+        self.codec_negotiated = False
+        self.negotiate_lock = asyncio.Lock()
+        # Whether the remote side supports batch calls (see call_remote_batch()).
+        self.batch_supported = True
+        # The standard input streams of commands started by execute_streaming().
+        self.input_streams = {}
+        # The output of cacheable commands (see find_cache_ttl()).
+        self.result_cache = ResultCache(RESULT_CACHE_SIZE)
+        # Requests that are being handled concurrently (see enter_main_loop()).
+        self.tasks = set()
+
+    @classmethod
+    async def connect(cls, unix_socket, **options):
+        """
+        Connect to a UNIX socket.
+
+        :param unix_socket: The absolute pathname of the UNIX socket (a string).
+        :param options: Any keyword arguments are passed on to the constructor.
+        :returns: An :class:`AsyncNegotiatorInterface` object.
+        """
+        logger.debug("Connecting to UNIX socket %s ..", unix_socket)
+        reader, writer = await asyncio.open_unix_connection(unix_socket)
+        return cls(reader, writer, label="UNIX socket %s" % unix_socket, **options)
+
+    async def close(self):
+        """Close the channel (pending remote method calls fail with :exc:`~negotiator_common.RemoteMethodFailed`)."""
+        self.writer.close()
+        if self.receiver:
+            self.receiver.cancel()
+            try:
+                await self.receiver
+            except asyncio.CancelledError:
+                pass
+        self.fail_pending_calls()
+
+    async def read_frame(self):
+        """
+        Wait for a message from the remote side.
+
+        :returns: A tuple with two values (see
+                  :func:`~negotiator_common.NegotiatorInterface.read_frame()`)
+                  or :data:`None` when the remote side closed the channel.
+        :raises: :exc:`~negotiator_common.ProtocolError` when the remote side
+                 violates the defined protocol.
+        """
+        line = await self.reader.readline()
+        if not line:
+            return None
+        num_bytes, codec_name, attachment_sizes = parse_header(line)
+        try:
+            encoded_value = await self.reader.readexactly(num_bytes)
+            attachments = [await self.reader.readexactly(n) for n in attachment_sizes]
+        except asyncio.IncompleteReadError:
+            raise ProtocolError("Remote side closed %s in the middle of a message!" % self.conn_label)
+        return decode_message(encoded_value, codec_name, attachments), codec_name
+
+    async def write(self, value, codec=None):
+        """
+        Send a Python value to the other side.
+
+        :param value: Any Python value that can be encoded using the codec.
+        :param codec: The name of the codec used to encode the message (a
+                      string) or :data:`None` to send a plain JSON message.
+        """
+        attachments = []
+        if codec:
+            value = extract_attachments(value, attachments)
+        encoded_message = AVAILABLE_CODECS[codec or JSONCodec.name].encode(value)
+        header = ' '.join(["%i" % len(encoded_message)] + ([codec] if codec else []) +
+                          ["%i" % len(a) for a in attachments])
+        logger.debug("Sending message of %i bytes (with %i attachments): %r",
+                     len(encoded_message), len(attachments), encoded_message)
+        # The message is written to the transport without yielding to the
+        # event loop, so messages can't get interleaved on the channel. The
+        # lock is needed because concurrent drain() calls aren't supported.
+        self.writer.write(header.encode('ascii') + b'\n' + encoded_message)
+        for data in attachments:
+            self.writer.write(data)
+        async with self.write_lock:
+            await self.writer.drain()
+
+    async def call_remote_method(self, method, *args, timeout=None, **kw):
+        """
+        Call a method on the remote object.
+
+        :param method: The name of the method to call (a string).
+        :param args: The positional arguments for the method.
+        :param timeout: The number of seconds to wait for the response (a
+                        number, defaults to :attr:`timeout`, zero disables
+                        the timeout). This keyword argument is not passed on
+                        to the remote method.
+        :param kw: The keyword arguments for the method.
+        :returns: The return value of the remote method.
+        :raises: :exc:`~negotiator_common.RemoteMethodFailed` when the remote
+                 method call fails, :exc:`asyncio.TimeoutError` when the
+                 timeout expires.
+        """
+        call = await self.start_remote_call(method, *args, **kw)
+        return await call.wait(timeout)
+
+    async def call_remote_batch(self, calls, parallel=False, timeout=None):
+        """
+        Call several methods on the remote object in a single round trip.
+
+        :param calls: An iterable of tuples with the name of a method (a
+                      string) and optionally a list of positional arguments
+                      and a dictionary of keyword arguments.
+        :param parallel: :data:`True` to have the remote side run the calls
+                         at the same time, :data:`False` to run them one
+                         after another.
+        :param timeout: The number of seconds to wait for the responses (a
+                        number, defaults to :attr:`timeout`).
+        :returns: A list of :class:`AsyncRemoteCall` objects whose responses
+                  have been received, in the order of `calls`.
+
+        Refer to :func:`~negotiator_common.NegotiatorInterface.call_remote_batch()`
+        for details.
+        """
+        members = [AsyncRemoteCall(self, None, c[0], tuple(c[1]) if len(c) > 1 else (), c[2] if len(c) > 2 else {})
+                   for c in calls]
+        if self.batch_supported:
+            try:
+                responses = await self.call_remote_method('call_batch', [
+                    dict(method=m.method, args=m.args, kw=m.kw) for m in members
+                ], parallel=parallel, timeout=timeout)
+            except RemoteMethodUnsupported:
+                logger.debug("Remote side doesn't support batch calls, falling back to separate calls.")
+                self.batch_supported = False
+            else:
+                for member, response in zip(members, responses):
+                    member.response = response
+                return members
+        members = [await self.start_remote_call(m.method, *m.args, **m.kw) for m in members]
+        await asyncio.wait_for(asyncio.gather(*(m.wait_for_response() for m in members)),
+                               self.get_timeout(timeout))
+        return members
+
+    async def start_remote_call(self, method, *args, **kw):
+        """
+        Send a remote method call without waiting for the response.
+
+        :param method: The name of the method to call (a string).
+        :param args: The positional arguments for the method.
+        :param kw: The keyword arguments for the method.
+        :returns: An :class:`AsyncRemoteCall` object.
+        """
+        if not self.codec_negotiated:
+            await self.negotiate_codec()
+        return await self.send_remote_call(method, *args, **kw)
+
+    async def send_remote_call(self, method, *args, **kw):
+        """
+        Send a remote method call using the current codec (see :func:`start_remote_call()`).
+
+        :param method: The name of the method to call (a string).
+        :param args: The positional arguments for the method.
+        :param kw: The keyword arguments for the method.
+        :returns: An :class:`AsyncRemoteCall` object.
+        """
+        call = AsyncRemoteCall(self, next(self.request_ids), method, args, kw)
+        logger.debug("Calling remote method %s (request #%i) ..", format_call(method, *args, **kw), call.request_id)
+        self.pending_calls[call.request_id] = call
+        self.start_receiving()
+        await self.write(dict(id=call.request_id, method=method, args=args, kw=kw), codec=self.codec)
+        return call
+
+    async def negotiate_codec(self):
+        """
+        Agree with the remote side on the codec used to encode messages.
+
+        Refer to :func:`~negotiator_common.NegotiatorInterface.negotiate_codec()`
+        for details.
+        """
+        async with self.negotiate_lock:
+            if not self.codec_negotiated:
+                offered_codecs = [name for name in self.preferred_codecs if name in AVAILABLE_CODECS]
+                call = await self.send_remote_call('select_codec', offered_codecs)
+                await asyncio.wait_for(call.wait_for_response(), self.get_timeout(None))
+                selected_codec = call.response.get('result')
+                if not call.response['success']:
+                    logger.debug("Remote side doesn't support codec negotiation, using JSON.")
+                elif selected_codec in AVAILABLE_CODECS:
+                    logger.debug("Remote side selected %s codec.", selected_codec)
+                    self.codec = selected_codec
+                else:
+                    logger.warning("Remote side selected unsupported codec %r, using JSON.", selected_codec)
+                self.codec_negotiated = True
+
+    def get_timeout(self, timeout):
+        """
+        Get the timeout for a remote method call.
+
+        :param timeout: The timeout given by the caller (a number or :data:`None`).
+        :returns: The number of seconds to wait (a number) or :data:`None`
+                  when the timeout is disabled.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        return timeout or None
+
+    def start_receiving(self):
+        """Make sure that a task is reading responses from the channel (see :func:`enter_main_loop()`)."""
+        if not self.receiving:
+            self.receiving = True
+            self.receiver = asyncio.ensure_future(self.enter_main_loop())
+
+    async def enter_main_loop(self):
+        """
+        Handle the messages from the other side until the channel is closed.
+
+        Requests from the remote side are handled concurrently, except for
+        requests without a request ID (from remote sides that expect
+        responses in order). Responses to our own remote method calls are
+        handed to the calls they belong to.
+
+        This coroutine is started automatically (as a task) when remote
+        methods are called. A remote side that only answers requests should
+        await this coroutine directly.
+        """
+        self.receiving = True
+        try:
+            while True:
+                frame = await self.read_frame()
+                if frame is None:
+                    logger.debug("Remote side closed %s.", self.conn_label)
+                    break
+                message, codec = frame
+                if 'method' not in message:
+                    self.dispatch_response(message)
+                elif 'id' in message:
+                    task = asyncio.ensure_future(self.process_request(message, codec))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                else:
+                    await self.process_request(message, codec)
+        finally:
+            self.receiving = False
+            self.fail_pending_calls()
+
+    def dispatch_response(self, response):
+        """
+        Hand a response from the remote side to the call it belongs to.
+
+        :param response: The decoded response (a dictionary).
+        """
+        request_id = response.get('id')
+        if request_id in self.pending_calls:
+            call = self.pending_calls[request_id]
+        elif request_id is None and self.pending_calls:
+            # Old peers answer our requests in order without echoing the ID.
+            call = self.pending_calls[min(self.pending_calls)]
+        else:
+            logger.warning("Ignoring response to unknown request #%s!", request_id)
+            return
+        if response.get('partial'):
+            call.partial_results.append(response['result'])
+        else:
+            self.pending_calls.pop(call.request_id)
+            call.response = response
+        call.cached = call.cached or response.get('cached', False)
+        call.changed.set()
+
+    def fail_pending_calls(self):
+        """Fail the remote method calls that are still waiting for a response because the channel was closed."""
+        for call in self.pending_calls.values():
+            call.response = dict(success=False, error="Remote side closed %s!" % self.conn_label)
+            call.changed.set()
+        self.pending_calls.clear()
+
+    async def process_request(self, request, codec=None):
+        """
+        Handle a request from the remote side and send the response.
+
+        :param request: The decoded request (a dictionary).
+        :param codec: The name of the codec used to encode the request (a
+                      string or :data:`None`), the response is encoded using
+                      the same codec.
+        """
+        response = await self.handle_request(request)
+        if response['success'] and inspect.isgenerator(response['result']):
+            await self.stream_response(request, response, codec)
+            return
+        try:
+            await self.write(response, codec=codec)
+        except (TypeError, ValueError) as e:
+            logger.exception("Failed to encode response to remote side!")
+            await self.write(dict(success=False, error="Failed to encode response: %s" % e, id=request.get('id')),
+                             codec=codec)
+
+    async def stream_response(self, request, response, codec=None):
+        """
+        Send the values produced by a streaming method to the remote side.
+
+        :param request: The decoded request (a dictionary).
+        :param response: The response whose result is a generator (a dictionary).
+        :param codec: The name of the codec used to encode the request (a
+                      string or :data:`None`).
+
+        Refer to :func:`~negotiator_common.NegotiatorInterface.stream_response()`
+        for details. The generator is advanced in the default executor of the
+        event loop because it may block.
+        """
+        loop = asyncio.get_event_loop()
+        generator = response['result']
+        values = []
+        try:
+            while True:
+                value = await loop.run_in_executor(None, next, generator, StopIteration)
+                if value is StopIteration:
+                    break
+                elif 'id' in request:
+                    await self.write(dict(id=request['id'], success=True, partial=True, result=value), codec=codec)
+                else:
+                    values.append(value)
+            response['result'] = values if 'id' not in request else None
+        except Exception as e:
+            logger.exception("Swallowing unexpected exception during streaming method call so we don't crash!")
+            response = dict(success=False, error=str(e), id=request.get('id'))
+        finally:
+            await loop.run_in_executor(None, generator.close)
+        await self.write(response, codec=codec)
+
+    async def handle_request(self, request):
+        """
+        Invoke a local method on behalf of the remote side.
+
+        :param request: The decoded request (a dictionary).
+        :returns: The response to send to the remote side (a dictionary).
+        """
+        method_name = request.get('method')
+        method = getattr(self, method_name, None) if method_name in self.exported_methods else None
+        args = request.get('args', [])
+        kw = request.get('kw', {})
+        if method:
+            try:
+                logger.info("Remote is calling local method %s ..", format_call(method_name, *args, **kw))
+                if asyncio.iscoroutinefunction(method):
+                    result = await method(*args, **kw)
+                else:
+                    loop = asyncio.get_event_loop()
+                    result = await loop.run_in_executor(None, functools.partial(method, *args, **kw))
+                logger.info("Local method call was successful and returned result %r.", result)
+                if isinstance(result, CachedResult):
+                    # Tell the remote side that the result came from a cache.
+                    response = dict(success=True, result=result.value, cached=True)
+                else:
+                    response = dict(success=True, result=result)
+            except Exception as e:
+                logger.exception("Swallowing unexpected exception during local method call so we don't crash!")
+                response = dict(success=False, error=str(e))
+        else:
+            logger.warning("Remote tried to call unsupported method %s!", method_name)
+            response = dict(success=False, error="Method %s not supported" % method_name)
+        if 'id' in request:
+            response['id'] = request['id']
+        return response
+
+    async def call_batch(self, requests, parallel=False):
+        """
+        Invoke several local methods on behalf of the remote side.
+
+        :param requests: A list of requests (dictionaries with the keys
+                         ``method``, ``args`` and ``kw``).
+        :param parallel: :data:`True` to handle the requests at the same time,
+                         :data:`False` to handle them one after another.
+        :returns: A list of responses in the order of `requests` (see
+                  :func:`~negotiator_common.NegotiatorInterface.call_batch()`).
+        """
+        requests = [dict(method=r.get('method'), args=r.get('args', []), kw=r.get('kw', {})) for r in requests]
+        if parallel:
+            responses = await asyncio.gather(*map(self.handle_request, requests))
+        else:
+            responses = [await self.handle_request(r) for r in requests]
+        for response in responses:
+            if response['success'] and inspect.isgenerator(response['result']):
+                # A batch is answered by a single response.
+                loop = asyncio.get_event_loop()
+                response['result'] = await loop.run_in_executor(None, list, response['result'])
+        return list(responses)
+
+
+class AsyncRemoteCall(RemoteCall):
+
+    """A remote method call made by :class:`AsyncNegotiatorInterface` that may still be in flight."""
+
+    def __init__(self, *args, **kw):
+        """
+        Initialize an :class:`AsyncRemoteCall` object.
+
+        Accepts the same arguments as :class:`~negotiator_common.RemoteCall`.
+        """
+        super(AsyncRemoteCall, self).__init__(*args, **kw)
+        self.changed = asyncio.Event()
+
+    async def wait(self, timeout=None):
+        """
+        Wait for the response to the remote method call.
+
+        :param timeout: The number of seconds to wait (a number, defaults to
+                        the timeout of the channel, zero disables the timeout).
+        :returns: The return value of the remote method.
+        :raises: :exc:`~negotiator_common.RemoteMethodFailed` when the remote
+                 method call fails, :exc:`asyncio.TimeoutError` when the
+                 timeout expires.
+        """
+        try:
+            await asyncio.wait_for(self.wait_for_response(), self.interface.get_timeout(timeout))
+        except asyncio.TimeoutError:
+            logger.warning("Remote method call timed out after %s!", self.timer)
+            # Forget about the call so that a late response is ignored.
+            self.interface.pending_calls.pop(self.request_id, None)
+            raise
+        return self.get_result()
+
+    async def wait_for_response(self, partial=False):
+        """
+        Wait for the response to arrive.
+
+        :param partial: :data:`True` to return as soon as a partial result is
+                        available (see :func:`stream()`).
+        """
+        while self.response is None and not (partial and self.partial_results):
+            self.changed.clear()
+            await self.changed.wait()
+
+    async def stream(self):
+        """
+        Get the partial results of a streaming remote method as they arrive.
+
+        :returns: An asynchronous generator of the values produced by the
+                  remote method.
+        :raises: :exc:`~negotiator_common.RemoteMethodFailed` when the remote
+                 method call fails.
+        """
+        while True:
+            while self.partial_results:
+                yield self.partial_results.popleft()
+            if self.done:
+                break
+            await self.wait_for_response(partial=True)
+        self.get_result()
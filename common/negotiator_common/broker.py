@@ -0,0 +1,487 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""
+Share channels between many local clients using UNIX sockets.
+
+Every :class:`~negotiator_common.NegotiatorInterface` channel is a single
+connection, so programs that want to talk to the other side each need to
+set up (and wait for) their own connection. This module enables a long
+running process to share the channels it keeps open with any number of local
+clients:
+
+- :class:`ControlServer` listens on a UNIX socket and handles the requests of
+  its clients using an :class:`~negotiator_common.eventloop.EventLoop` in a
+  background thread.
+
+- :class:`BrokerSession` is the server side of a client connection. Sub
+  classes define the methods that clients can call, usually by passing calls
+  on to a shared channel using :func:`forward_call()`.
+
+- :class:`BrokerClient` is the client side of a connection. It has the same
+  API as the channel it forwards to, so it can be used as a drop in
+  replacement.
+
+- :class:`SingleFlight` coalesces identical calls from different clients, so
+  that they share a single call on the channel they're forwarded to.
+
+The messages exchanged with clients use the same protocol as the channels
+(see :func:`~negotiator_common.NegotiatorInterface.read_frame()`), including
+request IDs and streaming responses.
+"""
+
+# Standard library modules.
+import errno
+import functools
+import itertools
+import logging
+import os
+import socket
+import threading
+import types
+
+# Modules included in our project.
+from negotiator_common import CachedResult, NegotiatorInterface, RemoteCall
+from negotiator_common.config import BROKER_CONCURRENCY
+from negotiator_common.eventloop import ChannelReader, EventLoop
+from negotiator_common.utils import WorkerPool
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+MAX_BUFFERED_CHUNKS = 16
+"""
+The number of partial results of a streaming call that are buffered for the
+callers that share the call (an integer, see :class:`SingleFlight`).
+
+When the slowest caller is this many partial results behind, no more partial
+results are read until it catches up.
+"""
+
+
+class ControlServer(object):
+
+    """Serve :class:`BrokerSession` objects on a UNIX socket."""
+
+    def __init__(self, pathname, session_factory, concurrency=BROKER_CONCURRENCY):
+        """
+        Initialize a :class:`ControlServer` object.
+
+        :param pathname: The pathname of the UNIX socket (a string).
+        :param session_factory: A callable that's given a binary file like
+                                object and a label (a string) and returns a
+                                :class:`BrokerSession` object.
+        :param concurrency: The number of requests (from all clients combined)
+                            that are handled at the same time (an integer,
+                            defaults to :data:`.BROKER_CONCURRENCY`).
+        """
+        self.pathname = pathname
+        self.session_factory = session_factory
+        self.concurrency = concurrency
+        self.readers = []
+        self.socket = None
+
+    def start(self):
+        """
+        Start listening on the UNIX socket and handling requests in a background thread.
+
+        :returns: :data:`True` when the server was started, :data:`False` when
+                  the UNIX socket couldn't be created (the reason is logged).
+        """
+        try:
+            directory = os.path.dirname(self.pathname)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            if os.path.exists(self.pathname):
+                # Remove the socket left behind by an earlier process.
+                os.unlink(self.pathname)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.bind(self.pathname)
+            # Clients get the same privileges as this process, so we don't
+            # want other users to be able to connect.
+            os.chmod(self.pathname, 0o600)
+            self.socket.listen(socket.SOMAXCONN)
+        except EnvironmentError as e:
+            logger.warning("Failed to create control socket %s! (%s)", self.pathname, e)
+            self.socket = None
+            return False
+        self.event_loop = EventLoop()
+        self.pool = WorkerPool(self.concurrency, queue_size=self.concurrency * 64)
+        self.event_loop.register(self.socket, self.accept_connection)
+        thread = threading.Thread(target=self.run, name="negotiator-control-socket")
+        thread.daemon = True
+        thread.start()
+        logger.info("Listening for clients on control socket %s ..", self.pathname)
+        return True
+
+    def run(self):
+        """Handle the requests of clients until :func:`stop()` is called."""
+        while self.socket:
+            self.event_loop.run_once()
+
+    def accept_connection(self, mask):
+        """
+        Accept a connection from a client.
+
+        :param mask: The event mask (an integer).
+        """
+        try:
+            connection, address = self.socket.accept()
+        except EnvironmentError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                logger.warning("Failed to accept connection on control socket! (%s)", e)
+            return
+        self.readers = [r for r in self.readers if r.is_alive()]
+        label = "client #%i of control socket %s" % (len(self.readers) + 1, self.pathname)
+        logger.debug("Accepted connection from %s.", label)
+        session = self.session_factory(connection.makefile('rwb'), label)
+        reader = ChannelReader(session, connection, self.event_loop, self.pool)
+        reader.start()
+        self.readers.append(reader)
+
+    def stop(self):
+        """Stop listening on the UNIX socket and disconnect all clients."""
+        if self.socket:
+            self.event_loop.unregister(self.socket)
+            for reader in self.readers:
+                reader.terminate()
+            self.socket.close()
+            self.socket = None
+            try:
+                os.unlink(self.pathname)
+            except EnvironmentError:
+                pass
+
+
+class BrokerSession(NegotiatorInterface):
+
+    """
+    The server side of a connection to a :class:`ControlServer`.
+
+    Only the methods named in :attr:`exported_methods` can be called by
+    clients, because the methods inherited from
+    :class:`~negotiator_common.NegotiatorInterface` would enable clients to
+    execute commands in the context of the server.
+    """
+
+    exported_methods = ('select_codec',)
+    """The names of the methods that clients are allowed to call (a tuple of strings)."""
+
+
+class BrokerClient(NegotiatorInterface):
+
+    """
+    The client side of a connection to a :class:`ControlServer`.
+
+    Remote method calls are wrapped in a call to :attr:`forward_method`, so
+    they're answered by the channel that the session forwards to.
+    """
+
+    def __init__(self, pathname, forward_method, forward_args=(), timeout=None):
+        """
+        Connect to a :class:`ControlServer`.
+
+        :param pathname: The pathname of the UNIX socket (a string).
+        :param forward_method: The name of the :class:`BrokerSession` method
+                               that forwards calls (a string).
+        :param forward_args: Positional arguments that are passed to the
+                             forwarding method before the name of the method
+                             and its arguments (a tuple).
+        :param timeout: The number of seconds after which reading from or
+                        writing to the UNIX socket times out (a number,
+                        optional).
+        :raises: :exc:`~exceptions.EnvironmentError` when connecting fails.
+        """
+        self.forward_method = forward_method
+        self.forward_args = tuple(forward_args)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        try:
+            self.socket.connect(pathname)
+        except EnvironmentError:
+            self.socket.close()
+            raise
+        super(BrokerClient, self).__init__(handle=self.socket.makefile('rwb'),
+                                           label="control socket %s" % pathname)
+
+    def send_remote_call(self, method, *args, **kw):
+        """
+        Send a remote method call through the broker.
+
+        :param method: The name of the method to call (a string).
+        :param args: The positional arguments for the method.
+        :param kw: The keyword arguments for the method.
+        :returns: A :class:`~negotiator_common.RemoteCall` object.
+
+        Codec negotiation is handled by the broker itself, all other calls are
+        forwarded.
+        """
+        if method == 'select_codec':
+            return super(BrokerClient, self).send_remote_call(method, *args, **kw)
+        call = RemoteCall(self, next(self.request_ids), method, args, kw)
+        with self.read_condition:
+            self.pending_calls[call.request_id] = call
+        self.write(dict(id=call.request_id, method=self.forward_method,
+                        args=self.forward_args + (method, args, kw)), codec=self.codec)
+        return call
+
+    def close(self):
+        """Close the connection to the broker."""
+        try:
+            self.conn_handle.close()
+        except EnvironmentError:
+            pass
+        self.socket.close()
+
+
+def forward_call(channel, method, args, kw):
+    """
+    Call a remote method on behalf of a client.
+
+    :param channel: The :class:`~negotiator_common.NegotiatorInterface` to
+                    forward the call to.
+    :param method: The name of the method to call (a string).
+    :param args: The positional arguments for the method (a list).
+    :param kw: The keyword arguments for the method (a dictionary).
+    :returns: The return value of the remote method or, when the remote
+              method streams its results, a generator of the partial results
+              (so that they're streamed to the client as they arrive). When
+              the remote side answered from its result cache the value is
+              wrapped in a :class:`~negotiator_common.execution.CachedResult` object
+              (so that the client is told as well).
+    :raises: :exc:`~negotiator_common.RemoteMethodFailed` when the remote
+             method call fails.
+    """
+    call = channel.start_remote_call(method, *args, **kw)
+    channel.wait_for_response(call, partial=True)
+    result = call.stream() if call.partial_results else call.get_result()
+    return CachedResult(result) if call.cached else result
+
+
+class SingleFlight(object):
+
+    """
+    Coalesce identical concurrent calls so that they share one call and its result.
+
+    When a call is started while an identical call (with the same key) is in
+    flight, the second caller waits for the result of the first call instead
+    of making its own call. Streaming results (generators) are copied to all
+    callers as they arrive, using a buffer of at most
+    :data:`MAX_BUFFERED_CHUNKS` partial results (see :class:`Flight`).
+    """
+
+    def __init__(self):
+        """Initialize a :class:`SingleFlight` object."""
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def call(self, key, function):
+        """
+        Call a function or join an identical call that's in flight.
+
+        :param key: The key that identifies identical calls (a hashable value).
+        :param function: The callable that makes the call (it's given no
+                         arguments). Its return value may be a generator
+                         and/or wrapped in a :class:`~negotiator_common.execution.CachedResult`.
+        :returns: The return value of the function (generators are replaced
+                  by a generator that produces the same values).
+        :raises: Any exception raised by the function.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            reader = flight.join() if flight else None
+            if reader is None:
+                flight = Flight()
+                reader = flight.join()
+                self.flights[key] = flight
+                leader = True
+            else:
+                logger.debug("Joining call that's already in flight (%s).", key)
+                leader = False
+        if leader:
+            flight.start(function, functools.partial(self.land, key, flight))
+        return flight.get_result(reader)
+
+    def land(self, key, flight):
+        """
+        Stop sharing a call with new callers.
+
+        :param key: The key of the call.
+        :param flight: The :class:`Flight` object of the call.
+        """
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+
+class Flight(object):
+
+    """
+    A call that's shared by one or more callers (see :class:`SingleFlight`).
+
+    The partial results of a streaming call are kept in a single buffer in
+    which every caller has its own position. The buffer is trimmed as the
+    callers read from it and the thread that reads the partial results stops
+    reading when the slowest caller is :data:`MAX_BUFFERED_CHUNKS` partial
+    results behind, so memory usage is bounded no matter how slow the
+    callers are. Callers can join until the first partial result has been
+    dropped from the buffer.
+    """
+
+    def __init__(self):
+        """Initialize a :class:`Flight` object."""
+        self.condition = threading.Condition()
+        self.started = False
+        self.done = False
+        self.joinable = True
+        self.result = None
+        self.error = None
+        self.cached = False
+        self.streaming = False
+        # The buffered partial results of a streaming call.
+        self.chunks = []
+        # The number of partial results dropped from the buffer.
+        self.dropped = 0
+        # The number of partial results produced so far.
+        self.produced = 0
+        # The number of partial results read by each caller.
+        self.positions = {}
+        self.readers = itertools.count()
+
+    def join(self):
+        """
+        Become one of the callers.
+
+        :returns: A number that identifies the caller or :data:`None` when
+                  the call can no longer be joined.
+        """
+        with self.condition:
+            if not self.joinable:
+                return None
+            reader = next(self.readers)
+            self.positions[reader] = 0
+            return reader
+
+    def start(self, function, land):
+        """
+        Make the call (on behalf of all callers).
+
+        :param function: The callable that makes the call.
+        :param land: A callable that stops new callers from joining.
+        """
+        try:
+            result = function()
+        except Exception as e:
+            self.finish(error=e, land=land)
+            return
+        cached = isinstance(result, CachedResult)
+        if cached:
+            result = result.value
+        if isinstance(result, types.GeneratorType):
+            with self.condition:
+                self.cached = cached
+                self.streaming = True
+                self.started = True
+                self.condition.notify_all()
+            thread = threading.Thread(target=self.pump, args=(result, land))
+            thread.daemon = True
+            thread.start()
+        else:
+            with self.condition:
+                self.cached = cached
+                self.result = result
+            self.finish(land=land)
+
+    def pump(self, generator, land):
+        """
+        Copy the partial results of a streaming call to the buffer.
+
+        :param generator: The generator returned by the call.
+        :param land: A callable that stops new callers from joining.
+        """
+        error = None
+        try:
+            for value in generator:
+                with self.condition:
+                    while self.produced - self.dropped >= MAX_BUFFERED_CHUNKS:
+                        self.condition.wait()
+                    self.chunks.append(value)
+                    self.produced += 1
+                    self.condition.notify_all()
+        except Exception as e:
+            error = e
+        self.finish(error=error, land=land)
+
+    def finish(self, error=None, land=None):
+        """
+        Mark the call as done and wake up the callers.
+
+        :param error: The exception raised by the call (if any).
+        :param land: A callable that stops new callers from joining.
+        """
+        land()
+        with self.condition:
+            self.error = error
+            self.started = True
+            self.done = True
+            self.joinable = False
+            self.condition.notify_all()
+
+    def get_result(self, reader):
+        """
+        Wait for the result of the call.
+
+        :param reader: The value returned by :func:`join()`.
+        :returns: The result of the call (see :func:`SingleFlight.call()`).
+        :raises: The exception raised by the call.
+        """
+        with self.condition:
+            while not self.started:
+                self.condition.wait()
+            if not self.streaming:
+                self.positions.pop(reader, None)
+                if self.error:
+                    raise self.error
+            result = self.follow(reader) if self.streaming else self.result
+        return CachedResult(result) if self.cached else result
+
+    def follow(self, reader):
+        """
+        Get the partial results of a streaming call as they arrive.
+
+        :param reader: The value returned by :func:`join()`.
+        :returns: A generator of partial results.
+        :raises: The exception raised by the call.
+        """
+        try:
+            while True:
+                with self.condition:
+                    while not (self.positions[reader] < self.produced or self.done):
+                        self.condition.wait()
+                    position = self.positions[reader]
+                    if position < self.produced:
+                        value = self.chunks[position - self.dropped]
+                        self.positions[reader] = position + 1
+                        self.trim()
+                    elif self.error:
+                        raise self.error
+                    else:
+                        return
+                yield value
+        finally:
+            with self.condition:
+                self.positions.pop(reader, None)
+                self.trim()
+
+    def trim(self):
+        """Drop the partial results that every caller has read (the caller must hold :attr:`condition`)."""
+        oldest = min(self.positions.values()) if self.positions else self.produced
+        if oldest > self.dropped:
+            del self.chunks[:oldest - self.dropped]
+            self.dropped = oldest
+            # Late callers would miss the partial results that were dropped.
+            self.joinable = False
+            self.condition.notify_all()
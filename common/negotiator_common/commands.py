@@ -0,0 +1,123 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""
+Index of the user defined and built-in commands.
+
+Listing the commands used to scan :data:`.USER_COMMANDS_DIRECTORY` and
+:data:`.BUILTIN_COMMANDS_DIRECTORY` (checking every entry) on each call, and
+executing a command checked both directories again. The
+:class:`CommandRegistry` class scans a directory once and only scans it
+again when the modification time of the directory changes, which happens
+when commands are added, removed or renamed.
+"""
+
+# Standard library modules.
+import logging
+import os
+import threading
+
+# Modules included in our project.
+from negotiator_common.config import BUILTIN_COMMANDS_DIRECTORY, USER_COMMANDS_DIRECTORY
+from negotiator_common.native import NATIVE_COMMANDS
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+
+class CommandRegistry(object):
+
+    """Find user defined and built-in commands without scanning directories on every call."""
+
+    def __init__(self, user_directory=USER_COMMANDS_DIRECTORY, builtin_directory=BUILTIN_COMMANDS_DIRECTORY):
+        """
+        Initialize a :class:`CommandRegistry` object.
+
+        :param user_directory: The directory with user defined commands (a
+                               string, defaults to :data:`.USER_COMMANDS_DIRECTORY`).
+        :param builtin_directory: The directory with built-in commands (a
+                                  string, defaults to :data:`.BUILTIN_COMMANDS_DIRECTORY`).
+        """
+        self.user_directory = user_directory
+        self.builtin_directory = builtin_directory
+        self.lock = threading.Lock()
+        # Map directory names to tuples with the stat() signature of the
+        # directory and a dictionary that maps filenames to booleans (True
+        # for executable files).
+        self.index = {}
+
+    def scan(self, directory):
+        """
+        Get the files in a directory, rescanning the directory when it has changed.
+
+        :param directory: The pathname of the directory (a string).
+        :returns: A dictionary that maps filenames (strings) to :data:`True`
+                  for executable files and :data:`False` for other files.
+                  When the directory doesn't exist the dictionary is empty.
+        """
+        try:
+            info = os.stat(directory)
+            signature = (info.st_dev, info.st_ino, info.st_mtime)
+        except EnvironmentError:
+            signature = None
+        with self.lock:
+            cached = self.index.get(directory)
+            if cached and cached[0] == signature:
+                return cached[1]
+            files = {}
+            if signature:
+                logger.debug("Scanning %s for commands ..", directory)
+                for entry in os.listdir(directory):
+                    pathname = os.path.join(directory, entry)
+                    if os.path.isfile(pathname):
+                        if directory == self.builtin_directory and not os.access(pathname, os.X_OK):
+                            # Somewhere in the Python installation process the
+                            # executable bits of the built-in scripts get lost.
+                            # This is a pragmatic hack to compensate for that.
+                            logger.debug("Making %s executable ..", pathname)
+                            os.chmod(pathname, 0o755)
+                        files[entry] = os.access(pathname, os.X_OK)
+            self.index[directory] = (signature, files)
+            return files
+
+    def list_commands(self):
+        """
+        Find the names of the user defined and built-in commands.
+
+        :returns: A list of command names (strings).
+        """
+        commands = set(NATIVE_COMMANDS)
+        for directory in (self.builtin_directory, self.user_directory):
+            commands.update(name for name, executable in self.scan(directory).items() if executable)
+        return list(commands)
+
+    def is_user_command(self, name):
+        """
+        Check whether a user defined command exists.
+
+        :param name: The name of the command (a string).
+        :returns: :data:`True` if the user defined command exists, :data:`False` otherwise.
+        """
+        return name in self.scan(self.user_directory)
+
+    def resolve(self, name):
+        """
+        Find the program that implements a command.
+
+        :param name: The name of the command (a string).
+        :returns: The absolute pathname of the user defined command when it
+                  exists, otherwise the absolute pathname of the built-in
+                  command (a string).
+        """
+        if self.is_user_command(name):
+            return os.path.join(self.user_directory, name)
+        # Scanning the directory makes sure the built-in command is executable.
+        self.scan(self.builtin_directory)
+        return os.path.join(self.builtin_directory, name)
+
+
+command_registry = CommandRegistry()
+"""The :class:`CommandRegistry` used by :class:`~negotiator_common.NegotiatorInterface`."""
@@ -1,7 +1,7 @@
 # Scriptable KVM/QEMU guest agent in Python.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: March 3, 2019
+# Last Change: October 16, 2026
 # URL: https://negotiator.readthedocs.org
 
 """Configuration defaults for the `negotiator` project."""
@@ -36,3 +36,176 @@ The number of seconds to wait for a reply from the other side (an integer).
 If more time elapses an exception is raised causing the process to exit with a
 nonzero status code.
 """
+
+LIBVIRT_STATE_DIRECTORY = '/run/libvirt/qemu'
+"""
+The pathname of the directory where libvirt keeps the live XML definitions of
+running guests (a string). The host daemon watches this directory to find out
+when guests are started or stopped (see :mod:`negotiator_host.inotify`).
+"""
+
+DISCOVERY_INTERVAL = 10
+"""
+The number of seconds between checks for guests that were started or stopped
+(an integer). When :data:`LIBVIRT_STATE_DIRECTORY` can be watched using inotify
+the host daemon only checks for guests when the directory changes or a worker
+has crashed (and every :data:`DISCOVERY_FALLBACK_INTERVAL` seconds).
+"""
+
+DISCOVERY_FALLBACK_INTERVAL = 60 * 5
+"""
+The maximum number of seconds between checks for guests that were started or
+stopped while :data:`LIBVIRT_STATE_DIRECTORY` is watched using inotify (an
+integer). This is a safety net in case changes are missed.
+"""
+
+HOST_CONTROL_SOCKET = '/run/negotiator/host.sock'
+"""
+The pathname of the UNIX socket where the host daemon accepts calls for guests
+(a string). The host daemon keeps a connection to every guest open, so calls
+sent through this socket don't need to discover the guest and connect to it
+first (see :mod:`negotiator_common.broker`).
+"""
+
+GUEST_CONTROL_SOCKET = '/run/negotiator/guest.sock'
+"""
+The pathname of the UNIX socket where the guest multiplexer accepts calls for
+the host (a string). The multiplexer keeps the character device of the guest
+to host channel open, so that any number of programs inside the guest can
+call the host at the same time (see :mod:`negotiator_common.broker`).
+"""
+
+DISCOVERY_CONCURRENCY = 8
+"""The maximum number of guests whose channels are discovered at the same time (an integer)."""
+
+FAN_OUT_CONCURRENCY = 8
+"""The maximum number of guests that ``negotiator-host`` talks to at the same time (an integer)."""
+
+DEFAULT_CONCURRENCY = 1
+"""
+The number of requests from the other side that are handled at the same time (an integer).
+
+The default value of one means requests are handled one at a time, in the order
+they are received. Higher values enable a pool of worker threads.
+"""
+
+EVENT_LOOP_CONCURRENCY = 16
+"""
+The number of requests that the single process host daemon handles at the same
+time (an integer, see :class:`~negotiator_host.EventLoopHostDaemon`).
+
+This is shared between all guests, in contrast with :data:`DEFAULT_CONCURRENCY`
+which applies to each guest individually.
+"""
+
+BROKER_CONCURRENCY = 32
+"""
+The number of requests from the clients of a control socket that are handled
+at the same time (an integer, see :data:`HOST_CONTROL_SOCKET`).
+"""
+
+FORK_SERVER_CONCURRENCY = 32
+"""
+The number of requests that the fork server handles at the same time (an
+integer, see :class:`~negotiator_common.forkserver.ForkServer`).
+"""
+
+COALESCED_METHODS = ('list_commands', 'execute', 'execute_streaming')
+"""
+The methods whose identical concurrent calls are coalesced by the host daemon
+(a tuple of strings, see :class:`~negotiator_common.broker.SingleFlight`).
+
+When several clients of the control socket call one of these methods of the
+same guest with the same arguments at the same time, the method is called
+once and all clients receive its result. Calls that stream input to the
+remote command are never coalesced.
+"""
+
+MAX_BATCH_CONCURRENCY = 8
+"""
+The maximum number of requests in a batch that are handled at the same time
+when the remote side asks for parallel execution (an integer).
+"""
+
+CACHEABLE_COMMANDS = {
+    'find-distributor-id': 60 * 60,
+    'find-distribution-release': 60 * 60,
+    'find-distribution-codename': 60 * 60,
+}
+"""
+The commands whose output is cached (a dictionary that maps command names to
+the number of seconds that their output is cached).
+
+The output of these commands is cached by the side that executes them (see
+:attr:`~negotiator_common.execution.CommandExecutionMixin.cacheable_commands`). Commands
+that are given input and commands that fail are never cached.
+"""
+
+RESULT_CACHE_SIZE = 256
+"""
+The maximum number of results cached by each channel (an integer, see
+:class:`~negotiator_common.utils.ResultCache`).
+"""
+
+PREFERRED_CODECS = ('msgpack', 'cbor', 'orjson', 'json')
+"""
+The names of the codecs that can be used to encode messages, in order of preference (a tuple of strings).
+
+Refer to :mod:`negotiator_common.serialization` for details.
+"""
+
+STREAM_CHUNK_SIZE = 1024 * 64
+"""The maximum number of bytes of command output sent in one message (an integer)."""
+
+STREAMING_CONCURRENCY = 8
+"""
+The number of streaming responses that a channel sends at the same time (an
+integer, see :func:`~negotiator_common.NegotiatorInterface.process_request()`).
+
+This applies to channels whose requests are handled by an
+:class:`~negotiator_common.eventloop.EventLoop`, the main loop of a channel
+uses its concurrency instead. Responses for commands with an input stream
+aren't limited by this (see :data:`MAX_INPUT_STREAMS`).
+"""
+
+MAX_INPUT_STREAMS = 32
+"""
+The number of commands with an input stream that can run at the same time on
+one channel (an integer, see
+:func:`~negotiator_common.execution.CommandExecutionMixin.execute_streaming()`).
+Further commands with an input stream fail until one of them exits.
+"""
+
+MAX_INPUT_CHUNKS_IN_FLIGHT = 4
+"""
+The number of chunks of input that can be sent to a remote command before
+waiting for it to consume them (an integer, see :data:`STREAM_CHUNK_SIZE`).
+"""
+
+INPUT_CHUNK_TIMEOUT = 60
+"""
+The number of seconds that a chunk of input (or of an uploaded file) waits
+for the preceding chunks to arrive (an integer, see
+:class:`~negotiator_common.utils.InputStream`). When the preceding chunks
+don't arrive in time the stream fails.
+"""
+
+FILE_TRANSFER_DIRECTORY = '/var/lib/negotiator/files'
+"""
+The pathname of the directory containing the files that 'the other side' can
+read and write (a string). File transfers are disabled when this directory
+doesn't exist (see :mod:`negotiator_common.transfer`). On KVM/QEMU hosts every
+guest gets its own subdirectory, named after the guest.
+"""
+
+FILE_CHUNK_SIZE = 1024 * 1024
+"""The number of bytes of a file that are sent in one message (an integer)."""
+
+MAX_FILE_CHUNKS_IN_FLIGHT = 4
+"""The number of chunks of a file that can be sent before waiting for acknowledgement (an integer)."""
+
+DELTA_BLOCK_SIZE = 1024 * 16
+"""The size of the blocks compared when files are synchronized (an integer)."""
+
+MAX_DELTA_INSTRUCTIONS = 1024
+"""The maximum number of instructions sent in one message when files are synchronized (an integer)."""
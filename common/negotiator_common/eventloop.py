@@ -0,0 +1,316 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""
+Event driven handling of requests from many channels in a single thread.
+
+The :class:`~negotiator_common.NegotiatorInterface` class reads messages
+using blocking reads, which means every channel needs its own thread or
+process to wait for requests. This module enables a single thread to wait for
+requests from any number of channels:
+
+- :class:`EventLoop` waits for sockets to become readable using
+  :func:`select.epoll()` (or :func:`select.poll()` where epoll isn't
+  available).
+
+- :class:`FrameParser` parses messages from the data received so far,
+  without blocking until a complete message has arrived.
+
+- :class:`ChannelReader` connects a channel to an event loop. Requests are
+  parsed as data arrives and handled by a :class:`~negotiator_common.utils.WorkerPool`
+  that's shared between channels. Responses are written by the worker threads
+  (using the regular blocking writes). Requests without a request ID (from
+  remote sides that expect responses in order) are handled one at a time.
+
+Channels served by an event loop only answer requests, they can't be used to
+call remote methods because responses would be consumed by the event loop.
+"""
+
+# Standard library modules.
+import collections
+import errno
+import logging
+import select
+import socket
+import threading
+
+# Modules included in our project.
+from negotiator_common import ProtocolError, decode_message, parse_header
+from negotiator_common.utils import Timer
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+RECEIVE_BUFFER_SIZE = 1024 * 64
+"""The maximum number of bytes read from a socket at once (an integer)."""
+
+
+class EventLoop(object):
+
+    """Dispatch events on file descriptors to callbacks."""
+
+    def __init__(self):
+        """Initialize an :class:`EventLoop` object."""
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.timeout_unit = 1
+        else:
+            self.poller = select.poll()
+            self.timeout_unit = 1000
+        self.callbacks = {}
+
+    def register(self, handle, callback):
+        """
+        Start watching a file descriptor for input.
+
+        :param handle: A file like object with a ``fileno()`` method.
+        :param callback: The callable to invoke when the file descriptor
+                         becomes readable or is closed. It's given a single
+                         argument: The event mask (an integer).
+        """
+        fd = handle.fileno()
+        self.poller.register(fd, select.POLLIN)
+        self.callbacks[fd] = callback
+
+    def unregister(self, handle):
+        """
+        Stop watching a file descriptor.
+
+        :param handle: A file like object with a ``fileno()`` method.
+        """
+        fd = handle.fileno()
+        if self.callbacks.pop(fd, None):
+            try:
+                self.poller.unregister(fd)
+            except (EnvironmentError, KeyError):
+                # File descriptors are removed automatically when they're closed.
+                pass
+
+    def run_once(self, timeout=None):
+        """
+        Wait for events and invoke the callbacks that they belong to.
+
+        :param timeout: The maximum number of seconds to wait (a number or
+                        :data:`None` to wait until an event arrives).
+        """
+        try:
+            events = self.poller.poll(-1 if timeout is None else timeout * self.timeout_unit)
+        except EnvironmentError as e:
+            if e.errno == errno.EINTR:
+                return
+            raise
+        for fd, mask in events:
+            callback = self.callbacks.get(fd)
+            if callback:
+                try:
+                    callback(mask)
+                except Exception:
+                    logger.exception("Swallowing unexpected exception in event handler so we don't crash!")
+
+    def run_until(self, seconds, condition=None):
+        """
+        Handle events for the given number of seconds.
+
+        :param seconds: The number of seconds to handle events (a number).
+        :param condition: A callable that returns :data:`True` to stop
+                          handling events before the time is up (optional).
+        """
+        timer = Timer()
+        while timer.elapsed_time < seconds and not (condition and condition()):
+            self.run_once(seconds - timer.elapsed_time)
+
+
+class FrameParser(object):
+
+    """
+    Incremental parser for messages received from the remote side.
+
+    Refer to :func:`~negotiator_common.NegotiatorInterface.read_frame()` for
+    details about the format of messages.
+    """
+
+    def __init__(self):
+        """Initialize a :class:`FrameParser` object."""
+        self.buffer = bytearray()
+        self.header = None
+
+    def feed(self, data):
+        """
+        Parse the messages that have been completely received.
+
+        :param data: The data received from the remote side (a byte string).
+        :returns: A list of tuples with two values each (the same values
+                  returned by :func:`~negotiator_common.NegotiatorInterface.read_frame()`).
+        :raises: :exc:`~negotiator_common.ProtocolError` when the remote side
+                 violates the protocol.
+        """
+        self.buffer.extend(data)
+        messages = []
+        while True:
+            if self.header is None:
+                end_of_line = self.buffer.find(b'\n')
+                if end_of_line < 0:
+                    break
+                self.header = parse_header(bytes(self.buffer[:end_of_line + 1]))
+                del self.buffer[:end_of_line + 1]
+            num_bytes, codec_name, attachment_sizes = self.header
+            if len(self.buffer) < num_bytes + sum(attachment_sizes):
+                break
+            encoded_value = bytes(self.buffer[:num_bytes])
+            offset = num_bytes
+            attachments = []
+            for size in attachment_sizes:
+                attachments.append(bytes(self.buffer[offset:offset + size]))
+                offset += size
+            del self.buffer[:offset]
+            self.header = None
+            messages.append((decode_message(encoded_value, codec_name, attachments), codec_name))
+        return messages
+
+
+class ChannelReader(object):
+
+    """
+    Read requests for a :class:`~negotiator_common.NegotiatorInterface` from an :class:`EventLoop`.
+
+    The :func:`start()`, :func:`terminate()` and :func:`is_alive()` methods
+    mimic the :class:`multiprocessing.Process` API, so that channel readers
+    can be managed like worker processes.
+    """
+
+    def __init__(self, interface, sock, event_loop, pool):
+        """
+        Initialize a :class:`ChannelReader` object.
+
+        :param interface: The :class:`~negotiator_common.NegotiatorInterface`
+                          that handles the requests.
+        :param sock: The socket that the interface is connected to.
+        :param event_loop: The :class:`EventLoop` to register with.
+        :param pool: The :class:`~negotiator_common.utils.WorkerPool` that
+                     handles requests.
+        """
+        self.interface = interface
+        self.socket = sock
+        self.event_loop = event_loop
+        self.pool = pool
+        self.parser = FrameParser()
+        self.alive = False
+        # Requests without a request ID that haven't been answered yet (the
+        # first one is being handled by a worker thread).
+        self.ordered_lock = threading.Lock()
+        self.ordered_requests = collections.deque()
+        # Statistics about the requests handled (see average_latency).
+        self.stats_lock = threading.Lock()
+        self.requests_handled = 0
+        self.total_latency = 0.0
+
+    @property
+    def average_latency(self):
+        """The average number of seconds between receiving a request and responding to it (a float)."""
+        with self.stats_lock:
+            return self.total_latency / self.requests_handled if self.requests_handled else 0.0
+
+    def start(self):
+        """Start reading requests from the channel."""
+        self.event_loop.register(self.socket, self.handle_event)
+        self.alive = True
+
+    def is_alive(self):
+        """:data:`True` while requests are being read from the channel, :data:`False` otherwise."""
+        return self.alive
+
+    def terminate(self):
+        """Stop reading requests from the channel and close it."""
+        if self.alive:
+            self.alive = False
+            self.event_loop.unregister(self.socket)
+            try:
+                self.interface.conn_handle.close()
+            except EnvironmentError:
+                pass
+            self.socket.close()
+
+    def handle_event(self, mask):
+        """
+        Read data from the channel and submit the requests that have been received.
+
+        :param mask: The event mask (an integer).
+        """
+        try:
+            data = self.socket.recv(RECEIVE_BUFFER_SIZE, socket.MSG_DONTWAIT)
+        except EnvironmentError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            logger.warning("Failed to read from %s! (%s)", self.interface.conn_label, e)
+            self.terminate()
+            return
+        if not data:
+            logger.info("Remote side closed %s.", self.interface.conn_label)
+            self.terminate()
+            return
+        try:
+            messages = self.parser.feed(data)
+        except ProtocolError as e:
+            logger.error("Closing %s because of protocol error! (%s)", self.interface.conn_label, e)
+            self.terminate()
+            return
+        for request, codec in messages:
+            if 'id' in request:
+                self.pool.submit(self.process_request, request, codec, Timer())
+            else:
+                self.submit_in_order(request, codec, Timer())
+
+    def submit_in_order(self, request, codec, timer):
+        """
+        Handle a request without a request ID after the preceding ones have been answered.
+
+        :param request: The decoded request (a dictionary).
+        :param codec: The name of the codec used to encode the request (a
+                      string or :data:`None`).
+        :param timer: A :class:`~negotiator_common.utils.Timer` started when the request
+                      was received.
+
+        Remote sides that don't send request IDs expect responses in the
+        order of their requests, so these requests are handled by a single
+        worker thread at a time (see :func:`process_in_order()`). This
+        doesn't block the event loop, so other channels are unaffected.
+        """
+        with self.ordered_lock:
+            self.ordered_requests.append((request, codec, timer))
+            if len(self.ordered_requests) > 1:
+                # A worker thread is already handling the preceding requests.
+                return
+        self.pool.submit(self.process_in_order)
+
+    def process_in_order(self):
+        """Handle the requests queued by :func:`submit_in_order()` in a worker thread."""
+        while True:
+            with self.ordered_lock:
+                request, codec, timer = self.ordered_requests[0]
+            try:
+                self.process_request(request, codec, timer)
+            except Exception:
+                # Keep handling the requests that follow.
+                logger.exception("Swallowing unexpected exception in worker thread so we don't crash!")
+            with self.ordered_lock:
+                self.ordered_requests.popleft()
+                if not self.ordered_requests:
+                    return
+
+    def process_request(self, request, codec, timer):
+        """
+        Handle a request in a worker thread.
+
+        :param request: The decoded request (a dictionary).
+        :param codec: The name of the codec used to encode the request (a
+                      string or :data:`None`).
+        :param timer: A :class:`~negotiator_common.utils.Timer` started when the request
+                      was received.
+        """
+        self.interface.process_request(request, codec)
+        with self.stats_lock:
+            self.requests_handled += 1
+            self.total_latency += timer.elapsed_time
@@ -0,0 +1,410 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""
+Execution of user defined and built-in commands on behalf of the remote side.
+
+This module implements the :class:`CommandExecutionMixin` class which
+provides the methods that the remote side calls to list and execute commands
+(see :func:`~CommandExecutionMixin.execute()` and
+:func:`~CommandExecutionMixin.execute_streaming()`). It's mixed into
+:class:`~negotiator_common.NegotiatorInterface` as well as
+:class:`~negotiator_common.aio.AsyncNegotiatorInterface`, so that both
+implementations of the protocol support the same commands.
+"""
+
+# Standard library modules.
+import logging
+import os
+import select
+import subprocess
+import threading
+
+# Modules included in our project.
+from negotiator_common.commands import command_registry
+from negotiator_common.config import CACHEABLE_COMMANDS, MAX_INPUT_STREAMS, STREAM_CHUNK_SIZE
+from negotiator_common.native import NATIVE_COMMANDS
+from negotiator_common.serialization import binary
+from negotiator_common.utils import InputStream, feed_input
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+
+class CommandExecutionMixin(object):
+
+    """
+    Methods for command execution, mixed into :class:`~negotiator_common.NegotiatorInterface`.
+
+    The ``input_streams`` attribute is expected to be a dictionary in which
+    the standard input streams of running commands are kept and the
+    ``result_cache`` attribute is expected to be a
+    :class:`~negotiator_common.utils.ResultCache` object.
+    """
+
+    cacheable_commands = CACHEABLE_COMMANDS
+    """
+    The commands whose output is cached by :func:`execute()` and
+    :func:`execute_streaming()` (a dictionary, see :data:`.CACHEABLE_COMMANDS`).
+    """
+
+    fork_server = None
+    """
+    The :class:`~negotiator_common.forkserver.ForkServer` that starts commands
+    on behalf of this channel (:data:`None` to start commands directly).
+    """
+
+    exported_methods = ('list_commands', 'execute', 'execute_streaming', 'write_input', 'close_input')
+    """The names of the methods that the remote side is allowed to call (a tuple of strings)."""
+
+    def list_commands(self):
+        """
+        Find the names of the user defined commands.
+
+        :returns: A list of executable names (strings).
+        """
+        return command_registry.list_commands()
+
+    def get_environment(self):
+        """
+        Get the environment variables for command execution.
+
+        :returns: A dictionary with environment variables that are set for
+                  external commands (on top of the environment inherited from
+                  the current process).
+
+        This method can be overridden by sub classes to expose environment
+        variables to external commands. Because the variables are passed to
+        each command individually (instead of modifying :data:`os.environ`)
+        this is safe to use when requests are handled concurrently.
+        """
+        return {}
+
+    def prepare_environment(self):
+        """
+        Prepare environment variables for command execution.
+
+        This method can be overridden by sub classes to prepare environment
+        variables for external command execution.
+
+        .. deprecated:: 0.13
+           Modifying :data:`os.environ` isn't safe when requests are handled
+           concurrently, please override :func:`get_environment()` instead.
+        """
+
+    def execute(self, *command, **options):
+        """
+        Execute a user defined or built-in command.
+
+        :param command: The command name and any arguments (one or more strings).
+        :param input: The input to feed to the command on its standard input
+                      stream (a string or ``None``).
+        :returns: The output of the command (a string) or ``None`` if the
+                  command exited with a nonzero exit code. When the output
+                  was cached (see :func:`find_cache_ttl()`) it's wrapped in
+                  a :class:`CachedResult` object.
+        """
+        ttl = self.find_cache_ttl(command, options)
+        if ttl:
+            cache_key = ('execute',) + tuple(self.resolve_command(command))
+            output = self.result_cache.get(cache_key)
+            if output is not None:
+                return CachedResult(output)
+        output = self.run_native_command(command)
+        if output is not None:
+            # Strip whitespace like executor does.
+            output = output.strip() if '\n' not in output.strip() else output
+        else:
+            self.prepare_environment()
+            if self.fork_server and self.fork_server.is_alive():
+                output = self.fork_server.execute(self.resolve_command(command), self.get_environment(),
+                                                  options.get('input', None))
+            else:
+                # Imported on demand to keep the start-up time of the command line programs low.
+                from executor import execute
+                output = execute(
+                    *self.resolve_command(command),
+                    input=options.get('input', None),
+                    environment=self.get_environment(),
+                    capture=True,
+                    logger=logger
+                )
+        if ttl and output is not None:
+            self.result_cache.put(cache_key, output, ttl)
+        return output
+
+    def execute_streaming(self, *command, **options):
+        """
+        Execute a user defined or built-in command and stream its output.
+
+        :param command: The command name and any arguments (one or more strings).
+        :param input: The input to feed to the command on its standard input
+                      stream (a string or ``None``).
+        :param input_stream: A unique identifier chosen by the remote side (a
+                             string). When given, the standard input of the
+                             command stays open so that the remote side can
+                             stream input using :func:`write_input()` and
+                             :func:`close_input()`.
+        :returns: A generator of dictionaries. When `input_stream` is given
+                  the first dictionary has an ``input_stream`` key to confirm
+                  that the command has started. While the command is running
+                  the dictionaries have a ``stdout`` or ``stderr`` key whose
+                  value is a chunk of output (a byte string). The last
+                  dictionary has a ``returncode`` key whose value is the exit
+                  code of the command (an integer).
+        :raises: :exc:`~exceptions.ValueError` when `input_stream` is given
+                 while :data:`.MAX_INPUT_STREAMS` commands with an input
+                 stream are running.
+
+        In contrast to :func:`execute()` the output isn't buffered until the
+        command exits, instead every chunk is sent to the remote side as soon
+        as it is available (see :func:`~negotiator_common.NegotiatorInterface.stream_response()`). When the output
+        was cached (see :func:`find_cache_ttl()`) the generator is wrapped in
+        a :class:`CachedResult` object.
+        """
+        if options.get('input_stream', None) and len(self.input_streams) >= MAX_INPUT_STREAMS:
+            raise ValueError("Refusing to start %s because %i commands with an input stream are running!"
+                             % (command[0], len(self.input_streams)))
+        ttl = self.find_cache_ttl(command, options)
+        if ttl:
+            cache_key = ('execute_streaming',) + tuple(self.resolve_command(command))
+            chunks = self.result_cache.get(cache_key)
+            if chunks is not None:
+                # Streaming responses are recognized as generators.
+                return CachedResult(chunk for chunk in chunks)
+        output = self.run_native_command(command)
+        if output is not None:
+            generator = self.stream_native_output(output, options.get('input_stream', None))
+        else:
+            self.prepare_environment()
+            if self.fork_server and self.fork_server.is_alive():
+                generator = self.fork_server.execute_streaming(self.resolve_command(command), self.get_environment(),
+                                                               options.get('input', None),
+                                                               options.get('input_stream', None))
+            else:
+                process = start_process(self.resolve_command(command), self.get_environment())
+                generator = self.stream_process(process, options.get('input', None),
+                                                options.get('input_stream', None))
+        return self.cache_output(generator, cache_key, ttl) if ttl else generator
+
+    def find_cache_ttl(self, command, options):
+        """
+        Find out whether the output of a command can be cached.
+
+        :param command: The command name and any arguments (a list of strings).
+        :param options: The keyword arguments given to :func:`execute()` or
+                        :func:`execute_streaming()` (a dictionary).
+        :returns: The number of seconds that the output can be cached (a
+                  number) or :data:`None` when the output can't be cached.
+
+        Only the commands in :attr:`cacheable_commands` are cached and only
+        when they aren't given any input.
+        """
+        if options.get('input', None) or options.get('input_stream', None):
+            return None
+        return self.cacheable_commands.get(os.path.basename(command[0]))
+
+    def cache_output(self, generator, cache_key, ttl):
+        """
+        Cache the output of a command started by :func:`execute_streaming()`.
+
+        :param generator: The generator returned by :func:`execute_streaming()`.
+        :param cache_key: The key of the cache entry (a tuple).
+        :param ttl: The number of seconds that the output is cached (a number).
+        :returns: A generator that produces the same values as `generator`.
+
+        The output is only cached when the command exits successfully.
+        """
+        chunks = []
+        for chunk in generator:
+            chunks.append(chunk)
+            yield chunk
+        if chunks and chunks[-1].get('returncode') == 0:
+            self.result_cache.put(cache_key, chunks, ttl)
+
+    def stream_process(self, process, input=None, input_stream=None):
+        """
+        Feed input to a subprocess and stream its output (see :func:`execute_streaming()`).
+
+        :param process: A :class:`subprocess.Popen` object created by :func:`start_process()`.
+        :param input: The input to feed to the subprocess (a string or :data:`None`).
+        :param input_stream: The identifier of the input stream of the
+                             subprocess (a string or :data:`None`).
+        :returns: A generator of dictionaries (see :func:`execute_streaming()`).
+        """
+        if input_stream:
+            self.input_streams[input_stream] = InputStream(process.stdin)
+        else:
+            writer = threading.Thread(target=feed_input, args=(process.stdin, input))
+            writer.daemon = True
+            writer.start()
+        return self.stream_output(process, input_stream)
+
+    def stream_output(self, process, input_stream=None):
+        """
+        Stream the output of a subprocess started by :func:`execute_streaming()`.
+
+        :param process: A :class:`subprocess.Popen` object.
+        :param input_stream: The identifier of the input stream of the
+                             subprocess (a string or :data:`None`).
+        :returns: A generator of dictionaries (see :func:`execute_streaming()`).
+        """
+        try:
+            if input_stream:
+                yield dict(input_stream=input_stream)
+            streams = {process.stdout.fileno(): 'stdout', process.stderr.fileno(): 'stderr'}
+            while streams:
+                readable, writable, exceptional = select.select(list(streams), [], [])
+                for fd in readable:
+                    data = os.read(fd, STREAM_CHUNK_SIZE)
+                    if data:
+                        yield {streams[fd]: binary(data)}
+                    else:
+                        streams.pop(fd)
+            yield dict(returncode=process.wait())
+        finally:
+            if input_stream:
+                self.input_streams.pop(input_stream).close()
+            if process.poll() is None:
+                logger.warning("Terminating command because its output is no longer needed ..")
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+
+    def stream_native_output(self, output, input_stream=None):
+        """
+        Stream the output of a native command (see :func:`execute_streaming()`).
+
+        :param output: The output of the command (a string).
+        :param input_stream: The identifier of the input stream (a string or
+                             :data:`None`). Native commands don't read input,
+                             so the stream is confirmed but not created (the
+                             same as a command that exits right away).
+        :returns: A generator of dictionaries (see :func:`execute_streaming()`).
+        """
+        if input_stream:
+            yield dict(input_stream=input_stream)
+        if output:
+            yield dict(stdout=binary(output.encode('utf-8')))
+        yield dict(returncode=0)
+
+    def find_input_stream(self, input_stream):
+        """
+        Find the standard input stream of a command started by :func:`execute_streaming()`.
+
+        :param input_stream: The identifier of the input stream (a string).
+        :returns: An :class:`~negotiator_common.utils.InputStream` object.
+        :raises: :exc:`~exceptions.KeyError` when the input stream doesn't
+                 exist (for example because the command has already exited).
+        """
+        if input_stream not in self.input_streams:
+            raise KeyError("Input stream %s doesn't exist (the command may have exited)" % input_stream)
+        return self.input_streams[input_stream]
+
+    def write_input(self, input_stream, offset, data):
+        """
+        Write a chunk of input to a command started by :func:`execute_streaming()`.
+
+        :param input_stream: The identifier of the input stream (a string).
+        :param offset: The offset of the chunk in the input (an integer).
+        :param data: The input (a byte string).
+        :returns: The number of bytes written (an integer).
+
+        This method blocks until the command has consumed enough of its input
+        for the chunk to fit in the pipe buffer, which means the remote side
+        can't send input faster than the command consumes it. When requests
+        are handled concurrently the offset is used to write the chunks in
+        the right order.
+        """
+        if self.fork_server and input_stream not in self.input_streams:
+            # The command was started by the fork server.
+            return self.fork_server.write_input(input_stream, offset, data)
+        return self.find_input_stream(input_stream).write(offset, data)
+
+    def close_input(self, input_stream):
+        """
+        Close the standard input of a command started by :func:`execute_streaming()`.
+
+        :param input_stream: The identifier of the input stream (a string).
+        """
+        if self.fork_server and input_stream not in self.input_streams:
+            self.fork_server.close_input(input_stream)
+        else:
+            self.find_input_stream(input_stream).close()
+
+    def run_native_command(self, command):
+        """
+        Run the native implementation of a built-in command (see :mod:`negotiator_common.native`).
+
+        :param command: The command name and any arguments (a list of strings).
+        :returns: The output of the command (a string) or :data:`None` when
+                  the command doesn't have a native implementation, a user
+                  defined command overrides it or the native implementation
+                  failed (in these cases the program should be executed).
+        """
+        command_name = os.path.basename(command[0])
+        function = NATIVE_COMMANDS.get(command_name)
+        if function and not command_registry.is_user_command(command_name):
+            try:
+                return function(list(command[1:]))
+            except Exception as e:
+                logger.warning("Native implementation of %s failed, falling back to program! (%s)", command_name, e)
+        return None
+
+    def resolve_command(self, command):
+        """
+        Find the program that implements a user defined or built-in command.
+
+        :param command: The command name and any arguments (a list of strings).
+        :returns: The command line with the absolute pathname of the program
+                  (a list of strings).
+        """
+        command = list(command)
+        command[0] = command_registry.resolve(os.path.basename(command[0]))
+        return command
+
+
+class CachedResult(object):
+
+    """
+    The return value of a local method that was answered from a cache.
+
+    When a method called by the remote side returns a :class:`CachedResult`
+    object, :func:`~negotiator_common.NegotiatorInterface.handle_request()`
+    sends the wrapped value with ``cached=True`` in the response (see
+    :attr:`~negotiator_common.RemoteCall.cached`).
+    """
+
+    def __init__(self, value):
+        """
+        Initialize a :class:`CachedResult` object.
+
+        :param value: The cached return value.
+        """
+        self.value = value
+
+
+def start_process(command, environment):
+    """
+    Start a subprocess whose standard streams are connected to pipes.
+
+    :param command: The absolute pathname of the program and any arguments (a list of strings).
+    :param environment: Environment variables to set for the subprocess on
+                        top of the environment of the current process (a
+                        dictionary).
+    :returns: A :class:`subprocess.Popen` object.
+    """
+    merged_environment = dict(os.environ)
+    merged_environment.update(environment)
+    return subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=merged_environment,
+        close_fds=True,
+    )
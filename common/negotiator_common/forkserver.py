@@ -0,0 +1,203 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""
+Start commands from a small helper process.
+
+Starting a subprocess means forking the current process, and the cost of
+that grows with its memory: page tables are copied and every page that
+either process writes to afterwards is copied as well. The daemons keep
+growing while they run (worker threads, channels, buffers), so starting
+commands gets slower over time.
+
+The :class:`ForkServer` class forks a helper process while the daemon is
+still small and hands it the commands to start. The two processes are
+connected by a socket pair that uses the same protocol as the channels (see
+:class:`~negotiator_common.NegotiatorInterface`), so commands can run
+concurrently and their output is streamed back as it arrives. The fork
+server should be started before the daemon starts any threads, because
+forking a multi threaded process is unreliable.
+"""
+
+# Standard library modules.
+import errno
+import logging
+import os
+import socket
+
+# Modules included in our project.
+from negotiator_common import NegotiatorInterface
+from negotiator_common.broker import forward_call
+from negotiator_common.config import FORK_SERVER_CONCURRENCY
+from negotiator_common.execution import start_process
+from negotiator_common.serialization import binary
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+
+class ForkServer(object):
+
+    """Start commands using a helper process that was forked before the daemon grew."""
+
+    def __init__(self, concurrency=FORK_SERVER_CONCURRENCY):
+        """
+        Fork the helper process.
+
+        :param concurrency: The number of requests that the helper process
+                            handles at the same time (an integer, defaults to
+                            :data:`.FORK_SERVER_CONCURRENCY`).
+        """
+        parent_socket, child_socket = socket.socketpair()
+        self.pid = os.fork()
+        if self.pid == 0:
+            parent_socket.close()
+            serve_forever(child_socket, concurrency)
+        child_socket.close()
+        self.socket = parent_socket
+        self.returncode = None
+        self.channel = NegotiatorInterface(handle=parent_socket.makefile('rwb'),
+                                           label="fork server (pid %i)" % self.pid)
+        logger.info("Started fork server with pid %i.", self.pid)
+
+    def is_alive(self):
+        """
+        Check whether the helper process is still running.
+
+        :returns: :data:`True` if the helper process is running, :data:`False`
+                  otherwise (in this case callers should start commands
+                  themselves).
+        """
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except EnvironmentError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                # Another thread reaped the helper process.
+                pid, status = self.pid, None
+            if pid:
+                logger.warning("Fork server with pid %i died, starting commands directly!", self.pid)
+                self.returncode = status
+        return self.returncode is None
+
+    def execute(self, command, environment, input=None):
+        """
+        Execute a command and capture its output.
+
+        :param command: The absolute pathname of the program and any arguments (a list of strings).
+        :param environment: Environment variables to set for the command (a dictionary).
+        :param input: The input to feed to the command (a string or :data:`None`).
+        :returns: The output of the command (see :func:`~negotiator_common.execution.CommandExecutionMixin.execute()`).
+        """
+        return self.channel.call_remote_method('spawn', command, environment, input)
+
+    def execute_streaming(self, command, environment, input=None, input_stream=None):
+        """
+        Execute a command and stream its output.
+
+        :param command: The absolute pathname of the program and any arguments (a list of strings).
+        :param environment: Environment variables to set for the command (a dictionary).
+        :param input: The input to feed to the command (a string or :data:`None`).
+        :param input_stream: The identifier of the input stream of the command
+                             (a string or :data:`None`, see :func:`write_input()`).
+        :returns: A generator of dictionaries (see
+                  :func:`~negotiator_common.execution.CommandExecutionMixin.execute_streaming()`).
+        """
+        return forward_call(self.channel, 'spawn_streaming', [command, environment, input, input_stream], {})
+
+    def write_input(self, input_stream, offset, data):
+        """
+        Write a chunk of input to a command started by :func:`execute_streaming()`.
+
+        :param input_stream: The identifier of the input stream (a string).
+        :param offset: The offset of the chunk in the input (an integer).
+        :param data: The input (a byte string).
+        :returns: The number of bytes written (an integer).
+        """
+        return self.channel.call_remote_method('write_input', input_stream, offset, binary(data))
+
+    def close_input(self, input_stream):
+        """
+        Close the standard input of a command started by :func:`execute_streaming()`.
+
+        :param input_stream: The identifier of the input stream (a string).
+        """
+        self.channel.call_remote_method('close_input', input_stream)
+
+    def stop(self):
+        """Stop the helper process (commands that are still running are terminated)."""
+        try:
+            self.channel.conn_handle.close()
+        except EnvironmentError:
+            pass
+        self.socket.close()
+        if self.returncode is None:
+            try:
+                os.waitpid(self.pid, 0)
+            except EnvironmentError:
+                pass
+            self.returncode = 0
+
+
+class ForkServerSession(NegotiatorInterface):
+
+    """
+    The helper process side of a :class:`ForkServer`.
+
+    In addition to the methods inherited from
+    :class:`~negotiator_common.NegotiatorInterface` this class defines
+    :func:`spawn()` and :func:`spawn_streaming()`, which execute arbitrary
+    programs. This is why these methods aren't defined by the channels that
+    are exposed to the other side.
+    """
+
+    exported_methods = ('select_codec', 'spawn', 'spawn_streaming', 'write_input', 'close_input')
+    """The names of the methods that the daemon is allowed to call (a tuple of strings)."""
+
+    def spawn(self, command, environment, input=None):
+        """
+        Execute a command and capture its output.
+
+        :param command: The absolute pathname of the program and any arguments (a list of strings).
+        :param environment: Environment variables to set for the command (a dictionary).
+        :param input: The input to feed to the command (a string or :data:`None`).
+        :returns: The output of the command (a string).
+        """
+        from executor import execute
+        return execute(*command, input=input, environment=environment, capture=True, logger=logger)
+
+    def spawn_streaming(self, command, environment, input=None, input_stream=None):
+        """
+        Execute a command and stream its output.
+
+        :param command: The absolute pathname of the program and any arguments (a list of strings).
+        :param environment: Environment variables to set for the command (a dictionary).
+        :param input: The input to feed to the command (a string or :data:`None`).
+        :param input_stream: The identifier of the input stream of the command (a string or :data:`None`).
+        :returns: A generator of dictionaries (see
+                  :func:`~negotiator_common.execution.CommandExecutionMixin.execute_streaming()`).
+        """
+        return self.stream_process(start_process(command, environment), input, input_stream)
+
+
+def serve_forever(sock, concurrency):
+    """
+    Handle the requests of a :class:`ForkServer` in the helper process.
+
+    :param sock: The helper process end of the socket pair.
+    :param concurrency: The number of requests to handle at the same time (an integer).
+
+    The helper process exits when the daemon closes its end of the socket
+    pair (this function never returns).
+    """
+    try:
+        session = ForkServerSession(handle=sock.makefile('rwb'), label="fork server socket")
+        session.enter_main_loop(concurrency=concurrency)
+    except BaseException as e:
+        logger.debug("Fork server is exiting: %s", e)
+    finally:
+        os._exit(0)
@@ -0,0 +1,256 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""
+Native implementations of the built-in commands.
+
+The built-in commands in :data:`.BUILTIN_COMMANDS_DIRECTORY` are shell
+scripts that start programs like ``ip``, ``df`` and ``lsb_release``, so a
+single call starts several processes. The functions in this module produce
+the same output by reading ``/proc``, ``/etc/os-release`` and netlink
+directly, without starting any processes.
+
+:func:`~negotiator_common.execution.CommandExecutionMixin.execute()` and
+:func:`~negotiator_common.execution.CommandExecutionMixin.execute_streaming()` use the
+functions in :data:`NATIVE_COMMANDS` unless a user defined command with the
+same name exists in :data:`.USER_COMMANDS_DIRECTORY`. When a native
+implementation fails the shell script is used instead.
+"""
+
+# Standard library modules.
+import os
+import re
+import shlex
+import socket
+import struct
+
+NATIVE_COMMANDS = {}
+"""
+A dictionary that maps command names (strings) to functions.
+
+The functions are given the arguments of the command (a list of strings) and
+return the output of the command (a string).
+"""
+
+DISTRIBUTOR_IDS = {
+    'centos': 'CentOS',
+    'debian': 'Debian',
+    'fedora': 'Fedora',
+    'linuxmint': 'Linuxmint',
+    'raspbian': 'Raspbian',
+    'ubuntu': 'Ubuntu',
+}
+"""
+A dictionary that maps the ``ID`` field of ``/etc/os-release`` to the output of ``lsb_release -si``.
+
+Distributions that aren't listed here (for example Red Hat Enterprise Linux,
+where ``NAME`` is ``Red Hat Enterprise Linux`` and ``lsb_release`` reports
+a name that depends on the version) fall back to the ``lsb_release`` program.
+"""
+
+# Constants from <linux/netlink.h>, <linux/rtnetlink.h> and <linux/if_addr.h>.
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x01
+NLM_F_DUMP = 0x300
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+NLMSG_HEADER = struct.Struct('=LHHLL')
+"""The binary format of ``struct nlmsghdr``."""
+
+IFADDRMSG = struct.Struct('=BBBBL')
+"""The binary format of ``struct ifaddrmsg``."""
+
+RTATTR_HEADER = struct.Struct('=HH')
+"""The binary format of ``struct rtattr``."""
+
+
+def native_command(name):
+    """
+    Register a native implementation of a built-in command.
+
+    :param name: The name of the command (a string).
+    :returns: A decorator that adds the decorated function to :data:`NATIVE_COMMANDS`.
+    """
+    def decorator(function):
+        NATIVE_COMMANDS[name] = function
+        return function
+    return decorator
+
+
+@native_command('find-ip-addresses')
+def find_ip_addresses(arguments):
+    """Find the IPv4 addresses in use (in CIDR notation, one per line)."""
+    return ''.join('%s/%i\n' % (address, prefix_length) for address, prefix_length in get_ipv4_addresses())
+
+
+@native_command('find-disk-usage')
+def find_disk_usage(arguments):
+    """Find the disk usage of all mounted disk devices (the device file, mount point, total and used bytes)."""
+    lines = []
+    for device_file, mount_point in find_disk_mounts():
+        info = os.statvfs(mount_point)
+        if info.f_blocks:
+            bytes_total = info.f_blocks * info.f_frsize
+            bytes_used = (info.f_blocks - info.f_bfree) * info.f_frsize
+            lines.append('%s %s %i %i\n' % (device_file, mount_point, bytes_total, bytes_used))
+    return ''.join(lines)
+
+
+@native_command('find-distributor-id')
+def find_distributor_id(arguments):
+    """Find the distributor ID (a string like ``Ubuntu``)."""
+    return get_distribution_field('DISTRIB_ID') + '\n'
+
+
+@native_command('find-distribution-release')
+def find_distribution_release(arguments):
+    """Find the distribution release (a string like ``12.04``)."""
+    return get_distribution_field('DISTRIB_RELEASE') + '\n'
+
+
+@native_command('find-distribution-codename')
+def find_distribution_codename(arguments):
+    """Find the distribution codename (a string like ``precise``)."""
+    return get_distribution_field('DISTRIB_CODENAME') + '\n'
+
+
+def get_ipv4_addresses():
+    """
+    Get the IPv4 addresses of the network interfaces using netlink.
+
+    :returns: A list of tuples with two values each: The address (a string)
+              and the prefix length (an integer).
+    :raises: :exc:`~exceptions.EnvironmentError` when netlink isn't available.
+    """
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        payload = IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0)
+        sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), RTM_GETADDR,
+                                    NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + payload)
+        addresses = []
+        while True:
+            data = sock.recv(1024 * 64)
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, message_type, flags, sequence, pid = NLMSG_HEADER.unpack_from(data, offset)
+                if message_type == NLMSG_DONE:
+                    return addresses
+                elif message_type == NLMSG_ERROR:
+                    raise EnvironmentError("Netlink request for addresses failed!")
+                elif message_type == RTM_NEWADDR:
+                    family, prefix_length, flags, scope, index = IFADDRMSG.unpack_from(data, offset + NLMSG_HEADER.size)
+                    attributes = parse_attributes(data, offset + NLMSG_HEADER.size + IFADDRMSG.size, offset + length)
+                    address = attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS))
+                    if family == socket.AF_INET and address:
+                        addresses.append((socket.inet_ntoa(address), prefix_length))
+                offset += align(length)
+    finally:
+        sock.close()
+
+
+def parse_attributes(data, offset, end):
+    """
+    Parse the routing attributes of a netlink message.
+
+    :param data: The data received from netlink (a byte string).
+    :param offset: The offset of the first attribute (an integer).
+    :param end: The offset where the message ends (an integer).
+    :returns: A dictionary that maps attribute types (integers) to values (byte strings).
+    """
+    attributes = {}
+    while offset + RTATTR_HEADER.size <= end:
+        length, attribute_type = RTATTR_HEADER.unpack_from(data, offset)
+        if length < RTATTR_HEADER.size:
+            break
+        attributes[attribute_type] = data[offset + RTATTR_HEADER.size:offset + length]
+        offset += align(length)
+    return attributes
+
+
+def align(length):
+    """Round a netlink message or attribute length up to a multiple of four bytes."""
+    return (length + 3) & ~3
+
+
+def find_disk_mounts():
+    """
+    Find the mounted disk devices.
+
+    :returns: A list of tuples with two strings each: The device file and the
+              mount point. Like ``df`` every device is reported only once
+              (using its shortest mount point).
+    """
+    mounts = []
+    with open('/proc/mounts') as handle:
+        for line in handle:
+            fields = line.split()
+            if len(fields) >= 2:
+                device_file, mount_point = (unescape_mount_field(f) for f in fields[:2])
+                if device_file.startswith('/dev/') and mount_point.startswith('/'):
+                    for index, (other_device, other_mount_point) in enumerate(mounts):
+                        if other_device == device_file:
+                            if len(mount_point) < len(other_mount_point):
+                                mounts[index] = (device_file, mount_point)
+                            break
+                    else:
+                        mounts.append((device_file, mount_point))
+    return mounts
+
+
+def unescape_mount_field(value):
+    r"""Decode the octal escape sequences (like ``\040`` for a space) used in ``/proc/mounts``."""
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), value)
+
+
+def get_distribution_field(name):
+    """
+    Get information about the Linux distribution like ``lsb_release`` does.
+
+    :param name: One of the strings ``DISTRIB_ID``, ``DISTRIB_RELEASE`` or
+                 ``DISTRIB_CODENAME``.
+    :returns: The value of the field (a string).
+    :raises: :exc:`~exceptions.ValueError` when the field isn't available.
+
+    The field is read from ``/etc/lsb-release`` when it exists, otherwise it's
+    derived from ``/etc/os-release`` (as defined by systemd). The distributor
+    ID is only derived for the distributions in :data:`DISTRIBUTOR_IDS`.
+    """
+    value = read_shell_variables('/etc/lsb-release').get(name)
+    if not value:
+        os_release = read_shell_variables('/etc/os-release') or read_shell_variables('/usr/lib/os-release')
+        if name == 'DISTRIB_ID':
+            value = DISTRIBUTOR_IDS.get(os_release.get('ID'))
+        elif name == 'DISTRIB_RELEASE':
+            value = os_release.get('VERSION_ID')
+        elif name == 'DISTRIB_CODENAME':
+            value = os_release.get('VERSION_CODENAME')
+    if not value:
+        raise ValueError("Failed to determine %s of Linux distribution!" % name)
+    return value
+
+
+def read_shell_variables(filename):
+    """
+    Read a file with shell variable assignments like ``/etc/os-release``.
+
+    :param filename: The pathname of the file (a string).
+    :returns: A dictionary with variable names and values (strings), empty
+              when the file doesn't exist.
+    """
+    variables = {}
+    if os.path.isfile(filename):
+        with open(filename) as handle:
+            for line in handle:
+                name, _, value = line.strip().partition('=')
+                if name and not name.startswith('#') and value:
+                    variables[name] = ' '.join(shlex.split(value))
+    return variables
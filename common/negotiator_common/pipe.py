@@ -0,0 +1,166 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""
+Run many commands over a single channel by reading them from a stream.
+
+The command line programs connect to the other side for every invocation,
+which adds up when a shell script or configuration management system needs
+to run hundreds of commands. The :func:`run_pipe()` function reads requests
+from a stream (one request per line) and handles them all using the same
+channel. Each line is one of the following:
+
+- A shell command line like ``ls -l /tmp`` (split using :func:`shlex.split()`).
+
+- A JSON object with the key ``command`` (a list of strings or a shell
+  command line) and optionally the key ``input`` (a string that's passed to
+  the standard input of the command).
+
+- A JSON object with the key ``method`` (the name of a remote method) and
+  optionally the keys ``args`` (a list) and ``kw`` (an object).
+
+Empty lines and lines starting with ``#`` are ignored. The outcome of each
+request is written as a single line of JSON, the keys are ``returncode``,
+``stdout``, ``stderr``, ``error`` and ``elapsed`` for commands and
+``result``, ``error`` and ``elapsed`` for method calls. When a JSON request
+contains the key ``id`` its value is copied to the response, otherwise the
+line number is used.
+"""
+
+# Standard library modules.
+import io
+import json
+import logging
+import shlex
+
+# Modules included in our project.
+from negotiator_common import RemoteMethodFailed
+from negotiator_common.utils import TimeOut, Timer
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+
+def run_pipe(connect, input_stream, output_stream, timeout=0):
+    """
+    Handle the requests read from a stream using a single channel.
+
+    :param connect: A callable that takes no arguments and returns a
+                    :class:`~negotiator_common.NegotiatorInterface` object.
+                    It's called before the first request is handled and again
+                    after a request leaves the channel in an unknown state
+                    (because it timed out or the connection was lost).
+    :param input_stream: A text file like object with one request per line.
+    :param output_stream: A text file like object to which the responses are
+                          written (one JSON object per line).
+    :param timeout: The number of seconds before a single request times out
+                    (an integer, zero disables the timeout).
+    :returns: The number of requests that failed (an integer).
+    """
+    channel = None
+    failures = 0
+    line_number = 0
+    # Don't use `for line in input_stream' because Python 2 reads ahead,
+    # which would delay requests typed interactively.
+    for line in iter(input_stream.readline, ''):
+        line_number += 1
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        timer = Timer()
+        response = dict(id=line_number)
+        try:
+            request = parse_request(line)
+            response['id'] = request.get('id', line_number)
+            with TimeOut(timeout):
+                if channel is None:
+                    channel = connect()
+                if 'method' in request:
+                    response['method'] = request['method']
+                    response['result'] = channel.call_remote_method(
+                        request['method'], *request.get('args', ()), **request.get('kw', {})
+                    )
+                else:
+                    response['command'] = request['command']
+                    response.update(execute_request(channel, request))
+            response['error'] = None
+        except Exception as e:
+            # Socket timeouts are reported without a message.
+            response['error'] = str(e) or e.__class__.__name__
+            if channel is not None and not isinstance(e, (RemoteMethodFailed, ValueError)):
+                # The remote side may still respond to the request we gave up
+                # on, so we start over using a fresh connection.
+                logger.warning("Reconnecting after failed request on %s! (%s)", channel.conn_label, response['error'])
+                close = getattr(channel, 'close', None)
+                if close:
+                    close()
+                channel = None
+        if response['error'] or response.get('returncode'):
+            failures += 1
+        response['elapsed'] = timer.elapsed_time
+        output_stream.write(json.dumps(response, default=encode_bytes, sort_keys=True) + '\n')
+        output_stream.flush()
+    return failures
+
+
+def parse_request(line):
+    """
+    Parse a request read by :func:`run_pipe()`.
+
+    :param line: A single line of text without leading or trailing whitespace (a string).
+    :returns: A dictionary with the key ``command`` (a list of strings) or the
+              key ``method`` (a string).
+    :raises: :exc:`~exceptions.ValueError` when the request is invalid.
+    """
+    if not line.startswith('{'):
+        return dict(command=shlex.split(line))
+    request = json.loads(line)
+    if not isinstance(request, dict):
+        raise ValueError("Request must be a JSON object!")
+    if 'method' in request:
+        if not isinstance(request.get('args', []), list) or not isinstance(request.get('kw', {}), dict):
+            raise ValueError("The 'args' of a request must be a list and its 'kw' an object!")
+        return request
+    command = request.get('command')
+    if isinstance(command, type(u'')):
+        # JSON strings are decoded to Unicode strings (also on Python 2).
+        request['command'] = shlex.split(command)
+    elif not (isinstance(command, list) and command):
+        raise ValueError("Request must contain a 'command' or 'method' key!")
+    return request
+
+
+def execute_request(channel, request):
+    """
+    Execute a command from a request and capture its output.
+
+    :param channel: The :class:`~negotiator_common.NegotiatorInterface` object.
+    :param request: The dictionary returned by :func:`parse_request()`.
+    :returns: A dictionary with the keys ``returncode``, ``stdout`` and ``stderr``.
+    """
+    stdout = io.BytesIO()
+    stderr = io.BytesIO()
+    data = request.get('input')
+    returncode = channel.execute_remote_command(
+        request['command'], input=io.BytesIO(data.encode('utf-8')) if data is not None else None,
+        stdout=stdout, stderr=stderr,
+    )
+    return dict(returncode=returncode,
+                stdout=stdout.getvalue().decode('utf-8', 'replace'),
+                stderr=stderr.getvalue().decode('utf-8', 'replace'))
+
+
+def encode_bytes(value):
+    """
+    Enable :func:`json.dumps()` to encode the byte strings returned by remote methods.
+
+    :param value: The value that can't be encoded by default.
+    :returns: The decoded string.
+    :raises: :exc:`~exceptions.TypeError` when `value` isn't a byte string.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode('utf-8', 'replace')
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
@@ -0,0 +1,243 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""
+Pluggable encodings for the messages exchanged between hosts and guests.
+
+JSON is always available and is what older versions of `negotiator` speak.
+Faster (binary) encodings are used when the required Python package is
+installed on both sides of a channel:
+
+========  ===============  ===========================================
+Name      Python package   Notes
+========  ===============  ===========================================
+msgpack   msgpack_         Compact binary encoding, pure Python fallback.
+cbor      cbor2_           Compact binary encoding (:rfc:`7049`).
+orjson    orjson_          JSON compatible, but a lot faster.
+json      (built-in)       The fallback for peers that don't negotiate.
+========  ===============  ===========================================
+
+Binary strings embedded in messages are sent as attachments next to the encoded
+message, so they're transferred without being encoded (see
+:func:`extract_attachments()`).
+
+.. _cbor2: https://pypi.org/project/cbor2/
+.. _msgpack: https://pypi.org/project/msgpack/
+.. _orjson: https://pypi.org/project/orjson/
+"""
+
+# Standard library modules.
+import collections
+import importlib
+import json
+import logging
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+ATTACHMENT_KEY = '__attachment__'
+"""The dictionary key used for placeholders of attachments (a string)."""
+
+BINARY_TYPES = (bytearray, memoryview) if str is bytes else (bytes, bytearray, memoryview)
+"""
+The types of values that are sent as attachments (a tuple of types).
+
+On Python 2 the :class:`str` type is used for text as well as binary data,
+so there only :class:`bytearray` and :class:`memoryview` objects are sent
+as attachments.
+"""
+
+
+class JSONCodec(object):
+
+    """Encode messages using the :mod:`json` module from the standard library."""
+
+    name = 'json'
+
+    def encode(self, value):
+        """Encode a Python value as JSON (returns a byte string)."""
+        return json.dumps(value).encode('ascii')
+
+    def decode(self, data):
+        """Decode a JSON encoded byte string to a Python value."""
+        return json.loads(data.decode('utf-8'))
+
+
+class ExternalCodec(object):
+
+    """
+    Base class for codecs that depend on a Python package.
+
+    The package is imported when the codec is first used, because importing
+    packages that aren't used (for example because the remote side selected
+    a different codec) slows down the start-up of the command line programs.
+    """
+
+    module_name = None
+    """The name of the Python package that implements the codec (a string)."""
+
+    def __init__(self):
+        """Check whether the Python package is installed (raises :exc:`~exceptions.ImportError` when it's not)."""
+        if not module_available(self.module_name):
+            raise ImportError("No module named %s" % self.module_name)
+        self.loaded_module = None
+
+    @property
+    def module(self):
+        """The Python package that implements the codec (imported on first use)."""
+        if self.loaded_module is None:
+            self.loaded_module = importlib.import_module(self.module_name)
+        return self.loaded_module
+
+
+class OrJSONCodec(ExternalCodec):
+
+    """Encode messages using the orjson_ package."""
+
+    name = 'orjson'
+    module_name = 'orjson'
+
+    def encode(self, value):
+        """Encode a Python value as JSON (returns a byte string)."""
+        return self.module.dumps(value)
+
+    def decode(self, data):
+        """Decode a JSON encoded byte string to a Python value."""
+        return self.module.loads(data)
+
+
+class MessagePackCodec(ExternalCodec):
+
+    """Encode messages using the msgpack_ package."""
+
+    name = 'msgpack'
+    module_name = 'msgpack'
+
+    def encode(self, value):
+        """Encode a Python value using MessagePack (returns a byte string)."""
+        return self.module.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+        """Decode a MessagePack encoded byte string to a Python value."""
+        return self.module.unpackb(data, raw=False)
+
+
+class CBORCodec(ExternalCodec):
+
+    """Encode messages using the cbor2_ package."""
+
+    name = 'cbor'
+    module_name = 'cbor2'
+
+    def encode(self, value):
+        """Encode a Python value using CBOR (returns a byte string)."""
+        return self.module.dumps(value)
+
+    def decode(self, data):
+        """Decode a CBOR encoded byte string to a Python value."""
+        return self.module.loads(data)
+
+
+def binary(data):
+    """
+    Mark a byte string as binary data so that it's sent as an attachment.
+
+    :param data: A byte string.
+    :returns: On Python 3 the byte string is returned as is, on Python 2 it is
+              converted to a :class:`bytearray` (see :data:`BINARY_TYPES`).
+    """
+    return data if isinstance(data, BINARY_TYPES) else bytearray(data)
+
+
+def extract_attachments(value, attachments):
+    """
+    Replace binary strings in a message with placeholders.
+
+    :param value: The Python value to be encoded.
+    :param attachments: A list to which binary strings are appended.
+    :returns: A copy of the value where binary strings (see
+              :data:`BINARY_TYPES`) have been replaced with placeholder
+              dictionaries that give the index of the attachment.
+
+    Dictionaries that contain the key :data:`ATTACHMENT_KEY` themselves are
+    wrapped in a list (placeholders contain an integer) so that they're not
+    mistaken for placeholders by :func:`restore_attachments()`.
+    """
+    if isinstance(value, BINARY_TYPES):
+        attachments.append(value)
+        return {ATTACHMENT_KEY: len(attachments) - 1}
+    elif isinstance(value, dict):
+        extracted = dict((k, extract_attachments(v, attachments)) for k, v in value.items())
+        return {ATTACHMENT_KEY: [extracted]} if ATTACHMENT_KEY in value else extracted
+    elif isinstance(value, (list, tuple)):
+        return [extract_attachments(v, attachments) for v in value]
+    else:
+        return value
+
+
+def restore_attachments(value, attachments):
+    """
+    Replace the placeholders in a decoded message with their attachments.
+
+    :param value: The decoded Python value.
+    :param attachments: A list of byte strings.
+    :returns: A copy of the value where placeholders have been replaced with
+              the attachments they refer to.
+    """
+    if isinstance(value, dict):
+        if len(value) == 1 and ATTACHMENT_KEY in value:
+            if isinstance(value[ATTACHMENT_KEY], list):
+                # A dictionary wrapped by extract_attachments().
+                value = value[ATTACHMENT_KEY][0]
+            else:
+                return attachments[value[ATTACHMENT_KEY]]
+        return dict((k, restore_attachments(v, attachments)) for k, v in value.items())
+    elif isinstance(value, list):
+        return [restore_attachments(v, attachments) for v in value]
+    else:
+        return value
+
+
+def module_available(name):
+    """
+    Check whether a Python module is installed without importing it.
+
+    :param name: The name of the module (a string).
+    :returns: :data:`True` if the module can be imported, :data:`False` otherwise.
+    """
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        # Python 2.
+        import imp
+        try:
+            imp.find_module(name)
+            return True
+        except ImportError:
+            return False
+    return find_spec(name) is not None
+
+
+def find_available_codecs():
+    """
+    Find the codecs whose Python packages are installed.
+
+    :returns: An ordered dictionary with codec names (strings) as keys and
+              codec objects as values.
+    """
+    available_codecs = collections.OrderedDict()
+    for codec_class in (MessagePackCodec, CBORCodec, OrJSONCodec, JSONCodec):
+        try:
+            codec = codec_class()
+        except ImportError:
+            logger.debug("Codec %s unavailable (Python package not installed).", codec_class.name)
+        else:
+            available_codecs[codec.name] = codec
+    return available_codecs
+
+
+AVAILABLE_CODECS = find_available_codecs()
+"""An ordered dictionary with the codecs that can be used in this process (see :func:`find_available_codecs()`)."""
@@ -0,0 +1,894 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""Test suite for the code shared between the host and guest sides of negotiator."""
+
+# Standard library modules.
+import functools
+import hashlib
+import io
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+
+# Modules included in our project.
+from negotiator_common import NegotiatorInterface, ProtocolError, RemoteMethodFailed, RemoteMethodUnsupported
+from negotiator_common.broker import (
+    MAX_BUFFERED_CHUNKS,
+    BrokerClient,
+    BrokerSession,
+    ControlServer,
+    SingleFlight,
+    forward_call,
+)
+from negotiator_common.config import FILE_CHUNK_SIZE
+from negotiator_common.eventloop import ChannelReader, EventLoop, FrameParser
+from negotiator_common.serialization import ATTACHMENT_KEY, AVAILABLE_CODECS, binary
+from negotiator_common.transfer import (
+    SIGNATURE_FORMAT,
+    compute_delta,
+    get_temporary_file,
+    parse_signatures,
+    pull_file,
+    push_file,
+    sync_file,
+)
+from negotiator_common.utils import TimeOut, WorkerPool
+
+
+class LoopbackTestCase(unittest.TestCase):
+
+    """Base class for tests that talk to a :class:`~negotiator_common.NegotiatorInterface` over a socket pair."""
+
+    def setUp(self):
+        """Prepare to clean up the sockets created by :func:`connect()`."""
+        self.sockets = []
+
+    def tearDown(self):
+        """Close the sockets created by :func:`connect()`."""
+        for sock in self.sockets:
+            sock.close()
+
+    def connect(self, server, client_class=NegotiatorInterface, **options):
+        """
+        Connect a client to a server over a socket pair.
+
+        :param server: A callable that's given a binary file like object and
+                       a label and returns the server object.
+        :param client_class: The class of the client object.
+        :param options: Keyword arguments for the main loop of the server.
+        :returns: A tuple with the server and client objects.
+        """
+        server_socket, client_socket = socket.socketpair()
+        self.sockets.extend((server_socket, client_socket))
+        server_object = server(server_socket.makefile('rwb'), 'server')
+        client_object = client_class(client_socket.makefile('rwb'), 'client')
+        thread = threading.Thread(target=self.serve, args=(server_object, options))
+        thread.daemon = True
+        thread.start()
+        return server_object, client_object
+
+    def serve(self, server, options):
+        """Run the main loop of a server until the client disconnects."""
+        try:
+            server.enter_main_loop(**options)
+        except Exception:
+            pass
+
+
+class EchoInterface(NegotiatorInterface):
+
+    """Server with methods that return their arguments."""
+
+    exported_methods = NegotiatorInterface.exported_methods + ('echo', 'delayed_echo')
+
+    def echo(self, value):
+        """Return the given value."""
+        return value
+
+    def delayed_echo(self, delay, value):
+        """Return the given value after a delay (in seconds)."""
+        time.sleep(delay)
+        return value
+
+
+class PipeliningTestCase(LoopbackTestCase):
+
+    """Test that many calls can be in flight on a single channel."""
+
+    def test_responses_out_of_order(self):
+        """Make sure responses are matched to their calls by request ID, even when they arrive out of order."""
+        server, client = self.connect(EchoInterface, concurrency=4)
+        with TimeOut(10):
+            slow_call = client.start_remote_call('delayed_echo', 1, 'slow')
+            fast_call = client.start_remote_call('delayed_echo', 0, 'fast')
+            assert slow_call.request_id != fast_call.request_id
+            assert fast_call.wait() == 'fast'
+            assert not slow_call.done
+            assert slow_call.wait() == 'slow'
+
+    def test_concurrent_callers(self):
+        """Make sure threads that share a channel each get their own responses."""
+        server, client = self.connect(EchoInterface, concurrency=4)
+        results = {}
+
+        def worker(index):
+            results[index] = [client.call_remote_method('delayed_echo', 0.01, [index, i]) for i in range(10)]
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        assert results == dict((index, [[index, i] for i in range(10)]) for index in range(8))
+        assert not client.pending_calls
+
+
+class LegacyInterface(EchoInterface):
+
+    """Server that doesn't support codec negotiation and batch calls (like older releases)."""
+
+    exported_methods = tuple(m for m in EchoInterface.exported_methods if m not in ('select_codec', 'call_batch'))
+
+
+class CodecTestCase(LoopbackTestCase):
+
+    """Test the negotiation of codecs over a socket pair."""
+
+    message = dict(text=u'\u20ac', numbers=[1, -2, 2.5], flags=[True, False, None], nested={'key': ['value']})
+
+    def test_preferred_codec_selected(self):
+        """Make sure the first codec that's available on both sides is selected."""
+        server, client = self.connect(EchoInterface)
+        with TimeOut(10):
+            assert client.call_remote_method('echo', self.message) == self.message
+        assert client.codec == next(name for name in client.preferred_codecs if name in AVAILABLE_CODECS)
+
+    def test_available_codecs(self):
+        """Make sure messages survive a round trip using every available codec."""
+        for name in AVAILABLE_CODECS:
+            server, client = self.connect(EchoInterface)
+            client.preferred_codecs = (name,)
+            with TimeOut(10):
+                assert client.call_remote_method('echo', self.message) == self.message
+            assert client.codec == name
+
+    def test_unknown_codecs_ignored(self):
+        """Make sure JSON is used when no other codec is available on both sides."""
+        server, client = self.connect(EchoInterface)
+        client.preferred_codecs = ('bogus',)
+        with TimeOut(10):
+            assert client.call_remote_method('echo', self.message) == self.message
+        assert client.codec == 'json'
+
+    def test_fallback_without_negotiation(self):
+        """Make sure plain JSON is used when the remote side doesn't support codec negotiation."""
+        server, client = self.connect(LegacyInterface)
+        with TimeOut(10):
+            assert client.call_remote_method('echo', self.message) == self.message
+        assert client.codec_negotiated
+        assert client.codec is None
+
+
+class BatchTestCase(LoopbackTestCase):
+
+    """Test calling many methods in a single round trip over a socket pair."""
+
+    calls = [
+        ('echo', [1]),
+        ('echo', [], dict(value=2)),
+        ('echo', [1, 2, 3]),
+        ('bogus',),
+        ('delayed_echo', [0.1, 'last']),
+    ]
+
+    def check_results(self, calls):
+        """Check the results of :attr:`calls`."""
+        assert [call.method for call in calls] == [c[0] for c in self.calls]
+        assert calls[0].get_result() == 1
+        assert calls[1].get_result() == 2
+        self.assertRaises(RemoteMethodFailed, calls[2].get_result)
+        self.assertRaises(RemoteMethodUnsupported, calls[3].get_result)
+        assert calls[4].get_result() == 'last'
+
+    def test_batch(self):
+        """Make sure the calls in a batch succeed or fail independently and in order."""
+        for parallel in (False, True):
+            server, client = self.connect(EchoInterface)
+            with TimeOut(10):
+                self.check_results(client.call_remote_batch(self.calls, parallel=parallel))
+            assert client.batch_supported
+
+    def test_parallel_batch(self):
+        """Make sure the calls in a parallel batch run at the same time."""
+        server, client = self.connect(EchoInterface)
+        with TimeOut(10):
+            started = time.time()
+            calls = client.call_remote_batch([('delayed_echo', [0.5, i]) for i in range(4)], parallel=True)
+            assert [call.get_result() for call in calls] == list(range(4))
+            assert time.time() - started < 1.5
+
+    def test_fallback_without_batch(self):
+        """Make sure separate calls are sent when the remote side doesn't support batch calls."""
+        server, client = self.connect(LegacyInterface)
+        with TimeOut(10):
+            self.check_results(client.call_remote_batch(self.calls))
+            assert not client.batch_supported
+            self.check_results(client.call_remote_batch(self.calls))
+
+
+class EventLoopTestCase(LoopbackTestCase):
+
+    """Test the handling of requests by an :class:`~negotiator_common.eventloop.EventLoop`."""
+
+    def test_frame_parser(self):
+        """Make sure messages are parsed correctly no matter how the data is split up."""
+        buffer = io.BytesIO()
+        writer = NegotiatorInterface(buffer, 'buffer')
+        messages = [
+            (dict(id=1, result=binary(b'data'), nested=[binary(b'more')]), 'json'),
+            (dict(id=2, result=u'\u20ac'), None),
+        ] + [(dict(id=3, result=list(range(10))), name) for name in AVAILABLE_CODECS]
+        for message, codec in messages:
+            writer.write(message, codec=codec)
+        data = buffer.getvalue()
+        parser = FrameParser()
+        parsed = []
+        for i in range(len(data)):
+            parsed.extend(parser.feed(data[i:i + 1]))
+        assert parsed == messages
+        assert FrameParser().feed(data) == messages
+        self.assertRaises(ProtocolError, FrameParser().feed, b'bogus\n')
+
+    def connect_reader(self, server):
+        """
+        Connect a client to a server whose requests are read by a :class:`~negotiator_common.eventloop.ChannelReader`.
+
+        :param server: The class of the server object.
+        :returns: A tuple with the channel reader and the client object.
+        """
+        server_socket, client_socket = socket.socketpair()
+        self.sockets.extend((server_socket, client_socket))
+        event_loop = EventLoop()
+        reader = ChannelReader(server(server_socket.makefile('rwb'), 'server'),
+                               server_socket, event_loop, WorkerPool(4))
+        reader.start()
+        thread = threading.Thread(target=event_loop.run_until, args=(30, lambda: not reader.is_alive()))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(reader.terminate)
+        return reader, NegotiatorInterface(client_socket.makefile('rwb'), 'client')
+
+    def test_channel_reader(self):
+        """Make sure requests with request IDs are handled concurrently."""
+        reader, client = self.connect_reader(EchoInterface)
+        with TimeOut(10):
+            slow_call = client.start_remote_call('delayed_echo', 0.5, 'slow')
+            assert client.call_remote_method('echo', 'fast') == 'fast'
+            assert not slow_call.done
+            assert slow_call.wait() == 'slow'
+        assert reader.requests_handled >= 2
+
+    def test_requests_without_ids(self):
+        """Make sure requests without request IDs are answered in order."""
+        reader, client = self.connect_reader(EchoInterface)
+        with TimeOut(10):
+            client.write(dict(method='delayed_echo', args=[0.5, 'first']))
+            client.write(dict(method='echo', args=['second']))
+            assert client.read()['result'] == 'first'
+            assert client.read()['result'] == 'second'
+
+    def test_disconnect(self):
+        """Make sure the channel reader stops when the remote side disconnects."""
+        reader, client = self.connect_reader(EchoInterface)
+        client.conn_handle.close()
+        self.sockets[-1].close()
+        with TimeOut(10):
+            while reader.is_alive():
+                time.sleep(0.1)
+
+
+class AsyncTestCase(LoopbackTestCase):
+
+    """Test :class:`~negotiator_common.aio.AsyncNegotiatorInterface` against the blocking implementation."""
+
+    def setUp(self):
+        """Create an event loop (the :mod:`asyncio` implementation requires Python 3.6 or newer)."""
+        super(AsyncTestCase, self).setUp()
+        if sys.version_info[:2] < (3, 6):
+            self.skipTest("asyncio implementation requires Python 3.6 or newer")
+        import asyncio
+        from negotiator_common.aio import AsyncNegotiatorInterface
+        self.asyncio = asyncio
+        self.interface_class = AsyncNegotiatorInterface
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+
+    def run_coroutine(self, coroutine):
+        """Run a coroutine in the event loop (with a timeout) and return its result."""
+        return self.loop.run_until_complete(self.asyncio.wait_for(coroutine, 10))
+
+    def create_channel(self, sock):
+        """Create an :class:`~negotiator_common.aio.AsyncNegotiatorInterface` connected to a socket."""
+        async_reader, async_writer = self.run_coroutine(self.asyncio.open_connection(sock=sock))
+        channel = self.interface_class(async_reader, async_writer, 'async')
+        channel.exported_methods = EchoInterface.exported_methods
+        channel.echo = functools.partial(EchoInterface.echo, channel)
+        channel.delayed_echo = functools.partial(EchoInterface.delayed_echo, channel)
+        return channel
+
+    def connect_async_client(self, server, **options):
+        """Connect an asynchronous client to a blocking server."""
+        server_socket, client_socket = socket.socketpair()
+        self.sockets.extend((server_socket, client_socket))
+        server_object = server(server_socket.makefile('rwb'), 'server')
+        thread = threading.Thread(target=self.serve, args=(server_object, options))
+        thread.daemon = True
+        thread.start()
+        client = self.create_channel(client_socket)
+        self.addCleanup(self.run_coroutine, client.close())
+        return client
+
+    def collect(self, call):
+        """Get the partial results of an :class:`~negotiator_common.aio.AsyncRemoteCall` (a list)."""
+        values = []
+        stream = call.stream()
+        while True:
+            try:
+                values.append(self.run_coroutine(stream.__anext__()))
+            except StopAsyncIteration:
+                return values
+
+    def test_async_client(self):
+        """Make sure an asynchronous client can call the methods of a blocking server."""
+        client = self.connect_async_client(EchoInterface)
+        value = dict(data=binary(b'\x00\xff'), nested={ATTACHMENT_KEY: 0})
+        assert self.run_coroutine(client.call_remote_method('echo', value)) == value
+        assert client.codec == next(name for name in client.preferred_codecs if name in AVAILABLE_CODECS)
+        calls = self.run_coroutine(client.call_remote_batch([('echo', ['batch']), ('bogus',)]))
+        assert calls[0].get_result() == 'batch'
+        self.assertRaises(RemoteMethodUnsupported, calls[1].get_result)
+        client = self.connect_async_client(StreamingInterface)
+        call = self.run_coroutine(client.start_remote_call('slow_stream', 3))
+        assert self.collect(call) == [0, 1, 2]
+
+    def test_async_pipelining(self):
+        """Make sure an asynchronous client can have many calls in flight at the same time."""
+        client = self.connect_async_client(EchoInterface, concurrency=4)
+        started = time.time()
+        results = self.run_coroutine(self.asyncio.gather(*[
+            client.call_remote_method('delayed_echo', 0.5, i) for i in range(4)
+        ]))
+        assert results == list(range(4))
+        assert time.time() - started < 1.5
+
+    def test_async_server(self):
+        """Make sure a blocking client can call the methods of an asynchronous server."""
+        server_socket, client_socket = socket.socketpair()
+        self.sockets.extend((server_socket, client_socket))
+        server = self.create_channel(server_socket)
+        thread = threading.Thread(target=self.loop.run_until_complete, args=(server.enter_main_loop(),))
+        thread.start()
+        client = NegotiatorInterface(client_socket.makefile('rwb'), 'client')
+        try:
+            with TimeOut(10):
+                assert client.call_remote_method('echo', binary(b'data')) == b'data'
+                started = time.time()
+                calls = client.call_remote_batch([('delayed_echo', [0.5, i]) for i in range(4)], parallel=True)
+                assert [call.get_result() for call in calls] == list(range(4))
+                assert time.time() - started < 1.5
+                self.assertRaises(RemoteMethodUnsupported, client.call_remote_method, 'bogus')
+            assert client.codec == next(name for name in client.preferred_codecs if name in AVAILABLE_CODECS)
+        finally:
+            client.conn_handle.close()
+            client_socket.close()
+            thread.join(10)
+        assert not thread.is_alive()
+
+
+class AttachmentTestCase(LoopbackTestCase):
+
+    """Test binary data sent as attachments over a socket pair."""
+
+    def round_trip(self, value):
+        """Send a value to an :class:`EchoInterface` using every available codec and check the responses."""
+        for name in AVAILABLE_CODECS:
+            server, client = self.connect(EchoInterface)
+            client.preferred_codecs = (name,)
+            with TimeOut(10):
+                result = client.call_remote_method('echo', value)
+            assert result == value, "Unexpected result using %s codec!" % name
+
+    def test_binary_data(self):
+        """Make sure arbitrary bytes embedded in messages survive a round trip."""
+        data = bytes(bytearray(range(256)))
+        self.round_trip(dict(data=binary(data), chunks=[binary(data[:10]), binary(b''), binary(data)]))
+
+    def test_placeholder_lookalikes(self):
+        """Make sure dictionaries that look like placeholders aren't mistaken for attachments."""
+        self.round_trip([{ATTACHMENT_KEY: 0}, {ATTACHMENT_KEY: [{ATTACHMENT_KEY: 1}]}, binary(b'data')])
+        self.round_trip(dict(nested={ATTACHMENT_KEY: 5, 'other': binary(b'data')}))
+
+
+class FileTransferTestCase(LoopbackTestCase):
+
+    """Test the methods of :class:`~negotiator_common.transfer.FileTransferMixin` over a socket pair."""
+
+    def setUp(self):
+        """Create a temporary transfer directory and a temporary local directory."""
+        super(FileTransferTestCase, self).setUp()
+        self.transfer_directory = tempfile.mkdtemp()
+        self.local_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the temporary directories."""
+        super(FileTransferTestCase, self).tearDown()
+        shutil.rmtree(self.transfer_directory)
+        shutil.rmtree(self.local_directory)
+
+    def create_server(self, handle, label):
+        """Create a server that uses the temporary transfer directory."""
+        server = NegotiatorInterface(handle, label)
+        server.transfer_directory = self.transfer_directory
+        return server
+
+    def create_file(self, directory, name, contents):
+        """Create a file with the given contents and return its pathname."""
+        pathname = os.path.join(directory, name)
+        with open(pathname, 'wb') as handle:
+            handle.write(contents)
+        return pathname
+
+    def read_file(self, directory, name):
+        """Get the contents of a file."""
+        with open(os.path.join(directory, name), 'rb') as handle:
+            return handle.read()
+
+    def test_push_and_pull(self):
+        """Make sure files that span several chunks are copied to and from the remote side."""
+        contents = os.urandom(FILE_CHUNK_SIZE * 2 + 100)
+        pathname = self.create_file(self.local_directory, 'local.bin', contents)
+        server, client = self.connect(self.create_server)
+        with TimeOut(30):
+            assert push_file(client, pathname, 'remote.bin') == len(contents)
+            assert self.read_file(self.transfer_directory, 'remote.bin') == contents
+            copy = os.path.join(self.local_directory, 'copy.bin')
+            assert pull_file(client, 'remote.bin', copy) == len(contents)
+        assert self.read_file(self.local_directory, 'copy.bin') == contents
+        assert sorted(os.listdir(self.local_directory)) == ['copy.bin', 'local.bin']
+        assert os.listdir(self.transfer_directory) == ['remote.bin']
+
+    def test_corrupted_chunk(self):
+        """Make sure chunks whose CRC32 checksum doesn't match are rejected."""
+        contents = b'x' * 100
+        checksum = hashlib.sha256(contents).hexdigest()
+        server, client = self.connect(self.create_server)
+        with TimeOut(10):
+            client.call_remote_method('start_upload', 'file.bin', len(contents), checksum)
+            self.assertRaises(RemoteMethodFailed, client.call_remote_method, 'write_file_chunk',
+                              'file.bin', checksum, 0, binary(contents), zlib.crc32(b'y' * 100) & 0xffffffff)
+
+    def test_push_resumed(self):
+        """Make sure an interrupted upload is resumed instead of starting over."""
+        contents = os.urandom(FILE_CHUNK_SIZE * 2)
+        checksum = hashlib.sha256(contents).hexdigest()
+        pathname = self.create_file(self.local_directory, 'local.bin', contents)
+        server, client = self.connect(self.create_server)
+        with TimeOut(30):
+            client.call_remote_method('start_upload', 'remote.bin', len(contents), checksum)
+            first_chunk = contents[:FILE_CHUNK_SIZE]
+            client.call_remote_method('write_file_chunk', 'remote.bin', checksum, 0,
+                                      binary(first_chunk), zlib.crc32(first_chunk) & 0xffffffff)
+            assert push_file(client, pathname, 'remote.bin') == len(contents) - FILE_CHUNK_SIZE
+        assert self.read_file(self.transfer_directory, 'remote.bin') == contents
+
+    def test_pull_resumed(self):
+        """Make sure an interrupted download is resumed instead of starting over."""
+        contents = os.urandom(FILE_CHUNK_SIZE * 2)
+        self.create_file(self.transfer_directory, 'remote.bin', contents)
+        pathname = os.path.join(self.local_directory, 'local.bin')
+        temporary_file = get_temporary_file(pathname, hashlib.sha256(contents).hexdigest())
+        self.create_file(self.local_directory, os.path.basename(temporary_file), contents[:FILE_CHUNK_SIZE])
+        server, client = self.connect(self.create_server)
+        with TimeOut(30):
+            assert pull_file(client, 'remote.bin', pathname) == len(contents) - FILE_CHUNK_SIZE
+        assert self.read_file(self.local_directory, 'local.bin') == contents
+
+    def test_compute_delta(self):
+        """Make sure blocks are found in a file regardless of their offset."""
+        blocks = [b'B' * 16, b'A' * 16]
+        signatures = parse_signatures(b''.join(SIGNATURE_FORMAT.pack(
+            zlib.adler32(block) & 0xffffffff, hashlib.md5(block).digest(),
+        ) for block in blocks))
+        contents = b'A' * 16 + b'xyz' + b'B' * 16 + b'z'
+        assert list(compute_delta(contents, len(contents), signatures, 16)) == [
+            ('copy', 1), ('literal', 16, 19), ('copy', 0), ('literal', 35, 36),
+        ]
+
+    def test_sync_changed_file(self):
+        """Make sure only the data that changed is sent when a file is synchronized."""
+        basis = os.urandom(1024 * 64)
+        self.create_file(self.transfer_directory, 'remote.bin', basis)
+        contents = basis[:1000] + b'inserted' + basis[1000:50000] + basis[51000:]
+        pathname = self.create_file(self.local_directory, 'local.bin', contents)
+        server, client = self.connect(self.create_server)
+        with TimeOut(30):
+            sent_bytes = sync_file(client, pathname, 'remote.bin', block_size=1024)
+        assert sent_bytes < 1024 * 4
+        assert self.read_file(self.transfer_directory, 'remote.bin') == contents
+
+    def test_sync_new_file(self):
+        """Make sure the whole file is sent when the remote side doesn't have a copy."""
+        contents = os.urandom(1024 * 64)
+        pathname = self.create_file(self.local_directory, 'local.bin', contents)
+        server, client = self.connect(self.create_server)
+        with TimeOut(30):
+            assert sync_file(client, pathname, 'remote.bin', block_size=1024) == len(contents)
+        assert self.read_file(self.transfer_directory, 'remote.bin') == contents
+
+    def test_apply_delta_bad_block(self):
+        """Make sure delta instructions that point past the end of the existing file are rejected."""
+        with open(os.path.join(self.transfer_directory, 'basis.bin'), 'wb') as handle:
+            handle.write(b'x' * 64)
+        contents = b'y' * 64
+        checksum = hashlib.sha256(contents).hexdigest()
+        server, client = self.connect(self.create_server)
+        with TimeOut(10):
+            client.call_remote_method('start_upload', 'basis.bin', len(contents), checksum)
+            for instruction in ([5, 1], [0, 5], [-1, 1]):
+                self.assertRaises(RemoteMethodFailed, client.call_remote_method,
+                                  'apply_delta', 'basis.bin', checksum, 0, [instruction], 16)
+
+    def test_invalid_checksum(self):
+        """Make sure invalid checksums are rejected before they're used in a pathname."""
+        server, client = self.connect(self.create_server)
+        with TimeOut(10):
+            for checksum in ('../../etc/passwd', 'A' * 64, '0' * 63, '0' * 64 + '\n', 42):
+                self.assertRaises(RemoteMethodFailed, client.call_remote_method,
+                                  'start_upload', 'file.bin', 0, checksum)
+            assert client.call_remote_method('start_upload', 'file.bin', 0, '0' * 64) == 0
+        assert os.listdir(self.transfer_directory) == ['.file.bin.%s.part' % ('0' * 16)]
+
+
+class StreamingInterface(NegotiatorInterface):
+
+    """Server that keeps track of the number of streaming responses in progress."""
+
+    exported_methods = NegotiatorInterface.exported_methods + ('slow_stream', 'broken_stream')
+
+    def __init__(self, *args, **kw):
+        """Initialize a :class:`StreamingInterface` object."""
+        super(StreamingInterface, self).__init__(*args, **kw)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+
+    def slow_stream(self, count):
+        """Produce a few values slowly."""
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        return self.generate(count)
+
+    def generate(self, count):
+        """Generate the values for :func:`slow_stream()`."""
+        try:
+            for i in range(count):
+                time.sleep(0.05)
+                yield i
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def broken_stream(self):
+        """Produce a value and then fail."""
+        yield 'first'
+        raise ValueError("Stream broken!")
+
+
+class SystemCommandInterface(NegotiatorInterface):
+
+    """Server that runs programs on the ``$PATH`` instead of negotiator commands."""
+
+    def resolve_command(self, command):
+        """Run the given program without looking for a negotiator command."""
+        return list(command)
+
+
+class StreamingTestCase(LoopbackTestCase):
+
+    """Test streaming responses over a socket pair."""
+
+    def test_partial_results(self):
+        """Make sure the values produced by a streaming method arrive before the method returns."""
+        server, client = self.connect(StreamingInterface)
+        with TimeOut(10):
+            call = client.start_remote_call('slow_stream', 3)
+            client.wait_for_response(call, partial=True)
+            assert not call.done
+            assert call.partial_results.popleft() == 0
+            assert list(call.stream()) == [1, 2]
+            assert call.done
+
+    def test_stream_failure(self):
+        """Make sure a streaming method that fails halfway reports the values it produced and the error."""
+        server, client = self.connect(StreamingInterface)
+        values = []
+        with TimeOut(10):
+            call = client.start_remote_call('broken_stream')
+            try:
+                for value in call.stream():
+                    values.append(value)
+            except RemoteMethodFailed as e:
+                assert "Stream broken!" in str(e)
+            else:
+                assert False, "Expected RemoteMethodFailed to be raised!"
+        assert values == ['first']
+
+    def test_command_output(self):
+        """Make sure the output streams and exit code of a remote command are reported separately."""
+        server, client = self.connect(SystemCommandInterface)
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        with TimeOut(10):
+            returncode = client.execute_remote_command(['sh', '-c', 'echo out; echo err >&2; exit 3'],
+                                                       stdout=stdout, stderr=stderr)
+        assert returncode == 3
+        assert stdout.getvalue() == b'out\n'
+        assert stderr.getvalue() == b'err\n'
+
+    def test_concurrent_input_streams(self):
+        """Make sure commands reading input don't wait for each other, even when requests are handled one at a time."""
+        server, client = self.connect(SystemCommandInterface)
+        data = os.urandom(1024 * 512)
+        outputs = [io.BytesIO(), io.BytesIO()]
+
+        def run(output):
+            client.execute_remote_command(['cat'], input=io.BytesIO(data), stdout=output, stderr=io.BytesIO())
+
+        threads = [threading.Thread(target=run, args=(output,)) for output in outputs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(20)
+        assert all(output.getvalue() == data for output in outputs)
+
+    def test_streaming_responses_limited(self):
+        """Make sure pipelined streaming calls don't all run at the same time."""
+        server, client = self.connect(StreamingInterface, concurrency=2)
+        with TimeOut(20):
+            calls = [client.start_remote_call('slow_stream', 3) for i in range(6)]
+            for call in calls:
+                assert list(call.stream()) == [0, 1, 2]
+        # Two responses are streamed while two worker threads wait for them.
+        assert server.peak == 4
+
+
+class CountingInterface(NegotiatorInterface):
+
+    """Server that counts how often its methods are called."""
+
+    exported_methods = NegotiatorInterface.exported_methods + ('slow_count',)
+
+    calls = 0
+
+    def slow_count(self):
+        """Increment the number of calls after a short delay."""
+        time.sleep(0.2)
+        CountingInterface.calls += 1
+        return CountingInterface.calls
+
+
+class ForwardingSession(BrokerSession):
+
+    """Broker session that forwards calls to a shared channel."""
+
+    exported_methods = BrokerSession.exported_methods + ('call_backend',)
+
+    def __init__(self, handle, label, backend, flights=None):
+        """
+        Initialize a :class:`ForwardingSession` object.
+
+        :param handle: A binary file like object connected to the client.
+        :param label: A string describing the client.
+        :param backend: The channel to forward calls to.
+        :param flights: A :class:`~negotiator_common.broker.SingleFlight` object (optional).
+        """
+        super(ForwardingSession, self).__init__(handle, label)
+        self.backend = backend
+        self.flights = flights
+
+    def call_backend(self, method, args=(), kw=None):
+        """Forward a call to the shared channel (coalescing identical calls when :attr:`flights` is set)."""
+        function = functools.partial(forward_call, self.backend, method, args, kw or {})
+        return self.flights.call((method, repr(args)), function) if self.flights else function()
+
+
+class BrokerTestCase(LoopbackTestCase):
+
+    """Test sharing a channel between clients of a :class:`~negotiator_common.broker.ControlServer`."""
+
+    def start_broker(self, server, flights=None, **options):
+        """
+        Start a control server that forwards calls to a server over a socket pair.
+
+        :param server: The class of the server object.
+        :param flights: A :class:`~negotiator_common.broker.SingleFlight` object (optional).
+        :param options: Keyword arguments for the main loop of the server.
+        :returns: A tuple with the server object and the pathname of the
+                  control socket (a string).
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        pathname = os.path.join(directory, 'control.sock')
+        server_object, backend = self.connect(server, **options)
+        control_server = ControlServer(pathname, lambda handle, label: ForwardingSession(
+            handle, label, backend, flights,
+        ))
+        assert control_server.start()
+        self.addCleanup(control_server.stop)
+        return server_object, pathname
+
+    def connect_client(self, pathname):
+        """Connect a :class:`~negotiator_common.broker.BrokerClient` to a control socket."""
+        client = BrokerClient(pathname, 'call_backend', timeout=10)
+        self.addCleanup(client.close)
+        return client
+
+    def test_forwarded_calls(self):
+        """Make sure calls, streaming calls and errors are forwarded to the shared channel."""
+        server, pathname = self.start_broker(StreamingInterface)
+        client = self.connect_client(pathname)
+        with TimeOut(10):
+            assert client.call_remote_method('select_codec', ['json']) == 'json'
+            assert list(client.start_remote_call('slow_stream', 3).stream()) == [0, 1, 2]
+            self.assertRaises(RemoteMethodFailed, client.call_remote_method, 'broken_stream')
+            self.assertRaises(RemoteMethodUnsupported, client.call_remote_method, 'bogus')
+
+    def test_clients_share_channel(self):
+        """Make sure several clients can use the shared channel at the same time."""
+        server, pathname = self.start_broker(EchoInterface, concurrency=4)
+        clients = [self.connect_client(pathname) for i in range(4)]
+        results = [None] * len(clients)
+
+        def worker(index):
+            results[index] = clients[index].call_remote_method('delayed_echo', 0.5, index)
+
+        started = time.time()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(clients))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        assert results == list(range(len(clients)))
+        assert time.time() - started < 1.5
+
+    def test_identical_calls_coalesced(self):
+        """Make sure identical calls of different clients share a single call on the shared channel."""
+        CountingInterface.calls = 0
+        server, pathname = self.start_broker(CountingInterface, flights=SingleFlight(), concurrency=4)
+        clients = [self.connect_client(pathname) for i in range(3)]
+        results = [None] * len(clients)
+
+        def worker(index):
+            results[index] = clients[index].call_remote_method('slow_count')
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(clients))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        assert results == [1] * len(clients)
+        assert CountingInterface.calls == 1
+
+    def test_streaming_calls_coalesced(self):
+        """Make sure identical streaming calls of different clients share a single call on the shared channel."""
+        server, pathname = self.start_broker(StreamingInterface, flights=SingleFlight(), concurrency=4)
+        clients = [self.connect_client(pathname) for i in range(3)]
+        with TimeOut(10):
+            calls = [client.start_remote_call('slow_stream', 5) for client in clients]
+            assert [list(call.stream()) for call in calls] == [list(range(5))] * len(clients)
+        assert server.peak == 1
+
+    def test_session_methods_restricted(self):
+        """Make sure clients can't call methods that the session doesn't export."""
+        server, pathname = self.start_broker(EchoInterface)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(pathname)
+        self.sockets.append(sock)
+        client = NegotiatorInterface(sock.makefile('rwb'), 'client')
+        with TimeOut(10):
+            assert client.call_remote_method('call_backend', 'echo', ['value']) == 'value'
+            for method in ('execute', 'list_commands', 'handle_request', 'call_batch'):
+                self.assertRaises(RemoteMethodUnsupported, client.call_remote_method, method)
+
+
+class SingleFlightTestCase(LoopbackTestCase):
+
+    """Test the coalescing of identical concurrent calls by :class:`~negotiator_common.broker.SingleFlight`."""
+
+    def call_concurrently(self, function, count):
+        """
+        Call a function from several threads at the same time.
+
+        :param function: The callable to call.
+        :param count: The number of threads.
+        :returns: A list with the return values.
+        """
+        results = [None] * count
+
+        def worker(index):
+            results[index] = function()
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return results
+
+    def test_identical_calls_coalesced(self):
+        """Make sure two concurrent identical calls result in one remote call."""
+        CountingInterface.calls = 0
+        server, client = self.connect(CountingInterface, concurrency=4)
+        flights = SingleFlight()
+        results = self.call_concurrently(lambda: flights.call('key', lambda: forward_call(
+            client, 'slow_count', [], {},
+        )), 2)
+        assert results == [1, 1]
+        assert CountingInterface.calls == 1
+        assert not flights.flights
+
+    def test_streaming_buffer_bounded(self):
+        """Make sure the partial results of a shared streaming call aren't buffered without limit."""
+        produced = []
+
+        def generate():
+            for i in range(MAX_BUFFERED_CHUNKS * 4):
+                produced.append(i)
+                yield i
+
+        flights = SingleFlight()
+        reader = flights.call('key', generate)
+        follower = flights.call('key', generate)
+        # Read everything from the first caller while the second lags behind.
+        thread = threading.Thread(target=list, args=(reader,))
+        thread.start()
+        time.sleep(0.2)
+        assert len(produced) <= MAX_BUFFERED_CHUNKS + 1
+        assert list(follower) == list(range(MAX_BUFFERED_CHUNKS * 4))
+        thread.join(10)
+        assert not thread.is_alive()
+
+    def test_late_callers_start_new_call(self):
+        """Make sure callers that join after partial results have been dropped make their own call."""
+        calls = []
+
+        def generate():
+            calls.append(True)
+            for i in range(3):
+                yield i
+                time.sleep(0.1)
+
+        flights = SingleFlight()
+        first = flights.call('key', generate)
+        assert next(first) == 0
+        assert next(first) == 1
+        # The first partial result has been dropped, so this is a new call.
+        assert list(flights.call('key', generate)) == [0, 1, 2]
+        assert list(first) == [2]
+        assert len(calls) == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,682 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""
+File transfers between hosts and guests.
+
+This module implements the :class:`FileTransferMixin` class which enables
+:class:`~negotiator_common.NegotiatorInterface` objects to serve file
+transfers, and the :func:`push_file()` and :func:`pull_file()` functions
+that copy files to and from the other side of a channel:
+
+- Files are transferred in chunks of :data:`.FILE_CHUNK_SIZE` bytes, each
+  chunk is sent with a CRC32 checksum that is verified by the receiving side.
+  Up to :data:`.MAX_FILE_CHUNKS_IN_FLIGHT` chunks are sent before waiting for
+  the first chunk to be acknowledged.
+
+- While the file is being transferred it is written to a temporary file whose
+  name includes the SHA-256 checksum of the file. When a transfer is
+  interrupted the next transfer of the same file resumes where the previous
+  transfer left off.
+
+- After the last chunk has been written the SHA-256 checksum of the complete
+  file is verified before the file is moved into place.
+
+Files can also be synchronized (see :func:`sync_file()`) in which case only
+the blocks that changed are sent.
+
+The remote side can only read and write files in :data:`.FILE_TRANSFER_DIRECTORY`,
+file transfers are disabled when this directory doesn't exist. On KVM/QEMU hosts
+every guest gets its own subdirectory (see :func:`negotiator_host.get_transfer_directory()`).
+"""
+
+# Standard library modules.
+import collections
+import functools
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+
+# Modules included in our project.
+from negotiator_common.config import (
+    DELTA_BLOCK_SIZE,
+    FILE_CHUNK_SIZE,
+    FILE_TRANSFER_DIRECTORY,
+    MAX_DELTA_INSTRUCTIONS,
+    MAX_FILE_CHUNKS_IN_FLIGHT,
+)
+from negotiator_common.serialization import binary
+from negotiator_common.utils import InputStream, Timer
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+ADLER32_MODULUS = 65521
+"""The modulus used by the Adler-32 checksum (an integer)."""
+
+SIGNATURE_FORMAT = struct.Struct('>I16s')
+"""The binary format of block checksums (a weak and a strong checksum)."""
+
+CHECKSUM_PATTERN = re.compile(r'^[0-9a-f]{64}\Z')
+"""A compiled regular expression that matches a hexadecimal SHA-256 checksum."""
+
+
+class FileTransferMixin(object):
+
+    """
+    Methods for file transfers, mixed into :class:`~negotiator_common.NegotiatorInterface`.
+
+    These methods are called by the remote side, which is why they only
+    accept names of files in the transfer directory (see
+    :func:`resolve_transfer_path()`). The functions that take local pathnames
+    (:func:`push_file()`, :func:`pull_file()` and :func:`sync_file()`) are
+    defined at the module level so that the remote side can't call them.
+
+    The ``uploads`` attribute is expected to be a dictionary in which the
+    unfinished uploads are kept.
+    """
+
+    transfer_directory = FILE_TRANSFER_DIRECTORY
+    """The directory to which the remote side can read and write files (a string)."""
+
+    exported_methods = ('start_upload', 'write_file_chunk', 'finish_upload', 'get_block_signatures',
+                        'apply_delta', 'get_file_info', 'read_file_chunk')
+    """The names of the methods that the remote side is allowed to call (a tuple of strings)."""
+
+    def start_upload(self, name, size, checksum, resume=True):
+        """
+        Prepare to receive a file from the remote side (see :func:`push_file()`).
+
+        :param name: The name of the file (a string).
+        :param size: The size of the file in bytes (an integer).
+        :param checksum: The SHA-256 checksum of the file (a hexadecimal string).
+        :param resume: :data:`False` to discard the data received by an earlier
+                       transfer of the same file (defaults to :data:`True`).
+        :returns: The number of bytes received by an earlier, interrupted
+                  transfer of the same file (an integer).
+        :raises: :exc:`~exceptions.ValueError` when the name refers to a file
+                 outside the transfer directory or the checksum isn't a
+                 hexadecimal SHA-256 checksum.
+        """
+        temporary_file = get_temporary_file(self.resolve_transfer_path(name), checksum)
+        offset = os.path.getsize(temporary_file) if os.path.isfile(temporary_file) else 0
+        if offset > size or not resume:
+            offset = 0
+        handle = open(temporary_file, 'r+b' if offset else 'wb')
+        handle.truncate(offset)
+        handle.seek(offset)
+        previous_upload = self.uploads.pop(temporary_file, None)
+        if previous_upload:
+            previous_upload.close()
+        self.uploads[temporary_file] = InputStream(handle, offset)
+        return offset
+
+    def write_file_chunk(self, name, checksum, offset, data, chunk_checksum):
+        """
+        Write a chunk of a file received from the remote side (see :func:`push_file()`).
+
+        :param name: The name of the file (a string).
+        :param checksum: The SHA-256 checksum of the file (a hexadecimal string).
+        :param offset: The offset of the chunk in the file (an integer).
+        :param data: The chunk of data (a byte string).
+        :param chunk_checksum: The CRC32 checksum of the chunk (an integer).
+        :returns: The number of bytes written (an integer).
+        :raises: :exc:`ChecksumMismatch` when the chunk is corrupted.
+        """
+        if zlib.crc32(data) & 0xffffffff != chunk_checksum:
+            raise ChecksumMismatch("Chunk at offset %i of %s is corrupted!" % (offset, name))
+        temporary_file = get_temporary_file(self.resolve_transfer_path(name), checksum)
+        return self.uploads[temporary_file].write(offset, data)
+
+    def finish_upload(self, name, checksum):
+        """
+        Verify a file received from the remote side and move it into place (see :func:`push_file()`).
+
+        :param name: The name of the file (a string).
+        :param checksum: The SHA-256 checksum of the file (a hexadecimal string).
+        :raises: :exc:`ChecksumMismatch` when the file is corrupted (in which
+                 case the temporary file is removed).
+        """
+        pathname = self.resolve_transfer_path(name)
+        temporary_file = get_temporary_file(pathname, checksum)
+        upload = self.uploads.pop(temporary_file)
+        upload.close()
+        try:
+            verify_file(temporary_file, upload.offset, checksum)
+        except ChecksumMismatch:
+            os.unlink(temporary_file)
+            raise
+        os.rename(temporary_file, pathname)
+
+    def get_block_signatures(self, name, block_size):
+        """
+        Get the checksums of the blocks of a file (see :func:`sync_file()`).
+
+        :param name: The name of the file (a string).
+        :param block_size: The size of the blocks (an integer).
+        :returns: A byte string with a weak (Adler-32) and strong (MD5)
+                  checksum for every complete block of the file (empty when
+                  the file doesn't exist, see :func:`parse_signatures()`).
+        """
+        pathname = self.resolve_transfer_path(name)
+        signatures = []
+        if os.path.isfile(pathname):
+            with open(pathname, 'rb') as handle:
+                for block in iter(functools.partial(handle.read, block_size), b''):
+                    if len(block) == block_size:
+                        signatures.append(SIGNATURE_FORMAT.pack(
+                            zlib.adler32(block) & 0xffffffff,
+                            hashlib.md5(block).digest(),
+                        ))
+        return binary(b''.join(signatures))
+
+    def apply_delta(self, name, checksum, offset, instructions, block_size):
+        """
+        Write part of a file based on instructions computed by :func:`sync_file()`.
+
+        :param name: The name of the file (a string).
+        :param checksum: The SHA-256 checksum of the file (a hexadecimal string).
+        :param offset: The offset in the file where the instructions start (an integer).
+        :param instructions: A list of instructions. Each instruction is either
+                             a list with two integers (the index of a block in
+                             the existing file and the number of consecutive
+                             blocks to copy) or a byte string with new data.
+        :param block_size: The size of the blocks (an integer).
+        :returns: The number of bytes written (an integer).
+        :raises: :exc:`~exceptions.ValueError` when an instruction refers to
+                 blocks outside of the existing file.
+        """
+        pathname = self.resolve_transfer_path(name)
+        upload = self.uploads[get_temporary_file(pathname, checksum)]
+        basis = None
+        try:
+            for instruction in instructions:
+                if isinstance(instruction, list):
+                    if basis is None:
+                        basis = open(pathname, 'rb')
+                        basis_size = os.fstat(basis.fileno()).st_size
+                    index, count = instruction
+                    if not (block_size > 0 and index >= 0 and count >= 0
+                            and (index + count) * block_size <= basis_size):
+                        raise ValueError("Refusing to copy blocks %i-%i of %s! (the file has %i bytes)"
+                                         % (index, index + count, name, basis_size))
+                    basis.seek(index * block_size)
+                    remaining = count * block_size
+                    while remaining > 0:
+                        data = basis.read(min(remaining, FILE_CHUNK_SIZE))
+                        if not data:
+                            raise ValueError("Unexpected end of %s while copying blocks!" % name)
+                        offset += upload.write(offset, data)
+                        remaining -= len(data)
+                else:
+                    offset += upload.write(offset, instruction)
+        finally:
+            if basis is not None:
+                basis.close()
+        return offset
+
+    def get_file_info(self, name):
+        """
+        Get the size and checksum of a file (see :func:`pull_file()`).
+
+        :param name: The name of the file (a string).
+        :returns: A dictionary with the keys ``size`` (an integer) and
+                  ``checksum`` (a hexadecimal SHA-256 checksum).
+        """
+        pathname = self.resolve_transfer_path(name)
+        with open(pathname, 'rb') as handle:
+            size = os.fstat(handle.fileno()).st_size
+            contents = map_file(handle, size)
+            try:
+                return dict(size=size, checksum=hashlib.sha256(contents).hexdigest())
+            finally:
+                if isinstance(contents, mmap.mmap):
+                    contents.close()
+
+    def read_file_chunk(self, name, offset, size):
+        """
+        Read a chunk of a file (see :func:`pull_file()`).
+
+        :param name: The name of the file (a string).
+        :param offset: The offset of the chunk in the file (an integer).
+        :param size: The maximum size of the chunk (an integer).
+        :returns: A dictionary with the keys ``data`` (a byte string) and
+                  ``checksum`` (the CRC32 checksum of the data).
+        """
+        with open(self.resolve_transfer_path(name), 'rb') as handle:
+            handle.seek(offset)
+            data = handle.read(size)
+        return dict(data=binary(data), checksum=zlib.crc32(data) & 0xffffffff)
+
+    def resolve_transfer_path(self, name):
+        """
+        Find the pathname of a file in the transfer directory.
+
+        :param name: The name of the file (a string).
+        :returns: The absolute pathname of the file (a string).
+        :raises: :exc:`~exceptions.ValueError` when file transfers are disabled
+                 or the name refers to a file outside the transfer directory.
+        """
+        if not os.path.isdir(self.transfer_directory):
+            raise ValueError("File transfers are disabled (%s doesn't exist)!" % self.transfer_directory)
+        name = os.path.normpath(name)
+        if os.path.isabs(name) or name == os.curdir or name.split(os.sep)[0] == os.pardir:
+            raise ValueError("Refusing to access file outside of %s! (%r)" % (self.transfer_directory, name))
+        return os.path.join(self.transfer_directory, name)
+
+
+class ChecksumMismatch(Exception):
+
+    """Exception raised when a file is corrupted during a transfer."""
+
+
+def push_file(channel, pathname, name=None, progress=None):
+    """
+    Copy a local file to the remote side.
+
+    :param channel: The :class:`~negotiator_common.NegotiatorInterface` object
+                    connected to the remote side.
+    :param pathname: The pathname of the local file (a string).
+    :param name: The name of the file on the remote side (a string,
+                 defaults to the base name of `pathname`).
+    :param progress: A callable that's called (without arguments) every time
+                     the remote side acknowledges a chunk (optional, this can
+                     be used to implement a progress timeout, see
+                     :func:`~negotiator_common.utils.TimeOut.reset()`).
+    :returns: The number of bytes sent (an integer).
+    :raises: :exc:`~negotiator_common.RemoteMethodFailed` when the
+             transfer fails on the remote side.
+
+    The local file is read using memory mapped I/O so that chunks are sent
+    without copying them into memory first.
+    """
+    from humanfriendly import format_size
+    timer = Timer()
+    name = name or os.path.basename(pathname)
+    with open(pathname, 'rb') as handle:
+        size = os.fstat(handle.fileno()).st_size
+        contents = map_file(handle, size)
+        in_flight = collections.deque()
+        try:
+            checksum = hashlib.sha256(contents).hexdigest()
+            offset = channel.call_remote_method('start_upload', name, size, checksum)
+            if offset:
+                logger.info("Resuming upload of %s at %s ..", name, format_size(offset))
+            for start in range(offset, size, FILE_CHUNK_SIZE):
+                send_chunk(channel, in_flight, 'write_file_chunk',
+                           (name, checksum, start, slice_file(contents, start, start + FILE_CHUNK_SIZE)),
+                           progress)
+            while in_flight:
+                acknowledge(in_flight, progress)
+            channel.call_remote_method('finish_upload', name, checksum)
+        finally:
+            if isinstance(contents, mmap.mmap):
+                contents.close()
+    logger.info("Sent %s (%s) in %s.", pathname, format_size(size - offset), timer)
+    return size - offset
+
+
+def pull_file(channel, name, pathname=None, progress=None):
+    """
+    Copy a file from the remote side.
+
+    :param channel: The :class:`~negotiator_common.NegotiatorInterface` object
+                    connected to the remote side.
+    :param name: The name of the file on the remote side (a string).
+    :param pathname: The pathname of the local file (a string, defaults to
+                     the base name of `name` in the working directory).
+    :param progress: A callable that's called (without arguments) every time
+                     the remote side acknowledges a chunk (optional, this can
+                     be used to implement a progress timeout, see
+                     :func:`~negotiator_common.utils.TimeOut.reset()`).
+    :returns: The number of bytes received (an integer).
+    :raises: :exc:`~negotiator_common.RemoteMethodFailed` when the remote
+             side fails to read the file, :exc:`ChecksumMismatch` when the
+             file is corrupted during the transfer.
+    """
+    from humanfriendly import format_size
+    timer = Timer()
+    pathname = pathname or os.path.basename(name)
+    info = channel.call_remote_method('get_file_info', name)
+    temporary_file = get_temporary_file(pathname, info['checksum'])
+    offset = os.path.getsize(temporary_file) if os.path.isfile(temporary_file) else 0
+    if offset > info['size']:
+        offset = 0
+    if offset:
+        logger.info("Resuming download of %s at %s ..", name, format_size(offset))
+    with open(temporary_file, 'r+b' if offset else 'wb') as handle:
+        handle.truncate(offset)
+        handle.seek(offset)
+        in_flight = collections.deque()
+        for start in range(offset, info['size'], FILE_CHUNK_SIZE):
+            in_flight.append(channel.start_remote_call('read_file_chunk', name, start, FILE_CHUNK_SIZE))
+            if len(in_flight) >= MAX_FILE_CHUNKS_IN_FLIGHT:
+                write_chunk(handle, acknowledge(in_flight, progress))
+        while in_flight:
+            write_chunk(handle, acknowledge(in_flight, progress))
+    verify_file(temporary_file, info['size'], info['checksum'])
+    os.rename(temporary_file, pathname)
+    logger.info("Received %s (%s) in %s.", pathname, format_size(info['size'] - offset), timer)
+    return info['size'] - offset
+
+
+def sync_file(channel, pathname, name=None, block_size=DELTA_BLOCK_SIZE, progress=None):
+    """
+    Update a file on the remote side by sending only the blocks that changed.
+
+    :param channel: The :class:`~negotiator_common.NegotiatorInterface` object
+                    connected to the remote side.
+    :param pathname: The pathname of the local file (a string).
+    :param name: The name of the file on the remote side (a string,
+                 defaults to the base name of `pathname`).
+    :param block_size: The size of the blocks that are compared (an
+                       integer, defaults to :data:`.DELTA_BLOCK_SIZE`).
+    :param progress: A callable that's called (without arguments) every time
+                     the remote side acknowledges a chunk (optional, this can
+                     be used to implement a progress timeout, see
+                     :func:`~negotiator_common.utils.TimeOut.reset()`).
+    :returns: The number of bytes of file data sent (an integer).
+    :raises: :exc:`~negotiator_common.RemoteMethodFailed` when the
+             transfer fails on the remote side.
+
+    This works like rsync_: The remote side sends the (rolling) checksums
+    of the blocks of its copy of the file (see
+    :func:`FileTransferMixin.get_block_signatures()`) and we look for those
+    blocks in the local file (see :func:`compute_delta()`). Blocks that were
+    found are copied by the remote side from its copy, only the data in
+    between is sent (see :func:`FileTransferMixin.apply_delta()`). When the remote side doesn't have
+    a copy of the file the whole file is sent.
+
+    .. _rsync: https://rsync.samba.org/tech_report/
+    """
+    from humanfriendly import format_size
+    timer = Timer()
+    name = name or os.path.basename(pathname)
+    with open(pathname, 'rb') as handle:
+        size = os.fstat(handle.fileno()).st_size
+        contents = map_file(handle, size)
+        try:
+            checksum = hashlib.sha256(contents).hexdigest()
+            signatures = parse_signatures(channel.call_remote_method('get_block_signatures', name, block_size))
+            channel.call_remote_method('start_upload', name, size, checksum, False)
+            in_flight = collections.deque()
+            instructions = []
+            offset = literal_bytes = sent_bytes = 0
+            for operation in compute_delta(contents, size, signatures, block_size):
+                if operation[0] == 'copy':
+                    if instructions and isinstance(instructions[-1], list) and \
+                            sum(instructions[-1]) == operation[1]:
+                        # Merge consecutive blocks into a single copy instruction.
+                        instructions[-1][1] += 1
+                    else:
+                        instructions.append([operation[1], 1])
+                else:
+                    instructions.append(binary(contents[operation[1]:operation[2]]))
+                    literal_bytes += operation[2] - operation[1]
+                if literal_bytes >= FILE_CHUNK_SIZE or len(instructions) >= MAX_DELTA_INSTRUCTIONS:
+                    offset += send_delta(channel, in_flight, name, checksum, offset, instructions, block_size, progress)
+                    sent_bytes += literal_bytes
+                    instructions = []
+                    literal_bytes = 0
+            if instructions:
+                send_delta(channel, in_flight, name, checksum, offset, instructions, block_size, progress)
+                sent_bytes += literal_bytes
+            while in_flight:
+                acknowledge(in_flight, progress)
+            channel.call_remote_method('finish_upload', name, checksum)
+        finally:
+            if isinstance(contents, mmap.mmap):
+                contents.close()
+    logger.info("Synchronized %s (sent %s of %s) in %s.",
+                pathname, format_size(sent_bytes), format_size(size), timer)
+    return sent_bytes
+
+
+def send_delta(channel, in_flight, name, checksum, offset, instructions, block_size, progress=None):
+    """
+    Send instructions computed by :func:`sync_file()` without waiting for the response.
+
+    :param channel: The :class:`~negotiator_common.NegotiatorInterface` object
+                    connected to the remote side.
+    :param in_flight: A :class:`~collections.deque` with the
+                      :class:`~negotiator_common.RemoteCall` objects of
+                      instructions that haven't been acknowledged yet.
+    :param name: The name of the file on the remote side (a string).
+    :param checksum: The SHA-256 checksum of the file (a hexadecimal string).
+    :param offset: The offset in the file where the instructions start (an integer).
+    :param instructions: A list of instructions (see :func:`FileTransferMixin.apply_delta()`).
+    :param block_size: The size of the blocks (an integer).
+    :param progress: See :func:`sync_file()`.
+    :returns: The number of bytes of the file covered by the instructions (an integer).
+    """
+    in_flight.append(channel.start_remote_call('apply_delta', name, checksum, offset, instructions, block_size))
+    while len(in_flight) >= MAX_FILE_CHUNKS_IN_FLIGHT:
+        acknowledge(in_flight, progress)
+    return sum(i[1] * block_size if isinstance(i, list) else len(i) for i in instructions)
+
+
+def send_chunk(channel, in_flight, method, args, progress=None):
+    """
+    Send a chunk of a file to the remote side without waiting for the response.
+
+    :param channel: The :class:`~negotiator_common.NegotiatorInterface` object
+                    connected to the remote side.
+    :param in_flight: A :class:`~collections.deque` with the
+                      :class:`~negotiator_common.RemoteCall` objects of
+                      chunks that haven't been acknowledged yet.
+    :param method: The name of the remote method (a string).
+    :param args: A tuple with the positional arguments for the remote method,
+                 the last argument is the chunk of data (a byte string or
+                 :class:`memoryview`). The CRC32 checksum of the chunk
+                 is added as an extra argument.
+    :param progress: See :func:`push_file()`.
+
+    When :data:`.MAX_FILE_CHUNKS_IN_FLIGHT` chunks are waiting to be
+    acknowledged this function waits for the oldest chunk to be acknowledged.
+    """
+    data = args[-1]
+    call = channel.start_remote_call(method, *(args + (zlib.crc32(data) & 0xffffffff,)))
+    # The chunk has been written to the channel, so we can release it
+    # (memory views of memory mapped files need to be released before
+    # the memory map can be closed).
+    call.args = None
+    if isinstance(data, memoryview) and hasattr(data, 'release'):
+        data.release()
+    in_flight.append(call)
+    while len(in_flight) >= MAX_FILE_CHUNKS_IN_FLIGHT:
+        acknowledge(in_flight, progress)
+
+
+def acknowledge(in_flight, progress=None):
+    """
+    Wait for the oldest chunk sent to (or requested from) the remote side.
+
+    :param in_flight: A :class:`~collections.deque` with
+                      :class:`~negotiator_common.RemoteCall` objects.
+    :param progress: See :func:`push_file()`.
+    :returns: The return value of the remote method.
+    """
+    result = in_flight.popleft().wait()
+    if progress:
+        progress()
+    return result
+
+
+def parse_signatures(data):
+    """
+    Parse the block checksums returned by :func:`FileTransferMixin.get_block_signatures()`.
+
+    :param data: The byte string with checksums.
+    :returns: A dictionary with weak checksums (integers) as keys and lists of
+              tuples with a strong checksum (a byte string) and a block index
+              (an integer) as values.
+    """
+    signatures = {}
+    for index, offset in enumerate(range(0, len(data), SIGNATURE_FORMAT.size)):
+        weak, strong = SIGNATURE_FORMAT.unpack_from(data, offset)
+        signatures.setdefault(weak, []).append((strong, index))
+    return signatures
+
+
+def compute_delta(contents, size, signatures, block_size):
+    """
+    Find the blocks of a file that also exist in the remote copy of the file.
+
+    :param contents: The contents of the file (see :func:`map_file()`).
+    :param size: The size of the file (an integer).
+    :param signatures: The value returned by :func:`parse_signatures()`.
+    :param block_size: The size of the blocks (an integer).
+    :returns: A generator of tuples, either ``('copy', index)`` for a block
+              that exists in the remote copy or ``('literal', start, end)``
+              for data that doesn't.
+
+    The weak checksum of the window at every offset of the file is computed
+    using a rolling version of Adler-32, so that blocks are found even when
+    data was inserted or removed in front of them. The strong checksum is only
+    computed when the weak checksum matches. After a block is found the
+    search continues at the end of the block.
+    """
+    data = byte_values(contents)
+    literal_start = position = 0
+    try:
+        if signatures and size >= block_size:
+            a, b = split_adler32(zlib.adler32(data[0:block_size]))
+            while True:
+                match = None
+                candidates = signatures.get((b << 16) | a)
+                if candidates:
+                    strong = hashlib.md5(data[position:position + block_size]).digest()
+                    match = next((index for checksum, index in candidates if checksum == strong), None)
+                if match is not None:
+                    if literal_start < position:
+                        yield ('literal', literal_start, position)
+                    yield ('copy', match)
+                    position += block_size
+                    literal_start = position
+                    if position + block_size > size:
+                        break
+                    a, b = split_adler32(zlib.adler32(data[position:position + block_size]))
+                elif position + block_size < size:
+                    # Roll the window one byte forward.
+                    removed = data[position]
+                    a = (a - removed + data[position + block_size]) % ADLER32_MODULUS
+                    b = (b - block_size * removed + a - 1) % ADLER32_MODULUS
+                    position += 1
+                else:
+                    break
+        if literal_start < size:
+            yield ('literal', literal_start, size)
+    finally:
+        # Memory views need to be released before the memory map can be closed.
+        if isinstance(data, memoryview) and hasattr(data, 'release'):
+            data.release()
+
+
+def byte_values(contents):
+    """
+    Get a view of file contents that can be indexed to get integers.
+
+    :param contents: The contents of the file (see :func:`map_file()`).
+    :returns: A :class:`memoryview` (on Python 2 indexing memory views gives
+              byte strings, so the contents are copied into a
+              :class:`bytearray` instead).
+    """
+    return memoryview(contents) if sys.version_info[0] >= 3 else bytearray(contents)
+
+
+def split_adler32(checksum):
+    """
+    Split an Adler-32 checksum into its two components.
+
+    :param checksum: The value returned by :func:`zlib.adler32()`.
+    :returns: A tuple of two integers.
+    """
+    checksum &= 0xffffffff
+    return checksum & 0xffff, checksum >> 16
+
+
+def get_temporary_file(pathname, checksum):
+    """
+    Get the pathname of the temporary file used while a file is transferred.
+
+    :param pathname: The pathname of the file (a string).
+    :param checksum: The SHA-256 checksum of the file (a hexadecimal string).
+    :returns: The pathname of the temporary file (a string).
+    :raises: :exc:`~exceptions.ValueError` when the checksum isn't a
+             hexadecimal SHA-256 checksum (because it's used in the
+             pathname).
+    """
+    if not CHECKSUM_PATTERN.match(str(checksum)):
+        raise ValueError("Invalid SHA-256 checksum! (%r)" % checksum)
+    directory, filename = os.path.split(pathname)
+    return os.path.join(directory, '.%s.%s.part' % (filename, checksum[:16]))
+
+
+def map_file(handle, size):
+    """
+    Map the contents of a file into memory.
+
+    :param handle: A file opened in binary mode.
+    :param size: The size of the file (an integer).
+    :returns: A :class:`mmap.mmap` object (or an empty byte string when the
+              file is empty, because empty files can't be mapped).
+    """
+    return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+
+def slice_file(contents, start, end):
+    """
+    Get a chunk of a file mapped into memory by :func:`map_file()`.
+
+    :param contents: The value returned by :func:`map_file()`.
+    :param start: The offset of the first byte (an integer).
+    :param end: The offset after the last byte (an integer).
+    :returns: A :class:`memoryview` of the chunk (on Python 2 memory maps
+              don't support memory views so the chunk is copied).
+    """
+    try:
+        return memoryview(contents)[start:end]
+    except TypeError:
+        return binary(contents[start:end])
+
+
+def write_chunk(handle, chunk):
+    """
+    Write a chunk received by :func:`pull_file()`.
+
+    :param handle: The file to write to.
+    :param chunk: A dictionary returned by :func:`FileTransferMixin.read_file_chunk()`.
+    :raises: :exc:`ChecksumMismatch` when the chunk is corrupted.
+    """
+    if zlib.crc32(chunk['data']) & 0xffffffff != chunk['checksum']:
+        raise ChecksumMismatch("Chunk at offset %i is corrupted!" % handle.tell())
+    handle.write(chunk['data'])
+
+
+def verify_file(pathname, size, checksum):
+    """
+    Verify the size and checksum of a file.
+
+    :param pathname: The pathname of the file (a string).
+    :param size: The expected size of the file (an integer).
+    :param checksum: The expected SHA-256 checksum (a hexadecimal string).
+    :raises: :exc:`ChecksumMismatch` when the file doesn't match.
+    """
+    with open(pathname, 'rb') as handle:
+        actual_size = os.fstat(handle.fileno()).st_size
+        contents = map_file(handle, actual_size)
+        try:
+            actual_checksum = hashlib.sha256(contents).hexdigest()
+        finally:
+            if isinstance(contents, mmap.mmap):
+                contents.close()
+    if actual_size != size or actual_checksum != checksum:
+        raise ChecksumMismatch("File %s is corrupted! (size %i, expected %i)" % (pathname, actual_size, size))
@@ -1,13 +1,42 @@
 # Scriptable KVM/QEMU guest agent in Python.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: October 11, 2019
+# Last Change: October 16, 2026
 # URL: https://negotiator.readthedocs.org
 
 """Miscellaneous functionality."""
 
 # Standard library modules.
+import collections
+import logging
+import os
 import signal
+import stat
+import sys
+import threading
+import time
+
+try:
+    # Python 3.
+    import queue
+except ImportError:
+    # Python 2.
+    import Queue as queue
+
+# Modules included in our project.
+from negotiator_common.config import INPUT_CHUNK_TIMEOUT
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+logging_options = {}
+"""
+The arguments given to :func:`configure_logging()` (a dictionary).
+
+Worker processes that don't inherit the logging configuration of their
+parent (because they weren't forked from it) use this to configure logging
+the same way (see :class:`~negotiator_host.AutomaticGuestChannel`).
+"""
 
 
 def format_call(function, *args, **kw):
@@ -26,6 +55,123 @@ def format_call(function, *args, **kw):
     return "%s(%s)" % (function, ', '.join(formatted_arguments))
 
 
+def configure_logging(verbosity=0, syslog=False):
+    """
+    Configure logging for the command line programs.
+
+    :param verbosity: The number of times the verbosity was increased (a
+                      positive integer) or decreased (a negative integer).
+    :param syslog: :data:`True` to log to the system log as well,
+                   :data:`False` to log to the terminal only.
+
+    When `syslog` is :data:`True` or the standard error stream is connected to
+    a terminal the coloredlogs_ package is used. Otherwise a plain handler
+    from the standard library is used, because importing coloredlogs_ (and
+    humanfriendly_) makes up most of the start-up time of short lived
+    invocations, for example by monitoring scripts.
+
+    .. _coloredlogs: https://pypi.org/project/coloredlogs/
+    .. _humanfriendly: https://pypi.org/project/humanfriendly/
+    """
+    logging_options.update(verbosity=verbosity, syslog=syslog)
+    if syslog or sys.stderr.isatty():
+        import coloredlogs
+        coloredlogs.install(syslog=syslog)
+        adjust_verbosity = coloredlogs.increase_verbosity if verbosity > 0 else coloredlogs.decrease_verbosity
+        for i in range(abs(verbosity)):
+            adjust_verbosity()
+    else:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s[%(process)d] %(levelname)s %(message)s'))
+        root_logger = logging.getLogger()
+        root_logger.addHandler(handler)
+        root_logger.setLevel(min(max(logging.INFO - verbosity * 10, logging.DEBUG), logging.CRITICAL))
+
+
+def get_redirected_input():
+    """
+    Get the standard input stream when it's redirected from a pipe or file.
+
+    :returns: A binary file like object or :data:`None` when the standard
+              input stream is connected to something else (like a terminal
+              or ``/dev/null``).
+    """
+    try:
+        mode = os.fstat(sys.stdin.fileno()).st_mode
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+    if stat.S_ISFIFO(mode) or stat.S_ISREG(mode):
+        return getattr(sys.stdin, 'buffer', sys.stdin)
+
+
+def feed_input(handle, data):
+    """
+    Write input to the standard input stream of a subprocess and close it.
+
+    :param handle: The standard input stream of the subprocess (a binary file
+                   like object).
+    :param data: The input for the subprocess (a string, byte string or
+                 :data:`None`).
+
+    This is intended to be run in a separate thread while the output of the
+    subprocess is consumed, to avoid deadlocks when pipe buffers fill up.
+    """
+    try:
+        if data:
+            handle.write(data.encode('utf-8') if not isinstance(data, bytes) else data)
+    except EnvironmentError as e:
+        # The subprocess may exit without consuming its input.
+        logger.debug("Failed to write input to subprocess: %s", e)
+    finally:
+        try:
+            handle.close()
+        except EnvironmentError:
+            pass
+
+
+def iterate_concurrently(function, values, concurrency):
+    """
+    Call a function for each of the given values using a bounded pool of threads.
+
+    :param function: The callable to invoke (it's given a single argument).
+    :param values: An iterable of values to pass to the callable.
+    :param concurrency: The maximum number of calls in progress at any given
+                        time (an integer).
+    :returns: A generator of tuples with three values each: The value that
+              was passed to the callable, the value that it returned (or
+              :data:`None`) and the exception that it raised (or
+              :data:`None`). The tuples are generated as the calls complete,
+              so they're not in the order of `values`.
+    """
+    values = list(values)
+    if not values:
+        return
+    results = queue.Queue()
+    pool = WorkerPool(min(concurrency, len(values)), queue_size=len(values))
+    try:
+        for value in values:
+            pool.submit(call_and_report, function, value, results)
+        for i in range(len(values)):
+            yield results.get()
+    finally:
+        pool.shutdown()
+
+
+def call_and_report(function, value, results):
+    """
+    Call a function and report the outcome (used by :func:`iterate_concurrently()`).
+
+    :param function: The callable to invoke.
+    :param value: The argument to pass to the callable.
+    :param results: The :class:`~queue.Queue` to which a tuple with the
+                    value, the return value and the exception is added.
+    """
+    try:
+        results.put((value, function(value), None))
+    except Exception as e:
+        results.put((value, None, e))
+
+
 class GracefulShutdown(object):
 
     """
@@ -48,6 +194,76 @@ class GracefulShutdown(object):
         raise TerminationError()
 
 
+class Timer(object):
+
+    """
+    Measure elapsed time (a lightweight alternative to :class:`humanfriendly.Timer`).
+
+    Timers are created for every remote method call, but they're rarely
+    formatted, so :mod:`humanfriendly` is only imported when a timer is
+    converted to a string (see :func:`configure_logging()` for why).
+    """
+
+    def __init__(self):
+        """Start the timer."""
+        self.start_time = time.time()
+
+    @property
+    def elapsed_time(self):
+        """The number of seconds since the timer was started (a float)."""
+        return time.time() - self.start_time
+
+    def __str__(self):
+        """Format the elapsed time as a human readable string."""
+        from humanfriendly import format_timespan
+        return format_timespan(self.elapsed_time)
+
+
+class ResultCache(object):
+
+    """A size bounded cache whose entries expire (least recently used entries are evicted first)."""
+
+    def __init__(self, max_size):
+        """
+        Initialize a :class:`ResultCache` object.
+
+        :param max_size: The maximum number of entries (an integer).
+        """
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get a cached value.
+
+        :param key: The key of the entry (a hashable value).
+        :returns: The cached value or :data:`None` when the key isn't cached
+                  or its entry has expired.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[0] > time.time():
+                # Re-inserting the entry marks it as most recently used.
+                self.entries[key] = entry
+                return entry[1]
+            return None
+
+    def put(self, key, value, ttl):
+        """
+        Add a value to the cache.
+
+        :param key: The key of the entry (a hashable value).
+        :param value: The value to cache (anything except :data:`None`).
+        :param ttl: The number of seconds until the entry expires (a number).
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
 class TimeOut(object):
 
     """Context manager that enforces timeouts using UNIX alarm signals."""
@@ -65,6 +281,17 @@ class TimeOut(object):
         """Schedule the timeout."""
         self.previous_handler = signal.signal(signal.SIGALRM, self.signal_handler)
         signal.alarm(self.num_seconds)
+        return self
+
+    def reset(self):
+        """
+        Restart the timeout.
+
+        This is useful for long running operations that make progress, in
+        which case the timeout applies to each step of the operation (see
+        :func:`~negotiator_common.transfer.push_file()`).
+        """
+        signal.alarm(self.num_seconds)
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Clear the timeout and restore the previous signal handler."""
@@ -76,6 +303,153 @@ class TimeOut(object):
         raise TimeOutError()
 
 
+class WorkerPool(object):
+
+    """
+    A fixed size pool of worker threads with a bounded queue of pending tasks.
+
+    When the queue is full :func:`submit()` blocks until a worker becomes
+    available, this provides back pressure to the producer of tasks.
+    """
+
+    def __init__(self, size, queue_size=None):
+        """
+        Initialize the worker pool and start the worker threads.
+
+        :param size: The number of worker threads (an integer).
+        :param queue_size: The maximum number of tasks waiting for a worker (an
+                           integer, defaults to twice the number of workers).
+        """
+        self.size = size
+        self.tasks = queue.Queue(queue_size or size * 2)
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.run_worker, name="negotiator-worker-%i" % (i + 1))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, *args, **kw):
+        """
+        Schedule a function to be called by one of the worker threads.
+
+        :param function: The callable to invoke.
+        :param args: The positional arguments for the callable.
+        :param kw: The keyword arguments for the callable.
+        """
+        self.tasks.put((function, args, kw))
+
+    def run_worker(self):
+        """Process tasks until :func:`shutdown()` is called."""
+        while True:
+            task = self.tasks.get()
+            try:
+                if task is None:
+                    break
+                function, args, kw = task
+                function(*args, **kw)
+            except Exception:
+                logger.exception("Swallowing unexpected exception in worker thread so we don't crash!")
+            finally:
+                self.tasks.task_done()
+
+    def shutdown(self):
+        """Stop the worker threads after the pending tasks have been processed."""
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class InputStream(object):
+
+    """
+    A stream that receives its input in chunks which are written in order.
+
+    This is used for the standard input streams of subprocesses (see
+    :func:`~negotiator_common.execution.CommandExecutionMixin.execute_streaming()`) and
+    for files uploaded by the remote side (see
+    :mod:`negotiator_common.transfer`).
+    """
+
+    def __init__(self, handle, offset=0, timeout=INPUT_CHUNK_TIMEOUT):
+        """
+        Initialize an :class:`InputStream` object.
+
+        :param handle: The stream to write to (a binary file like object).
+        :param offset: The number of bytes that have already been written to
+                       the stream (an integer, defaults to zero).
+        :param timeout: The number of seconds that a chunk waits for the
+                        preceding chunks (a number, defaults to
+                        :data:`.INPUT_CHUNK_TIMEOUT`).
+        """
+        self.handle = handle
+        self.offset = offset
+        self.timeout = timeout
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def write(self, offset, data):
+        """
+        Write a chunk of input to the stream.
+
+        :param offset: The offset of the chunk in the input (an integer).
+        :param data: The chunk of input (a byte string).
+        :returns: The number of bytes written (an integer).
+        :raises: :exc:`~exceptions.ValueError` when the stream has been closed
+                 or failed.
+
+        When chunks arrive out of order (because they're written by concurrent
+        threads) this method waits for the preceding chunks to be written.
+        When the offset was already written (a duplicate chunk) or the
+        preceding chunks don't arrive within the timeout, the stream fails
+        because its contents can no longer be trusted.
+        """
+        with self.condition:
+            if offset < self.offset and not self.closed:
+                self.fail("Chunk at offset %i was received after offset %i was written!" % (offset, self.offset))
+            timer = Timer()
+            while self.offset != offset and not self.closed:
+                remaining = self.timeout - timer.elapsed_time
+                if remaining <= 0:
+                    self.fail("Timed out waiting for chunk at offset %i (received chunk at offset %i)!"
+                              % (self.offset, offset))
+                    break
+                self.condition.wait(remaining)
+            if self.closed:
+                raise ValueError(self.error or "Input stream has already been closed!")
+            try:
+                self.handle.write(data)
+                self.handle.flush()
+            finally:
+                self.offset += len(data)
+                self.condition.notify_all()
+        return len(data)
+
+    def fail(self, reason):
+        """
+        Close the stream because it can't be completed.
+
+        :param reason: The reason why the stream failed (a string). Pending
+                       and future writes raise :exc:`~exceptions.ValueError`
+                       with this message.
+        """
+        with self.condition:
+            if not self.closed:
+                logger.warning("Input stream failed: %s", reason)
+                self.error = reason
+                self.close()
+
+    def close(self):
+        """Close the stream (any pending writes fail)."""
+        with self.condition:
+            self.closed = True
+            self.handle.close()
+            self.condition.notify_all()
+
+
 class TerminationError(SystemExit):
 
     """Exception that is raised when ``SIGTERM`` is received."""
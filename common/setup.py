@@ -3,7 +3,7 @@
 # Setup script for the `negotiator-common' package.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: April 26, 2018
+# Last Change: October 16, 2026
 # URL: https://negotiator.readthedocs.org
 
 """Setup script for the ``negotiator-common`` package."""
@@ -51,6 +51,11 @@ setup(name='negotiator-common',
           'executor >= 1.3',
           'humanfriendly >= 4.12',
       ],
+      extras_require={
+          'cbor': ['cbor2'],
+          'msgpack': ['msgpack >= 0.5.2'],
+          'orjson': ['orjson'],
+      },
       classifiers=[
           'Development Status :: 4 - Beta',
           'Environment :: Console',
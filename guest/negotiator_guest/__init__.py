@@ -1,33 +1,30 @@
 # Scriptable KVM/QEMU guest agent in Python.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: December 11, 2019
+# Last Change: October 16, 2026
 # URL: https://negotiator.readthedocs.org
 
 """
 The guest agent daemon and client.
 
 This module implements the guest agent, the Python daemon process that's always
-running inside KVM/QEMU guests.
+running inside KVM/QEMU guests, and the multiplexer that enables many programs
+inside a guest to share the guest to host channel (see :func:`start_multiplexer()`).
 """
 
 # Standard library modules.
 import errno
-import fcntl
-import itertools
+import functools
+import io
 import logging
-import multiprocessing
 import os
-import signal
-import sys
+import select
 import time
 
-# External dependencies.
-from humanfriendly import Timer, compact
-
 # Modules included in our project.
 from negotiator_common import NegotiatorInterface
-from negotiator_common.utils import GracefulShutdown
+from negotiator_common.broker import BrokerClient, BrokerSession, ControlServer, forward_call
+from negotiator_common.config import GUEST_CONTROL_SOCKET, GUEST_TO_HOST_CHANNEL_NAME
 
 # Semi-standard module versioning.
 __version__ = '0.12.2'
@@ -35,6 +32,12 @@ __version__ = '0.12.2'
 # Initialize a logger for this module.
 logger = logging.getLogger(__name__)
 
+HANGUP_POLL_INTERVAL = 0.5
+"""
+The number of seconds between checks for the host side of the channel to connect
+(an integer or float, only used on platforms without :func:`select.epoll()`).
+"""
+
 
 class GuestAgent(NegotiatorInterface):
 
@@ -56,9 +59,15 @@ class GuestAgent(NegotiatorInterface):
                   use :class:`~negotiator_common.utils.TimeOut` or a similar
                   solution.
         """
-        custom_open = self.retry_open if retry else open
+        custom_open = self.retry_open if retry else io.FileIO
+        self.device_handle = custom_open(character_device, 'r+')
+        # The epoll or poll object used to wait for input (see wait_for_input()).
+        self.poller = None
+        # We use separate read and write buffers (instead of a single buffered
+        # read/write stream) so that writing a response never discards
+        # buffered requests that haven't been processed yet.
         super(GuestAgent, self).__init__(
-            handle=custom_open(character_device, 'r+'),
+            handle=io.BufferedRWPair(self.device_handle, self.device_handle),
             label="character device %s" % character_device,
         )
 
@@ -66,7 +75,7 @@ class GuestAgent(NegotiatorInterface):
         """Open the character device and retry ``EBUSY`` errors."""
         while True:
             try:
-                return open(character_device, mode)
+                return io.FileIO(character_device, mode)
             except EnvironmentError as e:
                 if e.errno == errno.EBUSY:
                     logger.debug("Retrying access to %s after EBUSY error ..", character_device)
@@ -81,10 +90,9 @@ class GuestAgent(NegotiatorInterface):
         This method overrides the
         :func:`~negotiator_common.NegotiatorInterface.raw_readline()` method
         of the :func:`~negotiator_common.NegotiatorInterface` class to
-        implement blocking reads based on :data:`os.O_ASYNC` and
-        :data:`signal.SIGIO` (see also :class:`WaitForRead`).
+        implement blocking reads (see :func:`wait_for_input()`).
 
-        :returns: The data read from the remote side (a string).
+        :returns: The data read from the remote side (a byte string).
         """
         while True:
             # Check if the channel contains data.
@@ -93,74 +101,151 @@ class GuestAgent(NegotiatorInterface):
             if data:
                 break
             # If the readline() above returns an empty string the channel
-            # is (probably) not connected. At this point we'll bother to
-            # prepare a convoluted way to block until the channel does
-            # become connected.
-            logger.debug("Got an empty read, emulating blocking read of %s ..", self.conn_label)
-            # Set the O_ASYNC flag on the file descriptor connected to the
-            # character device (this is required to use SIGIO signals).
-            flags = fcntl.fcntl(self.conn_handle, fcntl.F_GETFL)
-            fcntl.fcntl(self.conn_handle, fcntl.F_SETFL, flags | os.O_ASYNC)
-            # Spawn a subprocess to reliably handle SIGIO signals. Due to the
-            # nature of (SIGIO) signals more than one signal may be delivered
-            # and this is a big problem when you want to do more than just call
-            # sys.exit(). The alternative to this would be signal.pause() but
-            # that function has an inherent race condition. To fix that race
-            # condition there is sigsuspend() but this function is not
-            # available in the Python standard library.
-            waiter = WaitForRead()
-            # If we get killed we need to make sure we take the subprocess
-            # down with us, otherwise the subprocess may still be reading
-            # from the character device when we are restarted and that's a
-            # problem because the character device doesn't allow multiple
-            # readers; all but the first reader will get the error
-            # `IOError: [Errno 16] Device or resource busy'.
-            with GracefulShutdown():
-                try:
-                    # Start the subprocess.
-                    waiter.start()
-                    # Connect the file descriptor to the subprocess.
-                    fcntl.fcntl(self.conn_handle, fcntl.F_SETOWN, waiter.pid)
-                    # The channel may have become connected after we last got an empty
-                    # read but before we spawned our subprocess, so check one more
-                    # time to make sure.
-                    data = self.conn_handle.readline()
-                    if data:
-                        break
-                    # If there is still no data available we'll wait for the
-                    # subprocess to indicate that data has become available.
-                    waiter.join()
-                    # Let's see if the subprocess is right :-)
-                    data = self.conn_handle.readline()
-                    if data:
-                        break
-                finally:
-                    logger.debug("Terminating subprocess with process id %i ..", waiter.pid)
-                    waiter.terminate()
-            # If the convoluted way to simulate blocking reads above ever
-            # fails we don't want this method to turn into a `busy loop'.
-            logger.debug("Blocking read emulation seems to have failed, falling back to 1 second polling interval ..")
-            time.sleep(1)
+            # is (probably) not connected, so we block until it is.
+            self.wait_for_input()
         logger.debug("Read %i bytes from %s: %r", len(data), self.conn_label, data)
         return data
 
+    def wait_for_input(self):
+        """
+        Block until the character device becomes readable.
+
+        Reads from the character device return immediately (with no data)
+        while the host side of the channel isn't connected. To avoid a busy
+        loop we wait for the character device using :func:`select.epoll()` in
+        edge triggered mode: While the host isn't connected the device reports
+        ``POLLHUP``, but because of edge triggering the next wait blocks until
+        the state of the device changes, i.e. when the host connects or data
+        arrives. On platforms without :func:`select.epoll()` we fall back to
+        :func:`select.poll()`, which can't tell us when the host connects, so
+        in that case we check again after :data:`HANGUP_POLL_INTERVAL` seconds.
+        """
+        if self.poller is None:
+            if hasattr(select, 'epoll'):
+                self.poller = select.epoll()
+                self.poller.register(self.device_handle.fileno(), select.EPOLLIN | select.EPOLLET)
+            else:
+                self.poller = select.poll()
+                self.poller.register(self.device_handle.fileno(), select.POLLIN)
+        logger.debug("Waiting for %s to become readable ..", self.conn_label)
+        while True:
+            try:
+                events = self.poller.poll()
+            except EnvironmentError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, mask in events:
+                if mask & select.POLLIN:
+                    logger.debug("%s has become readable.", self.conn_label)
+                    return
+                elif mask & select.POLLHUP:
+                    logger.debug("Host side of %s isn't connected, waiting for it to connect ..", self.conn_label)
+                    if not isinstance(self.poller, getattr(select, 'epoll', ())):
+                        time.sleep(HANGUP_POLL_INTERVAL)
+                        return
+
+
+class ControlSession(BrokerSession):
+
+    """The multiplexer's side of a connection to its control socket (see :func:`start_multiplexer()`)."""
+
+    exported_methods = ('select_codec', 'call_host')
+
+    def __init__(self, handle, label, agent):
+        """
+        Initialize a :class:`ControlSession` object.
 
-class WaitForRead(multiprocessing.Process):
+        :param handle: A binary file like object connected to the client.
+        :param label: A string describing the client (used in logging).
+        :param agent: The :class:`GuestAgent` connected to the guest to host
+                      channel (shared between all clients).
+        """
+        super(ControlSession, self).__init__(handle, label)
+        self.agent = agent
 
-    """Used by :func:`GuestAgent.raw_readline()` to implement blocking reads."""
+    def call_host(self, method, args=(), kw=None):
+        """
+        Call a method of the host on behalf of a client.
+
+        :param method: The name of the method to call (a string).
+        :param args: The positional arguments for the method (a list).
+        :param kw: The keyword arguments for the method (a dictionary).
+        :returns: The return value of the method (see
+                  :func:`~negotiator_common.broker.forward_call()`).
+        """
+        return forward_call(self.agent, method, args, kw or {})
 
-    def run(self):
-        """Endless loop that waits for one or more ``SIGIO`` signals to arrive."""
-        logger.debug("Installing SIGIO signal handler ..")
-        signal.signal(signal.SIGIO, self.signal_handler)
-        timer = Timer()
-        for seconds in itertools.count():
-            logger.debug("Waiting for SIGIO signal (%s) ..", timer)
-            time.sleep(seconds)
 
-    def signal_handler(self, signal_number, frame):
-        """Signal handler for ``SIGIO`` signals that immediately exits the process."""
-        sys.exit(0)
+class MultiplexedChannel(BrokerClient):
+
+    """
+    Call the methods of the host through the control socket of the multiplexer.
+
+    This has the same API as :class:`GuestAgent` (for calling the host), but
+    the calls are sent over the guest to host channel that the multiplexer
+    keeps open, so it can be used by any number of programs at the same time.
+    """
+
+    def __init__(self, control_socket=GUEST_CONTROL_SOCKET, timeout=None):
+        """
+        Connect to the control socket of the multiplexer.
+
+        :param control_socket: The pathname of the control socket (a string,
+                               defaults to :data:`.GUEST_CONTROL_SOCKET`).
+        :param timeout: The number of seconds after which reading from or
+                        writing to the control socket times out (a number,
+                        optional).
+        :raises: :exc:`~exceptions.EnvironmentError` when connecting fails.
+        """
+        super(MultiplexedChannel, self).__init__(control_socket, 'call_host', (), timeout)
+
+
+def start_multiplexer(character_device=None, control_socket=GUEST_CONTROL_SOCKET):
+    """
+    Share the guest to host channel with the programs running inside the guest.
+
+    :param character_device: The absolute pathname of the character device of
+                             the guest to host channel (a string, defaults to
+                             the result of :func:`find_character_device()`).
+    :param control_socket: The pathname of the control socket (a string,
+                           defaults to :data:`.GUEST_CONTROL_SOCKET`).
+    :returns: A :class:`~negotiator_common.broker.ControlServer` object
+              (calls are handled by a background thread).
+    :raises: :exc:`~exceptions.Exception` when the control socket can't be
+             created.
+    """
+    agent = GuestAgent(character_device or find_character_device(GUEST_TO_HOST_CHANNEL_NAME), retry=True)
+    server = ControlServer(control_socket, functools.partial(ControlSession, agent=agent))
+    if not server.start():
+        raise Exception("Failed to create control socket %s!" % control_socket)
+    return server
+
+
+def connect_to_host(character_device=None, timeout=None, control_socket=GUEST_CONTROL_SOCKET):
+    """
+    Connect to the host through the multiplexer or directly.
+
+    :param character_device: The absolute pathname of the character device of
+                             the guest to host channel (a string, defaults to
+                             the result of :func:`find_character_device()`).
+    :param timeout: The number of seconds after which socket operations time
+                    out (a number, optional, only used for the control socket).
+    :param control_socket: The pathname of the control socket (a string,
+                           defaults to :data:`.GUEST_CONTROL_SOCKET`).
+    :returns: A :class:`MultiplexedChannel` object when the multiplexer is
+              running, a :class:`GuestAgent` object otherwise.
+
+    While the multiplexer is running it keeps the character device open, so
+    the multiplexer needs to be used to call the host.
+    """
+    if control_socket and os.path.exists(control_socket):
+        try:
+            return MultiplexedChannel(control_socket, timeout)
+        except EnvironmentError as e:
+            logger.debug("Failed to connect to control socket %s, opening character device directly. (%s)",
+                         control_socket, e)
+    return GuestAgent(character_device or find_character_device(GUEST_TO_HOST_CHANNEL_NAME), retry=True)
 
 
 def find_character_device(port_name):
@@ -182,6 +267,7 @@ def find_character_device(port_name):
                 character_device = '/dev/%s' % entry
                 logger.debug("Selected character device: %s", character_device)
                 return character_device
+    from humanfriendly import compact
     raise Exception(compact("""
         Failed to select the appropriate character device for the port name
         {name}! This is probably caused by a configuration issue on either the
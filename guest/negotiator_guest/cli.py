@@ -1,7 +1,7 @@
 # Scriptable KVM/QEMU guest agent in Python.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: December 9, 2019
+# Last Change: October 16, 2026
 # URL: https://negotiator.readthedocs.org
 
 """
@@ -18,10 +18,35 @@ Supported options:
 
   -e, --execute=COMMAND
 
-    Execute the given command on the KVM/QEMU host. The standard output stream
-    of the command on the host is intercepted and copied to the standard output
-    stream on the guest. If the command exits with a nonzero status code the
-    negotiator-guest program will also exit with a nonzero status code.
+    Execute the given command on the KVM/QEMU host. The standard output and
+    error streams of the command on the host are copied to the standard output
+    and error streams on the guest as the output arrives. If the command exits
+    with a nonzero status code the negotiator-guest program will also exit
+    with a nonzero status code.
+
+    When the standard input stream is redirected from a pipe or file, its
+    contents are streamed to the standard input of the remote command.
+
+  -P, --pipe
+
+    Read commands for the KVM/QEMU host from the standard input stream (one
+    per line) and run them all using the same connection. Each line contains
+    a shell command line or a JSON object with the key 'command' (and
+    optionally 'input') or 'method' (and optionally 'args' and 'kw'). The
+    outcome of each command is reported as a JSON line with the keys 'id',
+    'returncode', 'stdout', 'stderr', 'error' and 'elapsed' (or 'result' for
+    method calls). The timeout applies to each command individually.
+
+  -s, --push-file=PATHNAME
+
+    Copy the given local file to the file transfer directory of this guest on
+    the KVM/QEMU host (a subdirectory of /var/lib/negotiator/files named after
+    the guest). Interrupted transfers are resumed.
+
+  -r, --pull-file=NAME
+
+    Copy the given file from the file transfer directory on the KVM/QEMU host
+    to the current working directory. Interrupted transfers are resumed.
 
   -d, --daemon
 
@@ -29,11 +54,31 @@ Supported options:
     `negotiator-guest' program never returns (unless an unexpected error
     condition occurs).
 
+  -m, --multiplexer
+
+    Start the multiplexer, which keeps the character device of the guest to
+    host channel open and accepts calls for the host from any number of
+    programs on the control socket /run/negotiator/guest.sock. The other
+    options of negotiator-guest use this control socket while the multiplexer
+    is running. When combined with --daemon a single process runs both.
+
+  -F, --fork-server
+
+    Make the guest daemon start the commands requested by the host from a
+    small helper process that's forked when the daemon starts. This keeps the
+    overhead of starting commands low while the daemon grows.
+
+  -C, --concurrency=COUNT
+
+    Set the number of requests from the host that the guest daemon handles at
+    the same time. The default is 1 (requests are handled one at a time).
+
   -t, --timeout=SECONDS
 
     Set the number of seconds before a remote call without a response times
     out. A value of zero disables the timeout (in this case the command can
-    hang indefinitely). The default is 10 seconds.
+    hang indefinitely). The default is 10 seconds. File transfers only time
+    out when no progress is made for the given number of seconds.
 
   -c, --character-device=PATH
 
@@ -41,6 +86,8 @@ Supported options:
     on /sys/class/virtio-ports/*/name. If the automatic selection doesn't work,
     you can set the absolute pathname of the character device that's used to
     communicate with the negotiator-host daemon running on the KVM/QEMU host.
+    When combined with --daemon and --multiplexer this applies to the channel
+    used by the daemon.
 
   -v, --verbose
 
@@ -56,20 +103,24 @@ Supported options:
 """
 
 # Standard library modules.
+import functools
 import getopt
 import logging
 import shlex
 import sys
-
-# External dependencies.
-import coloredlogs
-from humanfriendly import Timer
-from humanfriendly.terminal import usage, warning
+import time
 
 # Modules included in our project.
-from negotiator_common.config import GUEST_TO_HOST_CHANNEL_NAME, HOST_TO_GUEST_CHANNEL_NAME, DEFAULT_TIMEOUT
-from negotiator_common.utils import TimeOut
-from negotiator_guest import GuestAgent, find_character_device
+from negotiator_common import transfer
+from negotiator_common.config import (
+    DEFAULT_CONCURRENCY,
+    DEFAULT_TIMEOUT,
+    HOST_TO_GUEST_CHANNEL_NAME,
+)
+from negotiator_common.forkserver import ForkServer
+from negotiator_common.pipe import run_pipe
+from negotiator_common.utils import GracefulShutdown, TimeOut, Timer, configure_logging, get_redirected_input
+from negotiator_guest import GuestAgent, connect_to_host, find_character_device, start_multiplexer
 
 # Initialize a logger for this module.
 logger = logging.getLogger(__name__)
@@ -77,62 +128,139 @@ logger = logging.getLogger(__name__)
 
 def main():
     """Command line interface for the ``negotiator-guest`` program."""
-    # Initialize logging to the terminal and system log.
-    coloredlogs.install(syslog=True)
     # Parse the command line arguments.
+    verbosity = 0
     list_commands = False
     execute_command = None
+    pipe = False
+    push_file = None
+    pull_file = None
     start_daemon = False
+    multiplexer = False
+    fork_server = False
+    concurrency = DEFAULT_CONCURRENCY
     timeout = DEFAULT_TIMEOUT
     character_device = None
     try:
-        options, arguments = getopt.getopt(sys.argv[1:], 'le:dt:c:vqh', [
-            'list-commands', 'execute=', 'daemon', 'timeout=',
-            'character-device=', 'verbose', 'quiet', 'help'
+        options, arguments = getopt.getopt(sys.argv[1:], 'le:Ps:r:dmFC:t:c:vqh', [
+            'list-commands', 'execute=', 'pipe', 'push-file=', 'pull-file=', 'daemon',
+            'multiplexer', 'fork-server', 'concurrency=', 'timeout=', 'character-device=',
+            'verbose', 'quiet', 'help'
         ])
         for option, value in options:
             if option in ('-l', '--list-commands'):
                 list_commands = True
             elif option in ('-e', '--execute'):
                 execute_command = value
+            elif option in ('-P', '--pipe'):
+                pipe = True
+            elif option in ('-s', '--push-file'):
+                push_file = value
+            elif option in ('-r', '--pull-file'):
+                pull_file = value
             elif option in ('-d', '--daemon'):
                 start_daemon = True
+            elif option in ('-m', '--multiplexer'):
+                multiplexer = True
+            elif option in ('-F', '--fork-server'):
+                fork_server = True
+            elif option in ('-C', '--concurrency'):
+                concurrency = int(value)
             elif option in ('-t', '--timeout'):
                 timeout = int(value)
             elif option in ('-c', '--character-device'):
                 character_device = value
             elif option in ('-v', '--verbose'):
-                coloredlogs.increase_verbosity()
+                verbosity += 1
             elif option in ('-q', '--quiet'):
-                coloredlogs.decrease_verbosity()
+                verbosity -= 1
             elif option in ('-h', '--help'):
-                usage(__doc__)
-                sys.exit(0)
-        if not (list_commands or execute_command or start_daemon):
-            usage(__doc__)
-            sys.exit(0)
+                show_usage()
+        if not (list_commands or execute_command or pipe or push_file or pull_file or start_daemon or multiplexer):
+            show_usage()
     except Exception:
+        from humanfriendly.terminal import warning
         warning("Error: Failed to parse command line arguments!")
         sys.exit(1)
+    # Initialize logging to the terminal (and the system log for the daemons).
+    configure_logging(verbosity, syslog=start_daemon or multiplexer)
     # Start the guest daemon.
     try:
-        if not character_device:
-            channel_name = HOST_TO_GUEST_CHANNEL_NAME if start_daemon else GUEST_TO_HOST_CHANNEL_NAME
-            character_device = find_character_device(channel_name)
-        if start_daemon:
-            agent = GuestAgent(character_device=character_device, retry=False)
-            agent.enter_main_loop()
+        if start_daemon or multiplexer:
+            start_daemons(start_daemon, multiplexer, concurrency, character_device, fork_server)
         elif list_commands:
             with TimeOut(timeout):
-                agent = GuestAgent(character_device, retry=True)
+                agent = connect_to_host(character_device)
                 print('\n'.join(agent.call_remote_method('list_commands')))
         elif execute_command:
             with TimeOut(timeout):
                 timer = Timer()
-                agent = GuestAgent(character_device, retry=True)
-                output = agent.call_remote_method('execute', *shlex.split(execute_command), capture=True)
+                agent = connect_to_host(character_device)
+                returncode = agent.execute_remote_command(shlex.split(execute_command), input=get_redirected_input())
                 logger.debug("Took %s to execute remote command.", timer)
-                print(output.rstrip())
+            if returncode != 0:
+                logger.error("Remote command exited with status code %i!", returncode)
+                sys.exit(returncode)
+        elif pipe:
+            timer = Timer()
+            failures = run_pipe(functools.partial(connect_to_host, character_device), sys.stdin, sys.stdout, timeout)
+            logger.debug("Took %s to handle the commands for the host.", timer)
+            if failures:
+                logger.error("%i remote command(s) failed!", failures)
+                sys.exit(1)
+        elif push_file:
+            with TimeOut(timeout) as alarm:
+                agent = connect_to_host(character_device)
+                transfer.push_file(agent, push_file, progress=alarm.reset)
+        elif pull_file:
+            with TimeOut(timeout) as alarm:
+                agent = connect_to_host(character_device)
+                transfer.pull_file(agent, pull_file, progress=alarm.reset)
     except Exception:
         logger.exception("Caught a fatal exception! Terminating ..")
         sys.exit(1)
+
+
+def show_usage():
+    """Show the usage message and exit."""
+    from humanfriendly.terminal import usage
+    usage(__doc__)
+    sys.exit(0)
+
+
+def start_daemons(start_daemon, multiplexer, concurrency, character_device, fork_server=False):
+    """
+    Start the guest daemon and/or the multiplexer.
+
+    :param start_daemon: :data:`True` to start the guest daemon.
+    :param multiplexer: :data:`True` to start the multiplexer.
+    :param concurrency: The number of requests from the host that the guest
+                        daemon handles at the same time (an integer).
+    :param character_device: The absolute pathname of the character device
+                             (a string or :data:`None`, see ``--help``).
+    :param fork_server: :data:`True` to make the guest daemon start commands
+                        using a :class:`~negotiator_common.forkserver.ForkServer`.
+    """
+    server = None
+    launcher = None
+    try:
+        with GracefulShutdown():
+            if start_daemon and fork_server:
+                # The fork server is started before the multiplexer starts any threads.
+                launcher = ForkServer()
+            if multiplexer:
+                server = start_multiplexer(None if start_daemon else character_device)
+            if start_daemon:
+                character_device = character_device or find_character_device(HOST_TO_GUEST_CHANNEL_NAME)
+                agent = GuestAgent(character_device=character_device, retry=False)
+                agent.fork_server = launcher
+                agent.enter_main_loop(concurrency=concurrency)
+            else:
+                # Calls are handled by the multiplexer's background thread.
+                while True:
+                    time.sleep(60)
+    finally:
+        if server:
+            server.stop()
+        if launcher:
+            launcher.stop()
@@ -1,7 +1,7 @@
 # Scriptable KVM/QEMU guest agent in Python.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: December 9, 2019
+# Last Change: October 16, 2026
 # URL: https://negotiator.readthedocs.org
 
 """
@@ -13,20 +13,43 @@ used to query and command running guests.
 """
 
 # Standard library modules.
+import fnmatch
+import functools
+import json
 import logging
 import multiprocessing
 import os
 import socket
+import threading
 import time
-import xml.etree.ElementTree
 
 # Modules included in our project.
-from negotiator_common import NegotiatorInterface
-from negotiator_common.config import GUEST_TO_HOST_CHANNEL_NAME, HOST_TO_GUEST_CHANNEL_NAME, SUPPORTED_CHANNEL_NAMES
-from negotiator_common.utils import GracefulShutdown
-
-# External dependencies.
-from executor import ExternalCommandFailed, execute
+from negotiator_common import NegotiatorInterface, ProtocolError
+from negotiator_common.broker import BrokerClient, BrokerSession, ControlServer, SingleFlight, forward_call
+from negotiator_common.config import (
+    COALESCED_METHODS,
+    DEFAULT_CONCURRENCY,
+    DISCOVERY_CONCURRENCY,
+    DISCOVERY_FALLBACK_INTERVAL,
+    DISCOVERY_INTERVAL,
+    EVENT_LOOP_CONCURRENCY,
+    FILE_TRANSFER_DIRECTORY,
+    GUEST_TO_HOST_CHANNEL_NAME,
+    HOST_CONTROL_SOCKET,
+    HOST_TO_GUEST_CHANNEL_NAME,
+    LIBVIRT_STATE_DIRECTORY,
+    SUPPORTED_CHANNEL_NAMES,
+)
+from negotiator_common.eventloop import ChannelReader, EventLoop
+from negotiator_common.forkserver import ForkServer
+from negotiator_common.utils import (
+    GracefulShutdown,
+    Timer,
+    WorkerPool,
+    configure_logging,
+    iterate_concurrently,
+    logging_options,
+)
 
 # Semi-standard module versioning.
 __version__ = '0.12.2'
@@ -39,29 +62,166 @@ class HostDaemon(object):
 
     """The host daemon automatically manages a group of processes that handle "guest to host" calls."""
 
-    def __init__(self):
-        """Initialize the host daemon."""
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, state_directory=LIBVIRT_STATE_DIRECTORY,
+                 control_socket=HOST_CONTROL_SOCKET, enter_main_loop=True):
+        """
+        Initialize the host daemon.
+
+        :param concurrency: The number of requests from each guest that are
+                            handled at the same time (an integer, defaults to
+                            :data:`.DEFAULT_CONCURRENCY`).
+        :param state_directory: The directory where libvirt keeps the live XML
+                                definitions of running guests (a string,
+                                defaults to :data:`.LIBVIRT_STATE_DIRECTORY`).
+        :param control_socket: The pathname of the UNIX socket where calls for
+                               guests are accepted (a string, defaults to
+                               :data:`.HOST_CONTROL_SOCKET`) or :data:`None`
+                               to disable the control socket (see
+                               :class:`ControlSession`).
+        :param enter_main_loop: :data:`True` to call :func:`enter_main_loop()`
+                                from the constructor (the default, in which
+                                case the constructor never returns),
+                                :data:`False` to call it yourself (or to
+                                drive the daemon using :func:`run_once()`).
+
+        The running guests are found in `state_directory` (see
+        :func:`DiscoveryCache.find_running_guests()`), so a temporary
+        directory with XML files can be used to drive the daemon.
+        """
+        self.concurrency = concurrency
+        self.state_directory = state_directory
         self.workers = {}
-        self.guests_to_ignore = set()
-        self.enter_main_loop()
+        self.discovery = DiscoveryCache(state_directory)
+        self.channels = WarmChannels(self.discovery)
+        self.control_server = (ControlServer(control_socket, functools.partial(ControlSession, channels=self.channels,
+                                                                               flights=SingleFlight()))
+                               if control_socket else None)
+        self.guests_to_ignore = {}
+        self.watcher = None
+        self.changes_detected = False
+        self.last_update = None
+        self.worker_start_method = None
+        if enter_main_loop:
+            self.enter_main_loop()
 
     def enter_main_loop(self):
-        """Create and maintain active channels for all running guests."""
+        """
+        Create and maintain active channels for all running guests.
+
+        When libvirt's state directory can be watched (see
+        :func:`watch_state_directory()`) the workers are synchronized as soon
+        as guests are started or stopped. Otherwise we fall back to checking
+        for guests every :data:`.DISCOVERY_INTERVAL` seconds.
+        """
         with GracefulShutdown():
+            if self.control_server and not self.control_server.start():
+                self.control_server = None
             try:
                 while True:
-                    self.update_workers()
-                    time.sleep(10)
+                    self.run_once(DISCOVERY_INTERVAL)
             finally:
-                for channel in self.workers.values():
-                    channel.terminate()
+                self.shutdown()
+
+    def run_once(self, seconds):
+        """
+        Synchronize the workers when needed and wait for guests to be started or stopped.
+
+        :param seconds: The maximum number of seconds to wait (a number).
+        """
+        self.watch_state_directory()
+        if self.discovery_needed():
+            self.changes_detected = False
+            self.update_workers()
+            self.last_update = Timer()
+        self.wait(seconds)
+
+    def shutdown(self):
+        """Terminate the workers and release the resources of the host daemon."""
+        for channel in self.workers.values():
+            channel.terminate()
+        self.workers.clear()
+        if self.watcher:
+            self.stop_watching()
+        if self.control_server:
+            self.control_server.stop()
+        self.channels.close()
+
+    def watch_state_directory(self):
+        """Start watching libvirt's state directory for changes (when it's not already being watched)."""
+        if self.watcher and self.watcher.removed:
+            self.stop_watching()
+        if not self.watcher:
+            from negotiator_host.inotify import DirectoryWatcher
+            self.watcher = DirectoryWatcher.create(self.state_directory, '*.xml')
+            if self.watcher:
+                # Changes may have been missed while the directory wasn't watched.
+                self.changes_detected = True
+
+    def stop_watching(self):
+        """Stop watching libvirt's state directory for changes."""
+        self.watcher.close()
+        self.watcher = None
+
+    def discovery_needed(self):
+        """
+        Check whether the workers need to be synchronized.
+
+        :returns: :data:`True` when guests may have been started or stopped
+                  or a worker has crashed, :data:`False` otherwise.
+        """
+        return (self.last_update is None or
+                not (self.watcher and not self.watcher.removed) or
+                self.changes_detected or
+                self.last_update.elapsed_time >= DISCOVERY_FALLBACK_INTERVAL or
+                not all(worker.is_alive() for worker in self.workers.values()))
+
+    def wait(self, seconds):
+        """
+        Wait for guests to be started or stopped.
+
+        :param seconds: The maximum number of seconds to wait (a number).
+        """
+        if self.watcher and not self.watcher.removed:
+            if self.watcher.wait(seconds):
+                self.changes_detected = True
+        else:
+            time.sleep(seconds)
 
     def update_workers(self):
         """Automatically spawn subprocesses (workers) to maintain connections to all guests."""
         logger.debug("Synchronizing workers to channels ..")
-        running_guests = set(find_running_guests())
+        running_guests = set(self.discovery.find_running_guests())
+        self.channels.retain(running_guests)
         self.cleanup_workers(running_guests)
         self.spawn_workers(running_guests)
+        self.report_resource_usage()
+
+    def report_resource_usage(self):
+        """Log the memory used by the host daemon and its workers."""
+        from humanfriendly import format_size
+        pids = [os.getpid()] + [w.pid for w in self.workers.values() if getattr(w, 'pid', None)]
+        logger.debug("Serving %i guests using %i processes with %s of resident memory.",
+                     len(self.workers), len(pids), format_size(sum(map(get_resident_memory, pids))))
+
+    def create_worker(self, guest_name, unix_socket):
+        """
+        Start a worker that handles the requests from a guest.
+
+        :param guest_name: The name of the guest (a string).
+        :param unix_socket: The absolute pathname of the UNIX socket of the
+                            guest to host channel (a string).
+        :returns: An :class:`AutomaticGuestChannel` object.
+        """
+        if not self.worker_start_method:
+            self.worker_start_method = select_start_method()
+        worker = AutomaticGuestChannel(
+            guest_name=guest_name,
+            unix_socket=unix_socket,
+            concurrency=self.concurrency,
+            start_method=self.worker_start_method,
+        )
+        worker.start()
+        return worker
 
     def cleanup_workers(self, running_guests):
         """Cleanup crashed workers and workers for guests that are no longer running."""
@@ -71,27 +231,160 @@ class HostDaemon(object):
                 logger.warning("[%s] Cleaning up crashed worker ..", guest_name)
                 self.workers.pop(guest_name)
             # Check for and terminate workers for guests that are no longer running.
-            if guest_name not in running_guests:
+            elif guest_name not in running_guests:
                 logger.info("[%s] Terminating worker because guest is no longer running ..", guest_name)
                 self.workers[guest_name].terminate()
                 self.workers.pop(guest_name)
 
     def spawn_workers(self, running_guests):
         """Spawn new workers on demand (ignoring guests known not to support negotiator)."""
-        for guest_name in sorted(running_guests - self.guests_to_ignore):
-            if guest_name not in self.workers:
-                available_channels = find_channels_of_guest(guest_name)
-                if GUEST_TO_HOST_CHANNEL_NAME in available_channels:
-                    logger.info("[%s] Initializing worker for guest ..", guest_name)
-                    self.workers[guest_name] = AutomaticGuestChannel(
-                        guest_name=guest_name, unix_socket=available_channels[GUEST_TO_HOST_CHANNEL_NAME],
-                    )
-                    self.workers[guest_name].start()
-                else:
-                    # Don't keep running 'virsh dumpxml' for this guest when we
-                    # know that it is not configured to support negotiator.
-                    logger.info("[%s] Doesn't support negotiator, adding to ignore list ..", guest_name)
-                    self.guests_to_ignore.add(guest_name)
+        candidates = [g for g in sorted(running_guests) if g not in self.workers and not self.is_ignored(g)]
+        # The channels of guests are discovered concurrently, workers are
+        # started (by the main thread) as soon as the channels are known.
+        for guest_name, available_channels, error in iterate_concurrently(self.discovery.find_channels,
+                                                                          candidates, DISCOVERY_CONCURRENCY):
+            if error:
+                logger.warning("[%s] Failed to discover channels of guest! (%s)", guest_name, error)
+                continue
+            if self.control_server and HOST_TO_GUEST_CHANNEL_NAME in available_channels:
+                # Connect to the guest before the first call arrives.
+                try:
+                    self.channels.connect(guest_name, available_channels[HOST_TO_GUEST_CHANNEL_NAME])
+                except GuestChannelInitializationError:
+                    logger.warning("[%s] Failed to connect to host to guest channel! (will retry on demand)",
+                                   guest_name)
+            if GUEST_TO_HOST_CHANNEL_NAME in available_channels:
+                logger.info("[%s] Initializing worker for guest ..", guest_name)
+                worker = self.create_worker(guest_name, available_channels[GUEST_TO_HOST_CHANNEL_NAME])
+                if worker:
+                    self.workers[guest_name] = worker
+            else:
+                # Don't keep checking this guest when we know that it is
+                # not configured to support negotiator (until its
+                # definition changes, see is_ignored()).
+                logger.info("[%s] Doesn't support negotiator, adding to ignore list ..", guest_name)
+                self.guests_to_ignore[guest_name] = self.discovery.get_signature(guest_name)
+
+    def is_ignored(self, guest_name):
+        """
+        Check whether a guest is known not to support negotiator.
+
+        :param guest_name: The name of the guest (a string).
+        :returns: :data:`True` when the guest was added to the ignore list
+                  and its live XML definition hasn't changed since,
+                  :data:`False` otherwise.
+        """
+        if guest_name in self.guests_to_ignore:
+            if self.guests_to_ignore[guest_name] == self.discovery.get_signature(guest_name):
+                return True
+            logger.info("[%s] Definition of guest changed, removing from ignore list ..", guest_name)
+            del self.guests_to_ignore[guest_name]
+        return False
+
+
+class EventLoopHostDaemon(HostDaemon):
+
+    """
+    Host daemon that serves all guests from a single process.
+
+    Where :class:`HostDaemon` starts a separate process for every guest, this
+    daemon waits for requests from all guests using a single
+    :class:`~negotiator_common.eventloop.EventLoop` and handles the requests
+    using a shared pool of worker threads. This uses a lot less memory on
+    hosts running many guests.
+    """
+
+    def __init__(self, concurrency=EVENT_LOOP_CONCURRENCY, state_directory=LIBVIRT_STATE_DIRECTORY,
+                 control_socket=HOST_CONTROL_SOCKET, fork_server=False, enter_main_loop=True):
+        """
+        Initialize the host daemon.
+
+        :param concurrency: The number of requests (from all guests combined)
+                            that are handled at the same time (an integer,
+                            defaults to :data:`.EVENT_LOOP_CONCURRENCY`).
+        :param state_directory: The directory where libvirt keeps the live XML
+                                definitions of running guests (a string,
+                                defaults to :data:`.LIBVIRT_STATE_DIRECTORY`).
+        :param control_socket: Refer to :class:`HostDaemon`.
+        :param fork_server: :data:`True` to start the commands requested by
+                            guests using a
+                            :class:`~negotiator_common.forkserver.ForkServer`,
+                            :data:`False` to start them directly (the default).
+        :param enter_main_loop: Refer to :class:`HostDaemon`.
+        """
+        # The fork server is started before any threads.
+        self.fork_server = ForkServer() if fork_server else None
+        self.event_loop = EventLoop()
+        self.pool = WorkerPool(concurrency, queue_size=concurrency * 64)
+        super(EventLoopHostDaemon, self).__init__(concurrency=concurrency, state_directory=state_directory,
+                                                  control_socket=control_socket, enter_main_loop=enter_main_loop)
+
+    def enter_main_loop(self):
+        """Create and maintain active channels for all running guests (see :class:`HostDaemon`)."""
+        try:
+            super(EventLoopHostDaemon, self).enter_main_loop()
+        finally:
+            if self.fork_server:
+                self.fork_server.stop()
+
+    def watch_state_directory(self):
+        """Start watching libvirt's state directory for changes using the event loop."""
+        watcher = self.watcher
+        super(EventLoopHostDaemon, self).watch_state_directory()
+        if self.watcher and self.watcher is not watcher:
+            self.event_loop.register(self.watcher, self.handle_changes)
+
+    def stop_watching(self):
+        """Stop watching libvirt's state directory for changes using the event loop."""
+        self.event_loop.unregister(self.watcher)
+        super(EventLoopHostDaemon, self).stop_watching()
+
+    def handle_changes(self, mask):
+        """
+        Read the changes to libvirt's state directory.
+
+        :param mask: The event mask (an integer).
+        """
+        if self.watcher.read_changes():
+            self.changes_detected = True
+
+    def wait(self, seconds):
+        """
+        Handle requests from guests until guests are started or stopped.
+
+        :param seconds: The maximum number of seconds to handle requests (a number).
+        """
+        self.event_loop.run_until(seconds, lambda: self.changes_detected)
+
+    def report_resource_usage(self):
+        """Log the memory used by the host daemon and the latency of requests."""
+        from humanfriendly import format_timespan
+        super(EventLoopHostDaemon, self).report_resource_usage()
+        for guest_name, worker in sorted(self.workers.items()):
+            if worker.requests_handled:
+                logger.debug("[%s] Handled %i requests with an average latency of %s.", guest_name,
+                             worker.requests_handled, format_timespan(worker.average_latency))
+
+    def create_worker(self, guest_name, unix_socket):
+        """
+        Start reading the requests from a guest.
+
+        :param guest_name: The name of the guest (a string).
+        :param unix_socket: The absolute pathname of the UNIX socket of the
+                            guest to host channel (a string).
+        :returns: A :class:`~negotiator_common.eventloop.ChannelReader`
+                  object (or :data:`None` when connecting to the guest fails,
+                  in which case we'll try again in a bit).
+        """
+        try:
+            channel = GuestChannel(guest_name, unix_socket)
+        except GuestChannelInitializationError:
+            logger.error("[%s] Failed to initialize channel to guest! (will retry in a bit)", guest_name)
+            return None
+        channel.fork_server = self.fork_server
+        reader = ChannelReader(channel, channel.socket, self.event_loop, self.pool)
+        reader.start()
+        return reader
 
 
 class AutomaticGuestChannel(multiprocessing.Process):
@@ -100,30 +393,50 @@ class AutomaticGuestChannel(multiprocessing.Process):
     Thin wrapper for :class:`GuestChannel` that puts it in a separate process.
 
     Uses :class:`multiprocessing.Process` to isolate guest channels in
-    separate processes.
+    separate processes. The host daemon starts these processes using the
+    ``forkserver`` start method where available (see
+    :func:`select_start_method()`), so that workers aren't forked from the
+    (multi threaded) host daemon.
     """
 
-    def __init__(self, guest_name, unix_socket):
+    def __init__(self, guest_name, unix_socket, concurrency=DEFAULT_CONCURRENCY, start_method=None):
         """
         Initialize a :class:`GuestChannel` in a separate process.
 
         :param guest_name: The name of the guest to connect to (a string).
         :param unix_socket: The absolute pathname of the UNIX socket that we
                             should connect to (a string).
+        :param concurrency: The number of requests to handle at the same time
+                            (an integer, defaults to :data:`.DEFAULT_CONCURRENCY`).
+        :param start_method: The :mod:`multiprocessing` start method used to
+                             start the process (a string, defaults to
+                             :data:`None` which means the default start
+                             method is used).
         """
         # Initialize the super class.
         super(AutomaticGuestChannel, self).__init__()
         # Store the arguments to the constructor.
         self.guest_name = guest_name
         self.unix_socket = unix_socket
+        self.concurrency = concurrency
+        self.start_method = start_method
+        self.logging_options = dict(logging_options)
+
+    @staticmethod
+    def _Popen(process):
+        """Start the process using the start method given to the constructor (Python 3.4+)."""
+        return multiprocessing.get_context(process.start_method).Process._Popen(process)
 
     def run(self):
         """Start the main loop of the common negotiator interface."""
+        if self.logging_options and not logging.getLogger().handlers:
+            # The worker wasn't forked from the host daemon.
+            configure_logging(**self.logging_options)
         try:
             # Initialize the guest to host channel.
             channel = GuestChannel(self.guest_name, self.unix_socket)
             # Wait for messages from the other side.
-            channel.enter_main_loop()
+            channel.enter_main_loop(concurrency=self.concurrency)
         except GuestChannelInitializationError:
             # We know what the reason is here, so there's no need to log a noisy traceback.
             logger.error("[%s] Failed to initialize channel to guest! (worker will respawn in a bit)", self.guest_name)
@@ -144,15 +457,21 @@ class GuestChannel(NegotiatorInterface):
     :class:`GuestChannel` and puts it in its own process.
     """
 
-    def __init__(self, guest_name, unix_socket=None):
+    def __init__(self, guest_name, unix_socket=None, timeout=None):
         """
         Initialize a negotiator host agent.
 
         :param guest_name: The name of the guest to connect to (a string).
         :param unix_socket: The absolute pathname of the UNIX socket that we
                             should connect to (a string, optional).
+        :param timeout: The number of seconds after which connecting to,
+                        reading from or writing to the UNIX socket times out
+                        (a number, optional). Unlike
+                        :class:`~negotiator_common.utils.TimeOut` this works
+                        in any thread.
         """
         self.guest_name = guest_name
+        self.transfer_directory = get_transfer_directory(guest_name)
         # Figure out the pathname of the UNIX socket?
         if not unix_socket:
             available_channels = find_channels_of_guest(guest_name)
@@ -165,27 +484,222 @@ class GuestChannel(NegotiatorInterface):
         # Connect to the UNIX socket.
         logger.debug("[%s] Opening UNIX socket (%s) ..", self.guest_name, unix_socket)
         self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
         try:
             logger.debug("[%s] Connecting to UNIX socket ..", self.guest_name)
             self.socket.connect(unix_socket)
         except Exception:
             raise GuestChannelInitializationError("Guest refused connection attempt!")
         logger.debug("[%s] Successfully connected to UNIX socket!", self.guest_name)
-        # Initialize the super class, passing it a file like object connected
-        # to the character device in read/write mode.
-        super(GuestChannel, self).__init__(handle=self.socket.makefile(),
+        # Initialize the super class, passing it a binary file like object
+        # connected to the UNIX socket in read/write mode.
+        super(GuestChannel, self).__init__(handle=self.socket.makefile('rwb'),
                                            label="UNIX socket %s" % unix_socket)
 
-    def prepare_environment(self):
+    def get_environment(self):
         """
-        Prepare environment variables for command execution on KVM/QEMU hosts.
+        Get the environment variables for command execution on KVM/QEMU hosts.
 
         The following environment variables are currently exposed to commands:
 
         ``$NEGOTIATOR_GUEST``
           The name of the KVM/QEMU guest that invoked the command.
         """
-        os.environ['NEGOTIATOR_GUEST'] = self.guest_name
+        return dict(NEGOTIATOR_GUEST=self.guest_name)
+
+    def close(self):
+        """Close the connection to the guest."""
+        try:
+            self.conn_handle.close()
+        except EnvironmentError:
+            pass
+        self.socket.close()
+
+
+class BrokeredGuestChannel(BrokerClient):
+
+    """
+    Call the methods of a guest through the control socket of the host daemon.
+
+    This has the same API as :class:`GuestChannel`, but the calls are sent
+    over the connection to the guest that the host daemon keeps open (see
+    :class:`ControlSession`) which avoids channel discovery and connection
+    setup. Use :func:`connect_to_guest()` to fall back to a direct
+    connection when the host daemon isn't running.
+    """
+
+    def __init__(self, guest_name, control_socket=HOST_CONTROL_SOCKET, timeout=None):
+        """
+        Connect to the control socket of the host daemon.
+
+        :param guest_name: The name of the guest to call (a string).
+        :param control_socket: The pathname of the control socket (a string,
+                               defaults to :data:`.HOST_CONTROL_SOCKET`).
+        :param timeout: The number of seconds after which reading from or
+                        writing to the control socket times out (a number,
+                        optional).
+        :raises: :exc:`~exceptions.EnvironmentError` when connecting fails.
+        """
+        self.guest_name = guest_name
+        super(BrokeredGuestChannel, self).__init__(control_socket, 'call_guest', (guest_name,), timeout)
+
+
+class ControlSession(BrokerSession):
+
+    """The host daemon's side of a connection to its control socket (see :class:`BrokeredGuestChannel`)."""
+
+    exported_methods = ('select_codec', 'call_guest')
+
+    def __init__(self, handle, label, channels, flights=None):
+        """
+        Initialize a :class:`ControlSession` object.
+
+        :param handle: A binary file like object connected to the client.
+        :param label: A string describing the client (used in logging).
+        :param channels: The :class:`WarmChannels` object of the host daemon.
+        :param flights: The :class:`~negotiator_common.broker.SingleFlight`
+                        object shared by the clients of the host daemon (used
+                        to coalesce identical calls, see :data:`.COALESCED_METHODS`)
+                        or :data:`None` to disable coalescing.
+        """
+        super(ControlSession, self).__init__(handle, label)
+        self.channels = channels
+        self.flights = flights
+
+    def call_guest(self, guest_name, method, args=(), kw=None):
+        """
+        Call a method of a guest on behalf of a client.
+
+        :param guest_name: The name of the guest (a string).
+        :param method: The name of the method to call (a string).
+        :param args: The positional arguments for the method (a list).
+        :param kw: The keyword arguments for the method (a dictionary).
+        :returns: The return value of the method (see
+                  :func:`~negotiator_common.broker.forward_call()`).
+
+        Identical calls of the methods in :data:`.COALESCED_METHODS` that
+        are made by different clients at the same time share a single call
+        (unless input is streamed to the command).
+        """
+        function = functools.partial(self.forward_to_guest, guest_name, method, args, kw or {})
+        if self.flights and method in COALESCED_METHODS and not (kw or {}).get('input_stream'):
+            try:
+                key = (guest_name, method, json.dumps([args, kw or {}], sort_keys=True))
+            except (TypeError, ValueError):
+                # Binary arguments can't be compared this way.
+                return function()
+            return self.flights.call(key, function)
+        return function()
+
+    def forward_to_guest(self, guest_name, method, args, kw):
+        """
+        Forward a call to a guest (see :func:`call_guest()`).
+
+        :param guest_name: The name of the guest (a string).
+        :param method: The name of the method to call (a string).
+        :param args: The positional arguments for the method (a list).
+        :param kw: The keyword arguments for the method (a dictionary).
+        :returns: The return value of the method (see
+                  :func:`~negotiator_common.broker.forward_call()`).
+        """
+        channel = self.channels.get(guest_name)
+        try:
+            return forward_call(channel, method, args, kw)
+        except (EnvironmentError, ProtocolError):
+            # Reconnect on the next call (the guest may have been restarted).
+            self.channels.discard(guest_name, channel)
+            raise
+
+
+class WarmChannels(object):
+
+    """Connections to the host to guest channels of running guests that are kept open between calls."""
+
+    def __init__(self, discovery):
+        """
+        Initialize a :class:`WarmChannels` object.
+
+        :param discovery: The :class:`DiscoveryCache` used to find the UNIX
+                          sockets of guests.
+        """
+        self.discovery = discovery
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def get(self, guest_name):
+        """
+        Get the connection to a guest.
+
+        :param guest_name: The name of the guest (a string).
+        :returns: A :class:`GuestChannel` object.
+        :raises: :exc:`GuestChannelInitializationError` when connecting fails.
+        """
+        with self.lock:
+            channel = self.channels.get(guest_name)
+        return channel or self.connect(guest_name)
+
+    def connect(self, guest_name, unix_socket=None):
+        """
+        Connect to a guest (unless we're already connected).
+
+        :param guest_name: The name of the guest (a string).
+        :param unix_socket: The pathname of the UNIX socket of the host to
+                            guest channel (a string, optional).
+        :returns: A :class:`GuestChannel` object.
+        :raises: :exc:`GuestChannelInitializationError` when connecting fails.
+        """
+        with self.lock:
+            if guest_name in self.channels:
+                return self.channels[guest_name]
+        if not unix_socket:
+            unix_socket = self.discovery.find_channels(guest_name).get(HOST_TO_GUEST_CHANNEL_NAME)
+            if not unix_socket:
+                raise GuestChannelInitializationError("Guest %s doesn't have a host to guest channel!" % guest_name)
+        logger.debug("[%s] Opening connection to host to guest channel ..", guest_name)
+        channel = GuestChannel(guest_name, unix_socket)
+        with self.lock:
+            existing = self.channels.setdefault(guest_name, channel)
+        if existing is not channel:
+            # Another thread connected at the same time.
+            channel.close()
+        return existing
+
+    def discard(self, guest_name, channel=None):
+        """
+        Close the connection to a guest.
+
+        :param guest_name: The name of the guest (a string).
+        :param channel: The :class:`GuestChannel` to close (optional, used to
+                        avoid closing a newer connection).
+        """
+        with self.lock:
+            if guest_name in self.channels and channel in (None, self.channels[guest_name]):
+                channel = self.channels.pop(guest_name)
+            else:
+                channel = None
+        if channel:
+            logger.debug("[%s] Closing connection to host to guest channel ..", guest_name)
+            channel.close()
+
+    def retain(self, guest_names):
+        """
+        Close the connections to guests that are no longer running.
+
+        :param guest_names: The names of the running guests (a set of strings).
+        """
+        for guest_name in self.get_guest_names():
+            if guest_name not in guest_names:
+                self.discard(guest_name)
+
+    def get_guest_names(self):
+        """Get the names of the guests that we're connected to (a sorted list of strings)."""
+        with self.lock:
+            return sorted(self.channels)
+
+    def close(self):
+        """Close the connections to all guests."""
+        for guest_name in self.get_guest_names():
+            self.discard(guest_name)
 
 
 class GuestChannelInitializationError(Exception):
@@ -198,22 +712,251 @@ class GuestDiscoveryError(Exception):
     """Exception raised by :func:`find_running_guests()` when ``virsh list`` fails."""
 
 
-def find_supported_guests():
+def get_resident_memory(pid):
+    """
+    Get the resident memory (RSS) of a process.
+
+    :param pid: The process ID (an integer).
+    :returns: The resident memory in bytes (an integer, zero when the process
+              doesn't exist or ``/proc`` isn't available).
+    """
+    try:
+        with open('/proc/%i/statm' % pid) as handle:
+            return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (EnvironmentError, IndexError, ValueError):
+        return 0
+
+
+def select_start_method():
+    """
+    Prepare the :mod:`multiprocessing` start method for the workers of the host daemon.
+
+    :returns: The name of the start method (a string).
+
+    On Python 3.4+ the workers are started by a server process that doesn't
+    run any threads, because the host daemon does run threads (for example
+    to serve the control socket) and forking a multi threaded process can
+    deadlock the child (e.g. on a lock held by the logging module). This
+    changes process wide :mod:`multiprocessing` state, which is why it's
+    only done by the host daemon (when it starts its first worker) and not
+    when this module is imported.
+    """
+    try:
+        multiprocessing.get_context('forkserver')
+        multiprocessing.set_forkserver_preload(['negotiator_host'])
+        return 'forkserver'
+    except (AttributeError, ValueError):
+        # Python 2 only supports forking.
+        return 'fork'
+
+
+def get_transfer_directory(guest_name, parent_directory=FILE_TRANSFER_DIRECTORY):
+    """
+    Get the file transfer directory of a KVM/QEMU guest.
+
+    :param guest_name: The name of the guest (a string).
+    :param parent_directory: The directory that contains the file transfer
+                             directories of all guests (a string, defaults
+                             to :data:`.FILE_TRANSFER_DIRECTORY`).
+    :returns: The pathname of a subdirectory of the parent directory (a string).
+
+    Every guest gets its own subdirectory so that guests can't read or
+    overwrite each other's files. The subdirectory is created when the parent
+    directory exists (file transfers are disabled when it doesn't).
+    """
+    # Make sure the name can't refer to a directory outside of (or equal to)
+    # the parent directory.
+    directory = os.path.join(parent_directory, guest_name.replace(os.sep, '_').lstrip('.') or '_')
+    if os.path.isdir(parent_directory) and not os.path.isdir(directory):
+        try:
+            os.mkdir(directory)
+        except EnvironmentError as e:
+            if not os.path.isdir(directory):
+                logger.warning("[%s] Failed to create file transfer directory! (%s)", guest_name, e)
+    return directory
+
+
+class DiscoveryCache(object):
+
+    """
+    Cache for the channels of guests (see :func:`find_channels_of_guest()`).
+
+    The live XML definitions of running guests are read directly from
+    libvirt's state directory (instead of running ``virsh dumpxml``) and the
+    discovered channels are cached until the live XML definition of the guest
+    changes. When the live XML definition can't be read (for example because
+    we don't have permission) ``virsh dumpxml`` is used instead, in that case
+    the channels aren't cached.
+    """
+
+    def __init__(self, state_directory=LIBVIRT_STATE_DIRECTORY):
+        """
+        Initialize a :class:`DiscoveryCache` object.
+
+        :param state_directory: The directory where libvirt keeps the live XML
+                                definitions of running guests (a string,
+                                defaults to :data:`.LIBVIRT_STATE_DIRECTORY`).
+        """
+        self.state_directory = state_directory
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def find_running_guests(self):
+        """
+        Find the names of the running guests using the state directory.
+
+        :returns: A list of strings.
+        :raises: :exc:`GuestDiscoveryError` when the state directory can't be
+                 read and ``virsh list`` fails.
+
+        Libvirt keeps a live XML definition in the state directory for every
+        running guest, so listing the directory doesn't need to fork
+        ``virsh list``. When the state directory can't be read (for example
+        because we don't have permission) :func:`~negotiator_host.find_running_guests()`
+        is used instead.
+        """
+        try:
+            filenames = os.listdir(self.state_directory)
+        except EnvironmentError as e:
+            logger.debug("Failed to list %s! (%s)", self.state_directory, e)
+            return list(find_running_guests())
+        return [fn[:-len('.xml')] for fn in filenames if fn.endswith('.xml') and not fn.startswith('.')]
+
+    def get_signature(self, guest_name):
+        """
+        Get a value that changes whenever the live XML definition of a guest changes.
+
+        :param guest_name: The name of the guest (a string).
+        :returns: A tuple with the inode number, size and last modification
+                  time of the live XML definition or :data:`None` when it
+                  doesn't exist.
+        """
+        try:
+            stat = os.stat(self.get_pathname(guest_name))
+            return (stat.st_ino, stat.st_size, stat.st_mtime)
+        except EnvironmentError:
+            return None
+
+    def get_pathname(self, guest_name):
+        """
+        Get the pathname of the live XML definition of a guest.
+
+        :param guest_name: The name of the guest (a string).
+        :returns: The pathname of the XML file (a string).
+        """
+        return os.path.join(self.state_directory, '%s.xml' % guest_name)
+
+    def find_channels(self, guest_name):
+        """
+        Find the pathnames of the channels associated to a guest.
+
+        :param guest_name: The name of the guest (a string).
+        :returns: A dictionary with channel names (strings) as keys and
+                  pathnames of UNIX socket files (strings) as values (see
+                  :func:`find_channels_of_guest()`).
+        """
+        signature = self.get_signature(guest_name)
+        if signature:
+            with self.lock:
+                entry = self.entries.get(guest_name)
+            if entry and entry[0] == signature:
+                logger.debug("Using cached channels of '%s'.", guest_name)
+                return dict(entry[1])
+            try:
+                logger.debug("Discovering '%s' channels using live XML definition ..", guest_name)
+                with open(self.get_pathname(guest_name), 'rb') as handle:
+                    channels = parse_channels(handle.read())
+            except EnvironmentError as e:
+                logger.debug("Failed to read live XML definition of '%s'! (%s)", guest_name, e)
+            else:
+                with self.lock:
+                    self.entries[guest_name] = (signature, channels)
+                return dict(channels)
+        logger.debug("Discovering '%s' channels using 'virsh dumpxml' command ..", guest_name)
+        # Imported on demand to keep the start-up time of the command line programs low.
+        from executor import execute
+        return parse_channels(execute('virsh', 'dumpxml', guest_name, capture=True))
+
+
+def find_supported_guests(concurrency=DISCOVERY_CONCURRENCY):
     """
     Find guests supporting the negotiator interface.
 
-    :returns: A generator of strings with guest names.
+    :param concurrency: The maximum number of guests to check at the same time
+                        (an integer, defaults to :data:`.DISCOVERY_CONCURRENCY`).
+    :returns: A generator of strings with guest names (in the order in which
+              the checks complete).
 
     This function uses :func:`find_running_guests()` to determine which guests
     are currently running and then uses :func:`find_channels_of_guest()` to
     determine which guests support the negotiator interface.
     """
-    for guest_name in sorted(find_running_guests()):
-        matches = find_channels_of_guest(guest_name)
-        if HOST_TO_GUEST_CHANNEL_NAME in matches:
+    for guest_name, matches, error in iterate_concurrently(find_channels_of_guest, find_running_guests(), concurrency):
+        if error:
+            logger.warning("Failed to discover channels of guest '%s'! (%s)", guest_name, error)
+        elif HOST_TO_GUEST_CHANNEL_NAME in matches:
             yield guest_name
 
 
+def connect_to_guest(guest_name, timeout=None, control_socket=HOST_CONTROL_SOCKET):
+    """
+    Connect to a guest through the host daemon or directly.
+
+    :param guest_name: The name of the guest (a string).
+    :param timeout: The number of seconds after which socket operations time
+                    out (a number, optional).
+    :param control_socket: The pathname of the control socket of the host
+                           daemon (a string, defaults to
+                           :data:`.HOST_CONTROL_SOCKET`).
+    :returns: A :class:`BrokeredGuestChannel` object when the host daemon is
+              running, a :class:`GuestChannel` object otherwise.
+    :raises: :exc:`GuestChannelInitializationError` when connecting directly
+             fails.
+
+    While the host daemon is running it keeps the host to guest channels
+    connected, so the host daemon needs to be used to call guests.
+    """
+    if control_socket and os.path.exists(control_socket):
+        try:
+            return BrokeredGuestChannel(guest_name, control_socket, timeout)
+        except EnvironmentError as e:
+            logger.debug("Failed to connect to control socket %s, connecting directly. (%s)", control_socket, e)
+    return GuestChannel(guest_name=guest_name, timeout=timeout)
+
+
+def find_matching_guests(patterns=None, concurrency=DISCOVERY_CONCURRENCY):
+    """
+    Find the guests selected by the given names and/or patterns.
+
+    :param patterns: A list of guest names and/or :mod:`fnmatch` patterns
+                     (strings) or :data:`None` to select all guests that
+                     support the negotiator interface.
+    :param concurrency: Passed on to :func:`find_supported_guests()`.
+    :returns: A sorted list of guest names (strings).
+
+    Names without wildcards are selected without checking whether the guest
+    supports the negotiator interface, so :func:`find_supported_guests()` is
+    only used when :data:`None` or a pattern is given.
+    """
+    wildcards = [p for p in patterns or [] if is_pattern(p)]
+    selected = set(p for p in patterns or [] if not is_pattern(p))
+    if patterns is None or wildcards:
+        for guest_name in find_supported_guests(concurrency):
+            if patterns is None or any(fnmatch.fnmatch(guest_name, p) for p in wildcards):
+                selected.add(guest_name)
+    return sorted(selected)
+
+
+def is_pattern(value):
+    """
+    Check whether a string is a :mod:`fnmatch` pattern.
+
+    :param value: The string to check.
+    :returns: :data:`True` if the string contains wildcards, :data:`False` otherwise.
+    """
+    return any(c in value for c in '*?[')
+
+
 def find_channels_of_guest(guest_name):
     """
     Find the pathnames of the channels associated to a guest.
@@ -223,14 +966,36 @@ def find_channels_of_guest(guest_name):
               of UNIX socket files (strings) as values. If no channels are
               detected an empty dictionary will be returned.
 
-    This function uses ``virsh dumpxml`` and parses the XML output to
-    determine the pathnames of the channels associated to the guest.
+    This function reads the live XML definition of the guest from libvirt's
+    state directory (falling back to ``virsh dumpxml``) and parses it to
+    determine the pathnames of the channels associated to the guest. The
+    results are cached until the definition changes (see
+    :class:`DiscoveryCache`).
+    """
+    channels = discovery_cache.find_channels(guest_name)
+    if channels:
+        logger.debug("Discovered '%s' channels: %s", guest_name, channels)
+    else:
+        logger.debug("No channels found for guest '%s'.", guest_name)
+    return channels
+
+
+def parse_channels(domain_xml):
+    """
+    Find the channels in the XML definition of a guest.
+
+    :param domain_xml: The output of ``virsh dumpxml`` or the contents of a
+                       live XML definition in libvirt's state directory (a
+                       string or byte string).
+    :returns: A dictionary with channel names (strings) as keys and pathnames
+              of UNIX socket files (strings) as values.
     """
-    logger.debug("Discovering '%s' channels using 'virsh dumpxml' command ..", guest_name)
-    domain_xml = execute('virsh', 'dumpxml', guest_name, capture=True)
+    import xml.etree.ElementTree
     parsed_xml = xml.etree.ElementTree.fromstring(domain_xml)
+    # Live XML definitions wrap the domain in a <domstatus> element.
+    domain = parsed_xml if parsed_xml.tag == 'domain' else parsed_xml.find('domain')
     channels = {}
-    for channel in parsed_xml.findall('devices/channel'):
+    for channel in domain.findall('devices/channel') if domain is not None else []:
         if channel.attrib.get('type') == 'unix':
             source = channel.find('source')
             target = channel.find('target')
@@ -239,10 +1004,6 @@ def find_channels_of_guest(guest_name):
                 path = source.attrib.get('path')
                 if name in SUPPORTED_CHANNEL_NAMES:
                     channels[name] = path
-    if channels:
-        logger.debug("Discovered '%s' channels: %s", guest_name, channels)
-    else:
-        logger.debug("No channels found for guest '%s'.", guest_name)
     return channels
 
 
@@ -264,6 +1025,7 @@ def find_running_guests():
     :returns: A generator of strings.
     :raises: :exc:`GuestDiscoveryError` when ``virsh list`` fails.
     """
+    from executor import ExternalCommandFailed, execute
     try:
         logger.debug("Discovering running guests using 'virsh list' command ..")
         output = execute('virsh', '--quiet', 'list', '--all', capture=True, logger=logger)
@@ -278,3 +1040,7 @@ def find_running_guests():
                     yield vm_name
             except Exception:
                 logger.warning("Failed to parse 'virsh list' output! (%r)", line)
+
+
+discovery_cache = DiscoveryCache()
+"""The :class:`DiscoveryCache` used by :func:`find_channels_of_guest()`."""
@@ -1,15 +1,21 @@
 # Scriptable KVM/QEMU guest agent in Python.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: March 3, 2019
+# Last Change: October 16, 2026
 # URL: https://negotiator.readthedocs.org
 
 """
-Usage: negotiator-host [OPTIONS] GUEST_NAME
+Usage: negotiator-host [OPTIONS] [GUEST_NAME ...]
 
 Communicate from a KVM/QEMU host system with running guest systems using a
 guest agent daemon running inside the guests.
 
+The --execute option accepts multiple guest names as well as patterns like
+'web*' (remember to quote them) and the --all option to run the command
+inside many guests at the same time. In this case the output of each guest
+is reported when its command has finished, with each line prefixed by the
+name of the guest (or as JSON, see --json).
+
 Supported options:
 
   -g, --list-guests
@@ -22,20 +28,91 @@ Supported options:
 
   -e, --execute=COMMAND
 
-    Execute the given command inside GUEST_NAME. The standard output stream of
-    the command inside the guest is intercepted and copied to the standard
-    output stream on the host. If the command exits with a nonzero status code
-    the negotiator-host program will also exit with a nonzero status code.
+    Execute the given command inside GUEST_NAME. The standard output and error
+    streams of the command inside the guest are copied to the standard output
+    and error streams on the host as the output arrives. If the command exits
+    with a nonzero status code the negotiator-host program will also exit with
+    a nonzero status code.
+
+    When the standard input stream is redirected from a pipe or file, its
+    contents are streamed to the standard input of the remote command.
+
+  -a, --all
+
+    Execute the command given by --execute inside all guests that have the
+    appropriate channel.
+
+  -p, --parallel=COUNT
+
+    Set the number of guests that --execute talks to at the same time when
+    multiple guests are selected. The default is 8.
+
+  -j, --json
+
+    Report the results of --execute as JSON lines (one JSON object per guest
+    with the keys 'guest', 'returncode', 'stdout', 'stderr', 'error' and
+    'elapsed').
+
+  -P, --pipe
+
+    Read commands for GUEST_NAME from the standard input stream (one per line)
+    and run them all using the same connection. Each line contains a shell
+    command line or a JSON object with the key 'command' (and optionally
+    'input') or 'method' (and optionally 'args' and 'kw'). The outcome of
+    each command is reported as a JSON line with the keys 'id', 'returncode',
+    'stdout', 'stderr', 'error' and 'elapsed' (or 'result' for method calls).
+    The timeout applies to each command individually.
+
+  -s, --push-file=PATHNAME
+
+    Copy the given local file to the file transfer directory inside GUEST_NAME
+    (/var/lib/negotiator/files by default). Interrupted transfers are resumed.
+
+  -r, --pull-file=NAME
+
+    Copy the given file from the file transfer directory inside GUEST_NAME to
+    the current working directory. Interrupted transfers are resumed.
+
+  -y, --sync-file=PATHNAME
+
+    Update the copy of the given local file in the file transfer directory
+    inside GUEST_NAME. Only the blocks of the file that changed are sent.
 
   -t, --timeout=SECONDS
 
     Set the number of seconds before a remote call without a response times
     out. A value of zero disables the timeout (in this case the command can
-    hang indefinitely). The default is 10 seconds.
+    hang indefinitely). The default is 10 seconds. When multiple guests are
+    selected the timeout applies to each guest individually. File transfers
+    only time out when no progress is made for the given number of seconds.
 
   -d, --daemon
 
-    Start the host daemon that answers real time requests from guests.
+    Start the host daemon that answers real time requests from guests. The
+    host daemon keeps the connections to guests open and accepts calls for
+    guests on the control socket /run/negotiator/host.sock. The other options
+    of negotiator-host use this control socket while the daemon is running,
+    which avoids the overhead of discovering and connecting to guests.
+
+  -S, --single-process
+
+    Make the host daemon serve all guests from a single process (instead of
+    starting a process for each guest). This uses a lot less memory on hosts
+    that run many guests.
+
+  -F, --fork-server
+
+    Make the host daemon start the commands requested by guests from a small
+    helper process that's forked when the daemon starts. This keeps the
+    overhead of starting commands low while the daemon grows. Only used in
+    combination with --single-process.
+
+  -C, --concurrency=COUNT
+
+    Set the number of requests from each guest that the host daemon handles
+    at the same time. The default is 1 (requests are handled one at a time).
+    When combined with --single-process this sets the number of requests that
+    are handled at the same time for all guests combined (the default is 16).
 
   -v, --verbose
 
@@ -53,19 +130,26 @@ Supported options:
 # Standard library modules.
 import functools
 import getopt
+import io
+import json
 import logging
 import shlex
 import sys
 
-# External dependencies.
-import coloredlogs
-from humanfriendly import Timer
-from humanfriendly.terminal import usage, warning
-
 # Modules included in our project.
-from negotiator_common.config import DEFAULT_TIMEOUT
-from negotiator_common.utils import TimeOut
-from negotiator_host import GuestDiscoveryError, HostDaemon, GuestChannel, find_supported_guests
+from negotiator_common.config import DEFAULT_CONCURRENCY, DEFAULT_TIMEOUT, EVENT_LOOP_CONCURRENCY, FAN_OUT_CONCURRENCY
+from negotiator_common.pipe import run_pipe
+from negotiator_common.transfer import pull_file, push_file, sync_file
+from negotiator_common.utils import TimeOut, Timer, configure_logging, get_redirected_input, iterate_concurrently
+from negotiator_host import (
+    EventLoopHostDaemon,
+    GuestDiscoveryError,
+    HostDaemon,
+    connect_to_guest,
+    find_matching_guests,
+    find_supported_guests,
+    is_pattern,
+)
 
 # Initialize a logger for this module.
 logger = logging.getLogger(__name__)
@@ -73,16 +157,19 @@ logger = logging.getLogger(__name__)
 
 def main():
     """Command line interface for the ``negotiator-host`` program."""
-    # Initialize logging to the terminal and system log.
-    coloredlogs.install(syslog=True)
     # Parse the command line arguments.
     actions = []
     context = Context()
+    verbosity = 0
     try:
-        options, arguments = getopt.getopt(sys.argv[1:], 'gce:t:dvqh', [
-            'list-guests', 'list-commands', 'execute=', 'timeout=', 'daemon',
-            'verbose', 'quiet', 'help'
+        options, arguments = getopt.getopt(sys.argv[1:], 'gce:ap:jPs:r:y:t:dSFC:vqh', [
+            'list-guests', 'list-commands', 'execute=', 'all', 'parallel=', 'json', 'pipe',
+            'push-file=', 'pull-file=', 'sync-file=', 'timeout=', 'daemon',
+            'single-process', 'fork-server', 'concurrency=', 'verbose', 'quiet', 'help',
         ])
+        # Fan out to multiple guests when the arguments and/or options ask for it.
+        fan_out = (len(arguments) > 1 or any(is_pattern(a) for a in arguments) or
+                   any(o in ('-a', '--all', '-j', '--json') for o, v in options))
         for option, value in options:
             if option in ('-g', '--list-guests'):
                 actions.append(context.print_guest_names)
@@ -90,27 +177,58 @@ def main():
                 assert len(arguments) == 1, \
                     "Please provide the name of a guest as the 1st and only positional argument!"
                 actions.append(functools.partial(context.print_commands, arguments[0]))
+            elif option in ('-e', '--execute') and fan_out:
+                actions.append(functools.partial(context.execute_fan_out, arguments, value))
             elif option in ('-e', '--execute'):
                 assert len(arguments) == 1, \
                     "Please provide the name of a guest as the 1st and only positional argument!"
                 actions.append(functools.partial(context.execute_command, arguments[0], value))
+            elif option in ('-a', '--all'):
+                context.all_guests = True
+            elif option in ('-p', '--parallel'):
+                context.parallel = int(value)
+            elif option in ('-j', '--json'):
+                context.json = True
+            elif option in ('-P', '--pipe'):
+                assert len(arguments) == 1, \
+                    "Please provide the name of a guest as the 1st and only positional argument!"
+                actions.append(functools.partial(context.run_pipe, arguments[0]))
+            elif option in ('-s', '--push-file'):
+                assert len(arguments) == 1, \
+                    "Please provide the name of a guest as the 1st and only positional argument!"
+                actions.append(functools.partial(context.push_file, arguments[0], value))
+            elif option in ('-r', '--pull-file'):
+                assert len(arguments) == 1, \
+                    "Please provide the name of a guest as the 1st and only positional argument!"
+                actions.append(functools.partial(context.pull_file, arguments[0], value))
+            elif option in ('-y', '--sync-file'):
+                assert len(arguments) == 1, \
+                    "Please provide the name of a guest as the 1st and only positional argument!"
+                actions.append(functools.partial(context.sync_file, arguments[0], value))
             elif option in ('-t', '--timeout'):
                 context.timeout = int(value)
             elif option in ('-d', '--daemon'):
-                actions.append(HostDaemon)
+                actions.append(context.start_daemon)
+            elif option in ('-S', '--single-process'):
+                context.single_process = True
+            elif option in ('-F', '--fork-server'):
+                context.fork_server = True
+            elif option in ('-C', '--concurrency'):
+                context.concurrency = int(value)
             elif option in ('-v', '--verbose'):
-                coloredlogs.increase_verbosity()
+                verbosity += 1
             elif option in ('-q', '--quiet'):
-                coloredlogs.decrease_verbosity()
+                verbosity -= 1
             elif option in ('-h', '--help'):
-                usage(__doc__)
-                sys.exit(0)
+                show_usage()
         if not actions:
-            usage(__doc__)
-            sys.exit(0)
+            show_usage()
     except Exception:
+        from humanfriendly.terminal import warning
         warning("Failed to parse command line arguments!")
         sys.exit(1)
+    # Initialize logging to the terminal (and the system log for the daemon).
+    configure_logging(verbosity, syslog=context.start_daemon in actions)
     # Execute the requested action(s).
     try:
         for action in actions:
@@ -125,31 +243,160 @@ def main():
         sys.exit(1)
 
 
+def show_usage():
+    """Show the usage message and exit."""
+    from humanfriendly.terminal import usage
+    usage(__doc__)
+    sys.exit(0)
+
+
 class Context(object):
 
-    """Enables :func:`main()` to inject a custom timeout into partially applied actions."""
+    """Enables :func:`main()` to inject custom options into partially applied actions."""
 
     def __init__(self):
         """Initialize a context for executing commands on the host."""
         self.timeout = DEFAULT_TIMEOUT
+        self.concurrency = None
+        self.single_process = False
+        self.fork_server = False
+        self.all_guests = False
+        self.parallel = FAN_OUT_CONCURRENCY
+        self.json = False
+
+    def start_daemon(self):
+        """Start the host daemon that answers real time requests from guests."""
+        if self.single_process:
+            daemon = EventLoopHostDaemon(concurrency=self.concurrency or EVENT_LOOP_CONCURRENCY,
+                                         fork_server=self.fork_server, enter_main_loop=False)
+        else:
+            daemon = HostDaemon(concurrency=self.concurrency or DEFAULT_CONCURRENCY, enter_main_loop=False)
+        daemon.enter_main_loop()
 
     def print_guest_names(self):
         """Print the names of the guests that Negotiator can connect with."""
-        guests = find_supported_guests()
-        if guests:
-            print('\n'.join(sorted(guests)))
+        for guest_name in find_supported_guests():
+            # Names are printed as soon as they're known, so they're not sorted.
+            print(guest_name)
+            sys.stdout.flush()
 
     def print_commands(self, guest_name):
         """Print the commands supported by the guest."""
         with TimeOut(self.timeout):
-            channel = GuestChannel(guest_name=guest_name)
+            channel = connect_to_guest(guest_name)
             print('\n'.join(sorted(channel.call_remote_method('list_commands'))))
 
     def execute_command(self, guest_name, command_line):
         """Execute a command inside the named guest."""
         with TimeOut(self.timeout):
             timer = Timer()
-            channel = GuestChannel(guest_name=guest_name)
-            output = channel.call_remote_method('execute', *shlex.split(command_line), capture=True)
+            channel = connect_to_guest(guest_name)
+            returncode = channel.execute_remote_command(shlex.split(command_line), input=get_redirected_input())
             logger.debug("Took %s to execute remote command.", timer)
-            print(output.rstrip())
+        if returncode != 0:
+            logger.error("Remote command exited with status code %i!", returncode)
+            sys.exit(returncode)
+
+    def execute_fan_out(self, patterns, command_line):
+        """Execute a command inside the guests selected by names and/or patterns."""
+        assert patterns or self.all_guests, "Please provide guest names or patterns (or use --all)!"
+        timer = Timer()
+        guest_names = find_matching_guests(None if self.all_guests else patterns)
+        command = shlex.split(command_line)
+        input = get_redirected_input()
+        # The input is read once because it's sent to every guest.
+        data = input.read() if input is not None else None
+        failures = 0
+        for guest_name, result, error in iterate_concurrently(functools.partial(self.execute_captured, command, data),
+                                                              guest_names, max(1, self.parallel)):
+            if error or result['returncode'] != 0:
+                failures += 1
+            self.report_result(guest_name, result, error)
+        logger.debug("Took %s to execute remote command inside %i guests.", timer, len(guest_names))
+        if failures:
+            logger.error("Remote command failed inside %i out of %i guests!", failures, len(guest_names))
+            sys.exit(1)
+
+    def execute_captured(self, command, data, guest_name):
+        """
+        Execute a command inside a guest and capture its output (used by :func:`execute_fan_out()`).
+
+        :param command: The command name and any arguments (a list of strings).
+        :param data: The input for the command (a byte string or :data:`None`).
+        :param guest_name: The name of the guest (a string).
+        :returns: A dictionary with the keys ``returncode``, ``stdout``,
+                  ``stderr`` and ``elapsed``.
+
+        This runs in a worker thread where :class:`~negotiator_common.utils.TimeOut`
+        can't be used, so the timeout is enforced using socket timeouts.
+        """
+        timer = Timer()
+        stdout = io.BytesIO()
+        stderr = io.BytesIO()
+        channel = connect_to_guest(guest_name, timeout=self.timeout or None)
+        try:
+            returncode = channel.execute_remote_command(
+                command, input=io.BytesIO(data) if data is not None else None,
+                stdout=stdout, stderr=stderr,
+            )
+        finally:
+            channel.close()
+        return dict(returncode=returncode, stdout=stdout.getvalue(), stderr=stderr.getvalue(),
+                    elapsed=timer.elapsed_time)
+
+    def report_result(self, guest_name, result, error):
+        """
+        Report the outcome of executing a command inside a guest (used by :func:`execute_fan_out()`).
+
+        :param guest_name: The name of the guest (a string).
+        :param result: The dictionary returned by :func:`execute_captured()`
+                       or :data:`None` when an exception was raised.
+        :param error: The exception that was raised or :data:`None`.
+        """
+        result = result or dict(returncode=None, stdout=b'', stderr=b'', elapsed=None)
+        stdout = result['stdout'].decode('utf-8', 'replace')
+        stderr = result['stderr'].decode('utf-8', 'replace')
+        # Socket timeouts are reported without a message.
+        message = (str(error) or error.__class__.__name__) if error else None
+        if self.json:
+            print(json.dumps(dict(
+                guest=guest_name, returncode=result['returncode'], stdout=stdout, stderr=stderr,
+                error=message, elapsed=result['elapsed'],
+            ), sort_keys=True))
+        else:
+            for line in stdout.splitlines():
+                print("%s: %s" % (guest_name, line))
+            for line in stderr.splitlines():
+                sys.stderr.write("%s: %s\n" % (guest_name, line))
+            if error:
+                logger.error("[%s] Failed to execute remote command! (%s)", guest_name, message)
+            elif result['returncode'] != 0:
+                logger.error("[%s] Remote command exited with status code %i!", guest_name, result['returncode'])
+        sys.stdout.flush()
+
+    def run_pipe(self, guest_name):
+        """Execute the commands read from the standard input stream inside the named guest."""
+        timer = Timer()
+        failures = run_pipe(functools.partial(connect_to_guest, guest_name), sys.stdin, sys.stdout, self.timeout)
+        logger.debug("Took %s to handle the commands for %s.", timer, guest_name)
+        if failures:
+            logger.error("%i remote command(s) failed!", failures)
+            sys.exit(1)
+
+    def push_file(self, guest_name, pathname):
+        """Copy a local file to the guest."""
+        with TimeOut(self.timeout) as alarm:
+            channel = connect_to_guest(guest_name)
+            push_file(channel, pathname, progress=alarm.reset)
+
+    def pull_file(self, guest_name, name):
+        """Copy a file from the guest to the current working directory."""
+        with TimeOut(self.timeout) as alarm:
+            channel = connect_to_guest(guest_name)
+            pull_file(channel, name, progress=alarm.reset)
+
+    def sync_file(self, guest_name, pathname):
+        """Update the copy of a local file in the guest."""
+        with TimeOut(self.timeout) as alarm:
+            channel = connect_to_guest(guest_name)
+            sync_file(channel, pathname, progress=alarm.reset)
@@ -0,0 +1,173 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""
+Watch directories for changes using the Linux inotify API.
+
+This module enables the host daemon to notice guests being started and
+stopped as soon as libvirt updates its runtime state directory (see
+:data:`.LIBVIRT_STATE_DIRECTORY`) instead of polling ``virsh list``. The
+inotify API is accessed using :mod:`ctypes` so that no additional
+dependencies are required. On platforms without inotify
+:func:`DirectoryWatcher.create()` returns :data:`None` and the host daemon
+falls back to polling.
+"""
+
+# Standard library modules.
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import logging
+import os
+import select
+import struct
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
+
+# Constants from <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+"""The events that :class:`DirectoryWatcher` watches for (an integer)."""
+
+EVENT_HEADER = struct.Struct('iIII')
+"""The binary format of the fixed size part of ``struct inotify_event``."""
+
+
+class DirectoryWatcher(object):
+
+    """Watch a directory for files being created, changed or removed."""
+
+    @classmethod
+    def create(cls, directory, pattern='*'):
+        """
+        Create a :class:`DirectoryWatcher` if possible.
+
+        :param directory: The pathname of the directory to watch (a string).
+        :param pattern: A filename pattern (see :mod:`fnmatch`) that selects
+                        the files to report on (a string, defaults to ``*``).
+        :returns: A :class:`DirectoryWatcher` object or :data:`None` when
+                  inotify isn't available or the directory doesn't exist.
+        """
+        try:
+            return cls(directory, pattern)
+        except (AttributeError, EnvironmentError) as e:
+            logger.debug("Can't watch %s for changes! (%s)", directory, e)
+            return None
+
+    def __init__(self, directory, pattern='*'):
+        """
+        Initialize a :class:`DirectoryWatcher` object.
+
+        :param directory: The pathname of the directory to watch (a string).
+        :param pattern: A filename pattern (see :mod:`fnmatch`) that selects
+                        the files to report on (a string, defaults to ``*``).
+        :raises: :exc:`~exceptions.EnvironmentError` when inotify fails and
+                 :exc:`~exceptions.AttributeError` when the C library
+                 doesn't provide inotify.
+        """
+        self.directory = directory
+        self.pattern = pattern
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise_errno("inotify_init1() failed")
+        if libc.inotify_add_watch(self.fd, ctypes.c_char_p(directory.encode('utf-8')), WATCH_MASK) < 0:
+            os.close(self.fd)
+            raise_errno("Failed to watch %s" % directory)
+        self.closed = False
+        self.removed = False
+        logger.debug("Watching %s for changes using inotify ..", directory)
+
+    def fileno(self):
+        """Get the inotify file descriptor (an integer, this enables waiting for changes using :mod:`select`)."""
+        return self.fd
+
+    def read_changes(self):
+        """
+        Read the pending events without blocking.
+
+        :returns: A set of filenames (strings) that were created, changed or
+                  removed and match the pattern. When the kernel's event queue
+                  overflowed the set contains :data:`None` to indicate that
+                  changes may have been missed.
+
+        When the watched directory itself is removed :attr:`removed` is set
+        to :data:`True`, the caller is expected to close the watcher and
+        create a new watcher once the directory exists again.
+        """
+        changes = set()
+        while not (self.closed or self.removed):
+            try:
+                data = os.read(self.fd, 1024 * 64)
+            except EnvironmentError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    changes.add(None)
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    logger.debug("Watched directory %s was removed.", self.directory)
+                    changes.add(None)
+                    self.removed = True
+                elif name:
+                    filename = name.decode('utf-8', 'replace')
+                    if fnmatch.fnmatch(filename, self.pattern):
+                        changes.add(filename)
+        if changes:
+            logger.debug("Detected changes in %s: %s", self.directory, sorted(changes, key=str))
+        return changes
+
+    def wait(self, timeout):
+        """
+        Wait for changes.
+
+        :param timeout: The maximum number of seconds to wait (a number).
+        :returns: The value returned by :func:`read_changes()` (empty when
+                  the timeout expired).
+        """
+        if not (self.closed or self.removed):
+            try:
+                readable, writable, exceptional = select.select([self.fd], [], [], timeout)
+            except EnvironmentError as e:
+                if e.errno != errno.EINTR:
+                    raise
+            return self.read_changes()
+        return set()
+
+    def close(self):
+        """Stop watching the directory."""
+        if not self.closed:
+            self.closed = True
+            os.close(self.fd)
+
+
+def raise_errno(message):
+    """
+    Raise an exception for a failed C library call.
+
+    :param message: A message explaining what failed (a string).
+    :raises: :exc:`~exceptions.OSError` based on :func:`ctypes.get_errno()`.
+    """
+    error = ctypes.get_errno()
+    raise OSError(error, "%s: %s" % (message, os.strerror(error)))
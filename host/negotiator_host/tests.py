@@ -0,0 +1,186 @@
+# Scriptable KVM/QEMU guest agent in Python.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://negotiator.readthedocs.org
+
+"""Test suite for the host side of negotiator."""
+
+# Standard library modules.
+import os
+import shutil
+import tempfile
+import unittest
+
+# Modules included in our project.
+from negotiator_common.config import GUEST_TO_HOST_CHANNEL_NAME, HOST_TO_GUEST_CHANNEL_NAME
+from negotiator_host import HostDaemon, get_transfer_directory, parse_channels
+
+LIVE_XML_TEMPLATE = """
+<domstatus state='running' reason='booted' pid='1234'>
+  <domain type='kvm'>
+    <name>%(name)s</name>
+    <devices>
+      <channel type='unix'>
+        <source mode='bind' path='%(directory)s/%(name)s.guest-to-host'/>
+        <target type='virtio' name='%(guest_to_host)s'/>
+      </channel>
+      <channel type='unix'>
+        <source mode='bind' path='%(directory)s/%(name)s.host-to-guest'/>
+        <target type='virtio' name='%(host_to_guest)s'/>
+      </channel>
+    </devices>
+  </domain>
+</domstatus>
+"""
+"""A live XML definition of a guest like libvirt keeps in its state directory."""
+
+
+class FakeWorker(object):
+
+    """Stand-in for :class:`~negotiator_host.AutomaticGuestChannel` that doesn't connect to anything."""
+
+    def __init__(self, guest_name, unix_socket):
+        """Initialize a :class:`FakeWorker` object."""
+        self.guest_name = guest_name
+        self.unix_socket = unix_socket
+        self.terminated = False
+
+    def is_alive(self):
+        """:data:`True` until :func:`terminate()` is called."""
+        return not self.terminated
+
+    def terminate(self):
+        """Pretend to stop the worker."""
+        self.terminated = True
+
+
+class FakeHostDaemon(HostDaemon):
+
+    """Host daemon that records the workers it would start instead of starting them."""
+
+    def create_worker(self, guest_name, unix_socket):
+        """Create a :class:`FakeWorker` object."""
+        return FakeWorker(guest_name, unix_socket)
+
+    def report_resource_usage(self):
+        """Skip measuring memory usage."""
+
+
+class HostDaemonTestCase(unittest.TestCase):
+
+    """Test the discovery of guests by the host daemon using a fake state directory."""
+
+    def setUp(self):
+        """Create a temporary state directory and a host daemon that watches it."""
+        self.state_directory = tempfile.mkdtemp()
+        self.daemon = FakeHostDaemon(state_directory=self.state_directory, control_socket=None,
+                                     enter_main_loop=False)
+
+    def tearDown(self):
+        """Stop the host daemon and remove the temporary state directory."""
+        self.daemon.shutdown()
+        shutil.rmtree(self.state_directory)
+
+    def create_guest(self, name, channels=True):
+        """Create the live XML definition of a guest in the state directory."""
+        with open(os.path.join(self.state_directory, '%s.xml' % name), 'w') as handle:
+            if channels:
+                handle.write(LIVE_XML_TEMPLATE % dict(
+                    name=name, directory=self.state_directory,
+                    guest_to_host=GUEST_TO_HOST_CHANNEL_NAME,
+                    host_to_guest=HOST_TO_GUEST_CHANNEL_NAME,
+                ))
+            else:
+                handle.write("<domstatus><domain type='kvm'><name>%s</name></domain></domstatus>" % name)
+
+    def remove_guest(self, name):
+        """Remove the live XML definition of a guest from the state directory."""
+        os.unlink(os.path.join(self.state_directory, '%s.xml' % name))
+
+    def synchronize(self):
+        """Let the host daemon notice the changes to the state directory."""
+        self.daemon.run_once(0.5)
+        self.daemon.run_once(0)
+
+    def test_parse_channels(self):
+        """Make sure channels are found in live XML definitions."""
+        self.create_guest('vm1')
+        with open(os.path.join(self.state_directory, 'vm1.xml')) as handle:
+            channels = parse_channels(handle.read())
+        assert channels == {
+            GUEST_TO_HOST_CHANNEL_NAME: os.path.join(self.state_directory, 'vm1.guest-to-host'),
+            HOST_TO_GUEST_CHANNEL_NAME: os.path.join(self.state_directory, 'vm1.host-to-guest'),
+        }
+
+    def test_guests_started_and_stopped(self):
+        """Make sure workers are started and stopped as XML files are created and removed."""
+        self.synchronize()
+        assert self.daemon.workers == {}
+        self.create_guest('vm1')
+        self.create_guest('vm2')
+        self.synchronize()
+        assert sorted(self.daemon.workers) == ['vm1', 'vm2']
+        worker = self.daemon.workers['vm1']
+        assert worker.unix_socket == os.path.join(self.state_directory, 'vm1.guest-to-host')
+        self.remove_guest('vm1')
+        self.synchronize()
+        assert sorted(self.daemon.workers) == ['vm2']
+        assert worker.terminated
+
+    def test_unsupported_guests_ignored(self):
+        """Make sure guests without channels are ignored until their definition changes."""
+        self.create_guest('vm1', channels=False)
+        self.synchronize()
+        assert self.daemon.workers == {}
+        assert self.daemon.is_ignored('vm1')
+        self.create_guest('vm1')
+        self.synchronize()
+        assert sorted(self.daemon.workers) == ['vm1']
+
+    def test_changes_detected(self):
+        """Make sure changes to the state directory are noticed without polling."""
+        self.synchronize()
+        if not self.daemon.watcher:
+            self.skipTest("inotify isn't available")
+        assert not self.daemon.discovery_needed()
+        self.create_guest('vm1')
+        self.daemon.wait(5)
+        assert self.daemon.discovery_needed()
+
+
+class TransferDirectoryTestCase(unittest.TestCase):
+
+    """Test the file transfer directories of guests."""
+
+    def setUp(self):
+        """Create a temporary parent directory."""
+        self.parent_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the temporary parent directory."""
+        shutil.rmtree(self.parent_directory)
+
+    def test_directory_per_guest(self):
+        """Make sure every guest gets its own file transfer directory."""
+        vm1 = get_transfer_directory('vm1', self.parent_directory)
+        vm2 = get_transfer_directory('vm2', self.parent_directory)
+        assert vm1 == os.path.join(self.parent_directory, 'vm1')
+        assert vm2 == os.path.join(self.parent_directory, 'vm2')
+        assert os.path.isdir(vm1) and os.path.isdir(vm2)
+
+    def test_directory_inside_parent(self):
+        """Make sure guest names can't refer to a directory outside of the parent directory."""
+        for guest_name in ('..', '.', '../vm1', '/vm1'):
+            directory = get_transfer_directory(guest_name, self.parent_directory)
+            assert os.path.dirname(directory) == self.parent_directory
+
+    def test_transfers_disabled(self):
+        """Make sure no directories are created when file transfers are disabled."""
+        parent_directory = os.path.join(self.parent_directory, 'missing')
+        assert not os.path.isdir(get_transfer_directory('vm1', parent_directory))
+        assert not os.path.isdir(parent_directory)
+
+
+if __name__ == '__main__':
+    unittest.main()